@@ -1,9 +1,11 @@
 'use strict';
 
 angular.module('sndlatr.initialize',
-    ['sndlatr.authflow', 'sndlatr.scheduler'])
-  .run(['authflow', '$rootScope', '$http', '$log', 'SendJob', 'RemindJob', 'Snippet',
-    function(authflow, $rootScope, $http, $log, SendJob, RemindJob, Snippet) {
+    ['sndlatr.authflow', 'sndlatr.scheduler', 'sndlatr.push'])
+  .run(['authflow', '$rootScope', '$http', '$log', 'push', 'BaseJob',
+    'SendJob', 'RemindJob', 'Snippet',
+    function(authflow, $rootScope, $http, $log, push, BaseJob, SendJob,
+             RemindJob, Snippet) {
 
       function onSuccess(result) {
         var auth = result['auth'];
@@ -11,9 +13,11 @@ angular.module('sndlatr.initialize',
         if (auth == 'need_code') {
           authflow.openDialog();
         } else {
+          BaseJob.changesToken = result['changesToken'] || null;
           SendJob.loadData(result['sendJobs']);
           RemindJob.loadData(result['remindJobs']);
           Snippet.loadData(result['snippets']);
+          push.connect();
           $rootScope.isInitialized = true;
           $log.debug('sndlatr init complete');
           // initialize scheduler with data from result
@@ -0,0 +1,97 @@
+'use strict';
+
+angular.module('sndlatr.push', ['sndlatr.scheduler', 'sndlatr.constants'])
+  .factory('push', ['$window', '$document', '$http', '$q', '$timeout',
+    '$rootScope', '$log', 'constants', 'BaseJob',
+    function($window, $document, $http, $q, $timeout, $rootScope, $log,
+             constants, BaseJob) {
+      /**
+       * Receives job changes pushed by the backend over an app engine
+       * channel. Jobs are not polled while the channel is open.
+       */
+      var push = {};
+      /**
+       * @type {number} delay in ms before a closed channel is reopened.
+       */
+      push.REOPEN_DELAY = 10000;
+      var apiPromise = null;
+
+      /**
+       * Loads channel javascript api from backend.
+       * @return {Object} promise resolved when goog.appengine.Channel is
+       * available.
+       * @private
+       */
+      push._loadApi = function() {
+        if (apiPromise) return apiPromise;
+        var deferred = $q.defer();
+        if ($window.goog && $window.goog.appengine) {
+          deferred.resolve();
+        } else {
+          var script = $document[0].createElement('script');
+          script.type = 'text/javascript';
+          script.src = constants.BACKEND + '/_ah/channel/jsapi';
+          script.onload = function() {
+            $rootScope.$apply(function() {
+              deferred.resolve();
+            });
+          };
+          script.onerror = function() {
+            $rootScope.$apply(function() {
+              apiPromise = null;
+              deferred.reject();
+            });
+          };
+          $document[0].getElementsByTagName('head')[0].appendChild(script);
+        }
+        apiPromise = deferred.promise;
+        return apiPromise;
+      };
+
+      /**
+       * Opens channel with given token. Jobs are polled if this fails.
+       * @param {string} token channel token from backend.
+       */
+      push.open = function(token) {
+        push._loadApi().then(function() {
+          var channel = new $window.goog.appengine.Channel(token);
+          channel.open({
+            onopen: function() {
+              $rootScope.$apply(function() {
+                BaseJob.setPushActive(true);
+                // catch up with changes missed while there was no channel.
+                BaseJob.loadChanges();
+              });
+            },
+            onmessage: function(message) {
+              $rootScope.$apply(function() {
+                BaseJob.applyChanges(angular.fromJson(message.data));
+              });
+            },
+            onerror: function(error) {
+              $log.debug('channel error', error);
+            },
+            onclose: function() {
+              $rootScope.$apply(function() {
+                BaseJob.setPushActive(false);
+                $timeout(push.connect, push.REOPEN_DELAY);
+              });
+            }
+          });
+        }, function() {
+          $log.debug('could not load channel api, polling jobs');
+        });
+      };
+
+      /**
+       * Opens channel with a new token. Used after initialization and when
+       * channel was closed, e.g. because it expired.
+       */
+      push.connect = function() {
+        return $http.post('/api/channel').success(function(result) {
+          push.open(result.token);
+        });
+      };
+
+      return push;
+    }]);
@@ -242,19 +242,41 @@ angular.module('sndlatr.scheduler', [])
        * @protected
        */
       BaseJob._autoResetPreserveAttrs = [];
+      /**
+       * Token of /api/changes, set from /api/init. Jobs are polled by id
+       * if it is null.
+       * @type {?string}
+       */
+      BaseJob.changesToken = null;
+      /**
+       * True while changes are pushed by the backend (see push), jobs are
+       * not polled then.
+       * @type {boolean}
+       */
+      BaseJob.pushActive = false;
+      /**
+       * All subclasses, updated with the result of /api/changes.
+       * @type {Array.<Function>}
+       * @private
+       */
+      BaseJob._jobClasses = [];
 
       /**
        * Helper to inherit from BaseJob. This also takes care of creating a own,
        * $allModels array for the subclass.
        * @param {Function} cls subclass constructor.
+       * @param {string} changesKey key of jobs of subclass in result of
+       * /api/changes.
        * @protected
        */
-      BaseJob._inherit = function(cls) {
+      BaseJob._inherit = function(cls, changesKey) {
         angular.extend(cls, BaseJob,
           {prototype: Object.create(BaseJob.prototype)});
         cls.prototype.constructor = cls;
         cls.$allModels = [];
         cls._ignoredPutUpdateAttrs = BaseJob._ignoredPutUpdateAttrs;
+        cls._changesKey = changesKey;
+        BaseJob._jobClasses.push(cls);
       };
 
       /**
@@ -306,43 +328,97 @@ angular.module('sndlatr.scheduler', [])
 
       /**
        * Updates all jobs with display state processing from backend.
+       * If there is a changes token, only jobs that changed since the last
+       * update are loaded (of all job classes).
        */
       BaseJob.updateProcessing = function() {
         var cls = this;
         var allIds = [];
-        var jobsByIds = {};
         this.$allModels.forEach(function(job) {
           if (job.shouldPoll() && job.id) {
-            jobsByIds[job.id] = job;
             allIds.push(job.id);
           }
         });
         if (!allIds.length) return $q.when();
-        // TODO: pool these requests.
+        if (BaseJob.changesToken !== null) return BaseJob.loadChanges();
         var query = '?id=' + allIds.join('&id=');
         return $http.get(cls._endpointUrl + query)
           .success(function(result) {
-            result.forEach(function(jobData) {
-              var job = jobsByIds[jobData.id];
-              if (job) {
-                // remove failed jobs and reset object.
-                if (cls._autoResetStates.indexOf(jobData.state) >= 0) {
-                  job.forget();
-                  job._reset(true);
-                } else {
-                  job.update(jobData);
-                }
-              }
-            });
+            cls._applyUpdates(result);
           });
       };
 
+      /**
+       * Loads jobs of all job classes that changed since changesToken.
+       * @return {Object} promise.
+       */
+      BaseJob.loadChanges = function() {
+        if (BaseJob.changesToken === null) return $q.when();
+        return $http.get('/api/changes?since=' + BaseJob.changesToken)
+          .success(function(result) {
+            BaseJob.changesToken = result.token;
+            BaseJob.applyChanges(result);
+          });
+      };
+
+      /**
+       * Updates loaded jobs of all job classes with changed jobs.
+       * @param {Object} changes jobs by changesKey of their class, as
+       * returned by /api/changes or pushed by the backend.
+       */
+      BaseJob.applyChanges = function(changes) {
+        BaseJob._jobClasses.forEach(function(jobCls) {
+          jobCls._applyUpdates(changes[jobCls._changesKey] || []);
+        });
+      };
+
+      /**
+       * Stops polling of all job classes while changes are pushed and
+       * resumes it otherwise.
+       * @param {boolean} active true if changes are pushed.
+       */
+      BaseJob.setPushActive = function(active) {
+        BaseJob.pushActive = active;
+        BaseJob._jobClasses.forEach(function(jobCls) {
+          if (active) {
+            if (jobCls._pollTimerPromise)
+              $timeout.cancel(jobCls._pollTimerPromise);
+            jobCls._pollTimerPromise = null;
+            jobCls._activePollTimerInterval = null;
+          } else {
+            jobCls._planUpdatePolling();
+          }
+        });
+      };
+
+      /**
+       * Updates loaded jobs with given data from backend.
+       * @param {Array.<Object>} data jobs.
+       * @private
+       */
+      BaseJob._applyUpdates = function(data) {
+        var cls = this;
+        data.forEach(function(jobData) {
+          var job = cls.getById(jobData.id);
+          if (job) {
+            // remove failed jobs and reset object.
+            if (cls._autoResetStates.indexOf(jobData.state) >= 0) {
+              job.forget();
+              job._reset(true);
+            } else {
+              job.update(jobData);
+            }
+          }
+        });
+      };
+
       /**
        * Schedules next processing poll update at _nextPollInterval(). But only
        * if there isn't a poll scheduled  earlier.
        */
       BaseJob._planUpdatePolling = function() {
         var cls = this;
+        if (BaseJob.pushActive) return;
 
         function pollAndReschedule() {
           cls._activePollTimerInterval = null;
@@ -418,6 +494,7 @@ angular.module('sndlatr.scheduler', [])
           case 'failed':
             return 'failed';
           case 'queued':
+          case 'sending':
             return 'processing';
           case 'scheduled':
             if (this.isDue())
@@ -445,7 +522,7 @@ angular.module('sndlatr.scheduler', [])
         BaseJob.call(this, obj);
       }
 
-      BaseJob._inherit(SendJob);
+      BaseJob._inherit(SendJob, 'sendJobs');
       var pro = SendJob.prototype;
       SendJob._endpointUrl = '/api/schedule';
       SendJob._autoResetPreserveAttrs = ['messageId'];
@@ -585,7 +662,7 @@ angular.module('sndlatr.scheduler', [])
         BaseJob.call(this, obj);
       }
 
-      BaseJob._inherit(RemindJob);
+      BaseJob._inherit(RemindJob, 'remindJobs');
       RemindJob._endpointUrl = '/api/remind';
       RemindJob._autoResetStates = ['failed', 'done'];
       RemindJob._autoResetPreserveAttrs = ['threadId'];
@@ -620,6 +697,7 @@ angular.module('sndlatr.scheduler', [])
       pro.shouldPoll = function() {
         return (this.state == 'scheduled' && this.isDue()) ||
           this.state == 'queued' ||
+          this.state == 'sending' ||
           this.state == 'checking';
       };
 
@@ -636,7 +714,8 @@ angular.module('sndlatr.scheduler', [])
             return 'new';
         } else if (state == 'checking' || state == 'disabled')
           return 'disabled';
-        else if (state == 'queued' || state == 'scheduled')
+        else if (state == 'queued' || state == 'sending' ||
+                 state == 'scheduled')
           return 'scheduled';
         else {
           // failed, done
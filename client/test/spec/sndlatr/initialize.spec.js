@@ -23,7 +23,7 @@ describe('scheduler', function() {
   }));
 
   it('should get code from google if requested',
-    inject(function($q, SendJob, RemindJob, Snippet) {
+    inject(function($q, BaseJob, SendJob, RemindJob, Snippet, push) {
       // authSpy.andReturn($q.when({code: 'testcode'}));
       $httpBackend.expectGET('/api/init').respond({auth: 'need_code'});
       // $httpBackend.expectPOST('/api/init', {code: 'testcode'}).respond();
@@ -36,13 +36,17 @@ describe('scheduler', function() {
       var sendJobSpy = spyOn(SendJob, 'loadData');
       var remindJobSpy = spyOn(RemindJob, 'loadData');
       var snippetJobSpy = spyOn(Snippet, 'loadData');
+      var pushSpy = spyOn(push, 'connect');
       $rootScope.$broadcast('authcomplete');
       $httpBackend.expectGET('/api/init').respond({sendJobs: ['job'
-      ], remindJobs: ['remindJob'], snippets: ['snippet']});
+      ], remindJobs: ['remindJob'], snippets: ['snippet'],
+        changesToken: '3'});
       $httpBackend.flush();
       expect(sendJobSpy).toHaveBeenCalledWith(['job']);
       expect(remindJobSpy).toHaveBeenCalledWith(['remindJob']);
       expect(snippetJobSpy).toHaveBeenCalledWith(['snippet']);
+      expect(BaseJob.changesToken).toEqual('3');
+      expect(pushSpy).toHaveBeenCalled();
       expect($rootScope.isInitialized).toBe(true);
     }));
 
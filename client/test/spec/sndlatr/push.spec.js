@@ -0,0 +1,72 @@
+'use strict';
+
+describe('push', function() {
+  beforeEach(module('sndlatr.push'));
+
+  var push, BaseJob, $httpBackend, $timeout, $rootScope, channel, handlers;
+
+  beforeEach(inject(function(_push_, _BaseJob_, _$httpBackend_, _$timeout_,
+                             _$rootScope_, $window) {
+    $rootScope = _$rootScope_;
+    push = _push_;
+    BaseJob = _BaseJob_;
+    $httpBackend = _$httpBackend_;
+    $timeout = _$timeout_;
+    channel = jasmine.createSpyObj('channel', ['open']);
+    channel.open.andCallFake(function(callbacks) {
+      handlers = callbacks;
+    });
+    $window.goog = {appengine: {
+      Channel: jasmine.createSpy('Channel').andReturn(channel)}};
+    spyOn(BaseJob, 'setPushActive');
+    spyOn(BaseJob, 'loadChanges');
+    spyOn(BaseJob, 'applyChanges');
+  }));
+
+  afterEach(inject(function($window) {
+    delete $window.goog;
+    $httpBackend.verifyNoOutstandingExpectation();
+    $httpBackend.verifyNoOutstandingRequest();
+  }));
+
+  function open() {
+    push.open('token');
+    // resolve api promise
+    $rootScope.$digest();
+  }
+
+  it('should open channel and catch up with changes',
+    inject(function($window) {
+      open();
+      expect($window.goog.appengine.Channel).toHaveBeenCalledWith('token');
+      handlers.onopen();
+      expect(BaseJob.setPushActive).toHaveBeenCalledWith(true);
+      expect(BaseJob.loadChanges).toHaveBeenCalled();
+    }));
+
+  it('should apply pushed changes', function() {
+    open();
+    handlers.onmessage({data: '{"sendJobs": [{"id": "1"}]}'});
+    expect(BaseJob.applyChanges).toHaveBeenCalledWith(
+      {sendJobs: [{id: '1'}]});
+  });
+
+  it('should connect with new token', inject(function($window) {
+    $httpBackend.expectPOST('/api/channel').respond({token: 'new'});
+    push.connect();
+    $httpBackend.flush();
+    $rootScope.$digest();
+    expect($window.goog.appengine.Channel).toHaveBeenCalledWith('new');
+  }));
+
+  it('should poll and reopen when closed', inject(function($window) {
+    open();
+    handlers.onclose();
+    expect(BaseJob.setPushActive).toHaveBeenCalledWith(false);
+    $httpBackend.expectPOST('/api/channel').respond({token: 'new'});
+    $timeout.flush();
+    $httpBackend.flush();
+    $rootScope.$digest();
+    expect($window.goog.appengine.Channel).toHaveBeenCalledWith('new');
+  }));
+});
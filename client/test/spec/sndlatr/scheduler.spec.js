@@ -217,6 +217,28 @@ describe('scheduler models', function() {
           expect(job1[attr]).not.toBeUndefined();
         });
       });
+
+      it('should load changes if there is a changes token',
+        inject(function(BaseJob) {
+          BaseJob.changesToken = '5';
+          var result = {sendJobs: [], remindJobs: [], token: '7'};
+          result[Job._changesKey] = [{id: 'key1', state: 'scheduled'}];
+          $httpBackend.expectGET('/api/changes?since=5').respond(result);
+          Job.updateProcessing();
+          $httpBackend.flush();
+          expect(job1.getDisplayState()).toEqual('scheduled');
+          expect(BaseJob.changesToken).toEqual('7');
+        }));
+
+      it('should not poll while changes are pushed',
+        inject(function(BaseJob, $timeout) {
+          BaseJob.setPushActive(true);
+          expect(Job._pollTimerPromise).toBeNull();
+          Job._planUpdatePolling();
+          expect(Job._pollTimerPromise).toBeNull();
+          BaseJob.setPushActive(false);
+          expect(Job._pollTimerPromise).toBeTruthy();
+        }));
     });
 
   }
@@ -481,6 +503,12 @@ describe('scheduler models', function() {
         var job = new SendJob({state: 'queued'});
         expect(job.isChangeable()).toBe(false);
       });
+
+      it('should be processing while sending', function() {
+        var job = new SendJob({state: 'sending'});
+        expect(job.getDisplayState()).toEqual('processing');
+        expect(job.isChangeable()).toBe(false);
+      });
     });
   });
 
@@ -0,0 +1,53 @@
+"""
+Micro benchmarks. Run them from the gae directory with the app engine sdk on
+the python path, e.g.::
+
+    python -m benchmarks.enqueue
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+
+
+root_path = os.path.join(os.path.dirname(__file__), '..')
+
+
+@contextmanager
+def gae_testbed():
+    """
+    Context manager that activates a testbed with datastore, memcache and
+    taskqueue stubs. Provides the testbed.
+    """
+    bed = testbed.Testbed()
+    bed.activate()
+    # cross group transactions need the high replication datastore
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=root_path)
+    try:
+        yield bed
+    finally:
+        bed.deactivate()
+
+
+@contextmanager
+def timer(result):
+    """
+    Context manager that measures wall clock time of its body. The elapsed
+    time in seconds is stored as result['elapsed'].
+    """
+    start = time.time()
+    yield
+    result['elapsed'] = time.time() - start
+
+
+def report(name, count, elapsed, unit='ops'):
+    """ Prints count / elapsed rate. """
+    rate = count / elapsed if elapsed else float('inf')
+    print '{:<40} {:>8d} {} in {:8.3f}s {:>12.1f} {}/s'.format(
+        name, count, unit, elapsed, rate, unit)
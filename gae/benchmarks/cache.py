@@ -0,0 +1,139 @@
+"""
+Compares w69b.cache with the implementations it replaced: the lru_cache
+decorator built on a deque with reference counts and the LRUCache built on
+an OrderedDict. Runs a hit heavy workload (keys skewed towards a small hot
+set, like tokens and folders of active users) and an eviction heavy one
+(uniform keys, four times more than fit). Reports the best of three
+runs::
+
+    python -m benchmarks.cache [operations]
+"""
+import sys
+import random
+import functools
+import threading
+import collections
+from itertools import ifilterfalse
+
+from w69b import cache
+from benchmarks import timer, report
+
+MAXSIZE = 1000
+
+
+def deque_lru_cache(maxsize=100):
+    """ lru_cache decorator of w69b.cache before it was based on LRUCache.
+    """
+    maxqueue = maxsize * 10
+
+    def decorating_function(user_function):
+        data = {}
+        queue = collections.deque()
+        refcount = collections.Counter()
+        sentinel = object()
+
+        @functools.wraps(user_function)
+        def wrapper(*args):
+            key = args
+            queue.append(key)
+            refcount[key] += 1
+            try:
+                result = data[key]
+            except KeyError:
+                result = user_function(*args)
+                data[key] = result
+                if len(data) > maxsize:
+                    key = queue.popleft()
+                    refcount[key] -= 1
+                    while refcount[key]:
+                        key = queue.popleft()
+                        refcount[key] -= 1
+                    del data[key], refcount[key]
+            if len(queue) > maxqueue:
+                refcount.clear()
+                queue.appendleft(sentinel)
+                for key in ifilterfalse(refcount.__contains__,
+                                        iter(queue.pop, sentinel)):
+                    queue.appendleft(key)
+                    refcount[key] = 1
+            return result
+        return wrapper
+    return decorating_function
+
+
+class OrderedDictLRUCache(object):
+    """ LRUCache of w69b.cache before it was a linked hash map. """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+def hot_keys(count):
+    """ 90% of accesses go to 10% of MAXSIZE keys. """
+    rand = random.Random(1)
+    hot = MAXSIZE / 10
+    return [rand.randrange(hot) if rand.random() < 0.9
+            else rand.randrange(MAXSIZE * 4) for _ in xrange(count)]
+
+
+def uniform_keys(count):
+    rand = random.Random(2)
+    return [rand.randrange(MAXSIZE * 4) for _ in xrange(count)]
+
+
+def run_mapping(lru, keys):
+    get, set = lru.get, lru.set
+    for key in keys:
+        if get(key) is None:
+            set(key, key)
+
+
+def run_decorated(decorator, keys):
+    fn = decorator(maxsize=MAXSIZE)(lambda key: key)
+    for key in keys:
+        fn(key)
+
+
+def main(count):
+    for workload, keys in (('hot', hot_keys(count)),
+                           ('uniform', uniform_keys(count))):
+        cases = (
+            ('OrderedDict LRUCache', run_mapping,
+             lambda: OrderedDictLRUCache(MAXSIZE)),
+            ('LRUCache', run_mapping, lambda: cache.LRUCache(MAXSIZE)),
+            ('LRUCache ttl+maxbytes', run_mapping,
+             lambda: cache.LRUCache(MAXSIZE, ttl=3600,
+                                    maxbytes=MAXSIZE * 100)),
+            ('deque lru_cache', run_decorated, lambda: deque_lru_cache),
+            ('lru_cache', run_decorated, lambda: cache.lru_cache))
+        for name, run, factory in cases:
+            elapsed = []
+            for _ in xrange(3):
+                result = {}
+                arg = factory()
+                with timer(result):
+                    run(arg, keys)
+                elapsed.append(result['elapsed'])
+            report('{} ({})'.format(name, workload), count, min(elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,86 @@
+"""
+Compares loading the jobs and snippets shown by /api/init with the display
+queries and with a single get of the dashboard, for a user with many jobs.
+All but DISPLAYED jobs are done for long, like the history of an active
+user. Also compares the cost of saving a job with and without updating the
+dashboard against the testbed stubs::
+
+    python -m benchmarks.dashboard [jobs per user]
+"""
+import sys
+import datetime
+
+from google.appengine.ext import ndb
+
+from sndlatr import models
+from benchmarks import gae_testbed, timer, report
+
+USER_ID = 'user'
+# jobs of the user that are shown
+DISPLAYED = 20
+REQUESTS = 100
+PUT_BATCH_SIZE = 500
+
+
+def build_job(num, now):
+    if num < DISPLAYED:
+        state, scheduled_at = 'scheduled', now + datetime.timedelta(days=1)
+    else:
+        state, scheduled_at = 'done', now - datetime.timedelta(days=30)
+    params = {'scheduled_at': scheduled_at, 'state': state,
+              'user_id': USER_ID, 'user_email': 'test@example.com'}
+    if num % 2:
+        return models.SendJob(message_id='4d2', **params)
+    return models.RemindJob(thread_id='4d2', **params)
+
+
+def create_jobs(count):
+    now = datetime.datetime.utcnow()
+    for i in xrange(0, count, PUT_BATCH_SIZE):
+        ndb.put_multi([build_job(num, now)
+                       for num in xrange(i, min(count, i + PUT_BATCH_SIZE))])
+    models.Snippet(user_id=USER_ID, name='snippet', body='hello').put()
+
+
+def load_queries():
+    futures = [models.SendJob.query_display(USER_ID).fetch_async(),
+               models.RemindJob.query_display(USER_ID).fetch_async(),
+               models.Snippet.query_display(USER_ID).fetch_async()]
+    return [entity for future in futures for entity in future.get_result()]
+
+
+def load_dashboard():
+    entities, _ = models.Dashboard.get_displayed_async(USER_ID).get_result()
+    return entities
+
+
+def bench(name, count, fn):
+    result = {}
+    with timer(result):
+        for _ in xrange(REQUESTS):
+            fn()
+    report('{} ({} jobs)'.format(name, count), REQUESTS, result['elapsed'],
+           'requests')
+
+
+def main(counts):
+    for count in counts:
+        with gae_testbed():
+            # measure datastore, not the caches of ndb
+            ndb.get_context().set_cache_policy(False)
+            ndb.get_context().set_memcache_policy(False)
+            create_jobs(count)
+            # builds dashboard
+            assert len(load_dashboard()) == DISPLAYED + 1
+            assert len(load_queries()) == DISPLAYED + 1
+            bench('init with queries', count, load_queries)
+            bench('init with dashboard', count, load_dashboard)
+            job = models.SendJob.query(
+                models.SendJob.user_id == USER_ID,
+                models.SendJob.state == 'scheduled').get()
+            bench('put job', count, job.put)
+            bench('save job and dashboard', count, job.save)
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
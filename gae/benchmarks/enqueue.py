@@ -0,0 +1,60 @@
+"""
+Compares enqueuing due jobs one transaction per job (add_to_queue) with the
+batched path of the dispatchers (add_batches_to_queue of user batches)
+against the testbed stubs.
+"""
+import sys
+import datetime
+
+from google.appengine.ext import ndb
+
+from sndlatr import models
+from benchmarks import gae_testbed, timer, report
+
+
+def create_jobs(count, users=50):
+    now = datetime.datetime.utcnow()
+    jobs = [models.SendJob(scheduled_at=now, user_id='user{}'.format(i % users),
+                           user_email='test@example.com',
+                           message_id='4d2')
+            for i in xrange(count)]
+    # every put adds its job to the dispatch index in a nested transaction,
+    # so jobs are put in small chunks to keep the nesting shallow.
+    for i in xrange(0, count, 20):
+        ndb.put_multi(jobs[i:i + 20])
+    return jobs
+
+
+def bench_single(count):
+    with gae_testbed():
+        jobs = create_jobs(count)
+        result = {}
+        with timer(result):
+            for job, countdown in models.SendJob.spread_user_jobs(
+                    jobs, bucket_size=10, bucket_margin=30):
+                job.add_to_queue(countdown=countdown)
+        report('add_to_queue (per job transaction)', count,
+               result['elapsed'], 'jobs')
+
+
+def bench_batches(count):
+    with gae_testbed():
+        jobs = create_jobs(count)
+        result = {}
+        with timer(result):
+            models.SendJob.add_batches_to_queue(
+                models.SendJob.spread_user_batches(
+                    jobs, batch_size=models.USER_BATCH_SIZE,
+                    batch_margin=models.USER_BATCH_MARGIN))
+        report('add_batches_to_queue (user batches)', count,
+               result['elapsed'], 'jobs')
+
+
+def main(counts):
+    for count in counts:
+        bench_single(count)
+        bench_batches(count)
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000])
@@ -0,0 +1,71 @@
+"""
+Compares fetching and parsing full headers (RFC822.HEADER with
+email.parser) with fetching only the header fields get_thread needs
+(HEADER.FIELDS with gmail.parse_header_fields) on the test fixtures::
+
+    python -m benchmarks.headers [iterations]
+"""
+import os
+import sys
+import glob
+import email.parser
+
+from sndlatr import gmail
+from benchmarks import timer, report
+
+
+data_dir = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def load_headers():
+    """ Returns list of header blocks of the fixtures with CRLF line breaks.
+    """
+    headers = []
+    for path in sorted(glob.glob(os.path.join(data_dir, '*.txt'))):
+        with open(path) as fd:
+            rfc822 = fd.read().replace('\n', '\r\n')
+        headers.append(gmail.split_rfc822(rfc822)[0] + '\r\n')
+    return headers
+
+
+def header_fields(header):
+    """
+    Returns the header fields a HEADER.FIELDS fetch of
+    THREAD_HEADER_FIELDS would return for given header block.
+    """
+    wanted = set(name.lower() for name in gmail.THREAD_HEADER_FIELDS)
+    message = email.parser.HeaderParser().parsestr(header)
+    lines = ['{}: {}\r\n'.format(name, value)
+             for name, value in message.items() if name.lower() in wanted]
+    return ''.join(lines) + '\r\n'
+
+
+def parse_full(header):
+    mail = email.parser.Parser().parsestr(header)
+    return [mail.get(name) for name in gmail.THREAD_HEADER_FIELDS]
+
+
+def parse_fields(header):
+    fields = gmail.parse_header_fields(header)
+    return [fields.get(name.lower()) for name in gmail.THREAD_HEADER_FIELDS]
+
+
+def main(iterations):
+    full = load_headers()
+    fields = [header_fields(header) for header in full]
+    print 'bytes per thread of {} messages: RFC822.HEADER {}, ' \
+        'HEADER.FIELDS {}'.format(len(full), sum(map(len, full)),
+                                  sum(map(len, fields)))
+    for name, parse, headers in (
+            ('email.parser (RFC822.HEADER)', parse_full, full),
+            ('parse_header_fields (HEADER.FIELDS)', parse_fields, fields)):
+        result = {}
+        with timer(result):
+            for _ in xrange(iterations):
+                for header in headers:
+                    parse(header)
+        report(name, iterations * len(headers), result['elapsed'], 'msgs')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
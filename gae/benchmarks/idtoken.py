@@ -0,0 +1,69 @@
+"""
+Compares authenticating requests by their id token with and without the
+verified token cache of w69b.idtokenauth. Tokens are signed with a fresh RSA
+key (needs PyCrypto, as on app engine), so the uncached case measures the
+signature verification of a single cert::
+
+    python -m benchmarks.idtoken [requests]
+"""
+import sys
+import time
+
+from Crypto.PublicKey import RSA
+from oauth2client import crypt
+
+from w69b import idtokenauth
+from benchmarks import timer, report
+
+AUDIENCE = 'benchmark-audience'
+
+
+def make_token(signer, user_num):
+    now = int(time.time())
+    return crypt.make_signed_jwt(signer, {
+        'iss': 'accounts.google.com',
+        'aud': AUDIENCE,
+        'iat': now,
+        'exp': now + 3600,
+        'sub': str(user_num),
+        'email': 'user{}@example.com'.format(user_num)})
+
+
+def setup_certs():
+    """
+    Returns signer of a new key and sets up idtokenauth to verify tokens
+    with it without fetching certs.
+    """
+    key = RSA.generate(2048)
+    certs = idtokenauth.CertManager()
+    # tokens of make_signed_jwt have no kid, so all verifiers are tried
+    certs._verifiers = {'benchmark': crypt.PyCryptoVerifier(key.publickey())}
+    certs._expires_at = float('inf')
+    idtokenauth.cert_manager = certs
+    return crypt.PyCryptoSigner(key)
+
+
+def authenticate(tokens, requests, cached):
+    for i in xrange(requests):
+        if not cached:
+            idtokenauth.verified_token_cache.clear()
+        user = idtokenauth._user_from_token(tokens[i % len(tokens)],
+                                            AUDIENCE)
+        assert user is not None
+
+
+def main(requests):
+    signer = setup_certs()
+    # a few users polling with their current token
+    tokens = [make_token(signer, num) for num in xrange(10)]
+    for name, cached in (('verify every request', False),
+                         ('verified token cache', True)):
+        idtokenauth.verified_token_cache.clear()
+        result = {}
+        with timer(result):
+            authenticate(tokens, requests, cached)
+        report(name, requests, result['elapsed'], 'requests')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,98 @@
+"""
+Compares rewriting drafts for sending with the full MIME parser
+(MailSendRewriter) and the header-only mode that keeps the body as memoryview
+of the fetched string, either joined to one string or encoded for SMTP DATA
+chunk by chunk. Every case runs in its own process to measure its peak
+memory::
+
+    python -m benchmarks.rewrite [sizes in MB]
+"""
+import os
+import sys
+import time
+import base64
+import resource
+import tempfile
+import multiprocessing
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+
+from sndlatr import gmail
+
+
+def build_draft(size):
+    """ Returns rfc822 encoded draft with an attachment of about size bytes.
+    """
+    msg = MIMEMultipart()
+    msg['From'] = 'sender@example.com'
+    msg['To'] = 'to@example.com'
+    msg['Bcc'] = 'bcc@example.com'
+    msg['Subject'] = 'benchmark'
+    msg['Message-Id'] = gmail.make_message_id()
+    msg.attach(MIMEText('hello'))
+    # base64 encoding grows the payload by 4/3
+    msg.attach(MIMEApplication(base64.b64decode('A' * (size / 3 * 4))))
+    return msg.as_string().replace('\n', '\r\n')
+
+
+def peak_rss():
+    """ Peak resident set size of this process in KB. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_draft(size, path):
+    with open(path, 'wb') as fd:
+        fd.write(build_draft(size))
+
+
+def run_case(mode, path, results):
+    with open(path, 'rb') as fd:
+        draft = fd.read()
+    rss_before = peak_rss()
+    cpu_start = time.clock()
+    rewriter = gmail.MailSendRewriter(draft, headers_only=mode != 'full')
+    del rewriter.message['Message-Id']
+    rewriter.message['Message-Id'] = gmail.make_message_id()
+    rewriter.rewrite()
+    if mode == 'streamed':
+        length = 0
+        for data in gmail.smtp_data_chunks(rewriter.message_chunks()):
+            length += len(data)
+    else:
+        length = len(rewriter.message_as_str())
+    results.put((time.clock() - cpu_start, peak_rss() - rss_before, length))
+
+
+def in_process(target, *args):
+    """ Runs target in a new process so it has its own peak rss. """
+    proc = multiprocessing.Process(target=target, args=args)
+    proc.start()
+    proc.join()
+
+
+def bench(mode, path):
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run_case,
+                                   args=(mode, path, results))
+    proc.start()
+    cpu, rss, length = results.get()
+    proc.join()
+    print '{:<14} {:>6.1f} MB message: {:8.3f}s cpu {:>8.1f} MB extra peak' \
+        .format(mode, length / 1e6, cpu, rss / 1024.)
+
+
+def main(sizes):
+    path = tempfile.mktemp(suffix='.eml')
+    try:
+        for size in sizes:
+            in_process(write_draft, size, path)
+            for mode in ('full', 'headers only', 'streamed'):
+                bench(mode, path)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main([int(float(arg) * 1e6) for arg in sys.argv[1:]] or
+         [int(1e5), int(1e6), int(5e6), int(20e6)])
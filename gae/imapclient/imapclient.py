@@ -163,7 +163,17 @@ class IMAPClient(object):
         """
         auth_string = lambda x: 'user=%s\1auth=Bearer %s\1\1' % (
         user, access_token)
-        return self._command_and_check('authenticate', 'XOAUTH2', auth_string)
+        data = self._command_and_check('authenticate', 'XOAUTH2', auth_string)
+        self._update_login_capabilities()
+        return data
+
+    def _update_login_capabilities(self):
+        # servers like Gmail send their post-login capabilities with the
+        # tagged OK response, which saves a CAPABILITY command.
+        typ, data = self._imap.response('CAPABILITY')
+        data = [item for item in data if item]
+        if data:
+            self._imap.capabilities = tuple(data[-1].upper().split())
 
     def logout(self):
         """Logout, returning the server response.
@@ -197,6 +207,14 @@ class IMAPClient(object):
         # be detected by this method.
         return capability.upper() in self.capabilities
 
+    def enable(self, *capabilities):
+        """Activate server side capability extensions (RFC 5161).
+
+        Returns the list of capabilities that were enabled by the server.
+        """
+        data = self._command_and_check('enable', *capabilities)
+        return [cap.upper() for item in data if item for cap in item.split()]
+
     def enable_compression(self):
         self._imap.enable_compression()
 
@@ -355,10 +373,23 @@ class IMAPClient(object):
         Future calls to methods such as search and fetch will act on
         the selected folder.
 
+        Returns a dictionary with the numeric items of the ``SELECT``
+        response that were sent by the server (``EXISTS``, ``RECENT``,
+        ``UIDNEXT``, ``UIDVALIDITY`` and ``HIGHESTMODSEQ``).
         """
         # manu: disabled flags processing, we don't need them anyway
         self._command_and_check('select', self._normalise_folder(folder),
                                 readonly)
+        out = {}
+        for key in ('EXISTS', 'RECENT', 'UIDNEXT', 'UIDVALIDITY',
+                    'HIGHESTMODSEQ'):
+            # response() pops the values, so they don't pile up in the
+            # untagged responses of long lived connections.
+            typ, data = self._imap.response(key)
+            data = [value for value in data if value]
+            if data:
+                out[key] = int(data[-1])
+        return out
 
     def _process_select_response(self, resp):
         out = {}
@@ -85,6 +85,7 @@ Commands = {
         'CREATE':       ((AUTH, SELECTED),            True),
         'DELETE':       ((AUTH, SELECTED),            True),
         'DELETEACL':    ((AUTH, SELECTED),            True),
+        'ENABLE':       ((AUTH,),                     False),
         'EXAMINE':      ((AUTH, SELECTED),            False),
         'EXPUNGE':      ((SELECTED,),                 True),
         'FETCH':        ((SELECTED,),                 True),
@@ -717,6 +718,16 @@ class IMAP4(object):
         return self._simple_command('DELETEACL', mailbox, who, **kw)
 
 
+    def enable(self, *capabilities, **kw):
+        """(typ, [data]) = enable(capability, ...)
+        Enable server side extensions (RFC 5161).
+        'data' is list of the capabilities that were enabled."""
+
+        name = 'ENABLE'
+        kw['untagged_response'] = 'ENABLED'
+        return self._simple_command(name, *capabilities, **kw)
+
+
     def examine(self, mailbox='INBOX', **kw):
         """(typ, [data]) = examine(mailbox='INBOX')
         Select a mailbox for READ-ONLY access. (Flushes all untagged responses.)
@@ -18,6 +18,8 @@ config = {'idtoken_audience': get_client_id()}
 
 app = webapp2.WSGIApplication(
     [Route('/api/init', api.InitializeHanlder),
+     Route('/api/changes', api.ChangesHandler),
+     Route('/api/channel', api.ChannelHandler),
      Route('/api/schedule/<id>', api.ScheduleSendHandler),
      Route('/api/schedule', api.ScheduleSendHandler),
      Route('/api/snippet/<id>', api.SnippetHandler),
@@ -25,9 +27,18 @@ app = webapp2.WSGIApplication(
      Route('/api/remind/<id>', api.ScheduleRemindHandler),
      Route('/api/remind', api.ScheduleRemindHandler),
      Route('/api/remind/<id>/check_reply', api.ScheduleCheckReplyHandler),
+     Route('/api/batch', api.BatchMutationHandler),
      ('/api/tasks/enqueue_scheduled', api.QueueJobHandler),
+     ('/api/tasks/dispatch', api.DispatchHandler),
+     ('/api/tasks/batch', api.BatchHandler),
      ('/api/tasks/send', api.SendHandler),
      ('/api/tasks/remind', api.RemindHandler),
      ('/api/tasks/check_reply', api.CheckReplyHandler),
+     ('/api/tasks/prewarm', api.PrewarmHandler),
+     ('/api/tasks/migrate_layout', api.MigrateLayoutHandler),
+     ('/api/tasks/invalidate_dashboard', api.InvalidateDashboardHandler),
+     ('/api/tasks/publish', api.PublishHandler),
+     ('/api/tasks/backfill_dispatch_index',
+      api.BackfillDispatchIndexHandler),
      # ('/api/signout', LogoutHandler),
     ], debug=False, config=config)
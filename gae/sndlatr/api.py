@@ -3,81 +3,26 @@ import logging
 import json
 
 import webapp2
-from iso8601 import UTC
 from oauth2client.client import FlowExchangeError
 from google.appengine.api import users, taskqueue
 from google.appengine.ext import ndb
-import httplib2
 from oauth2client.client import AccessTokenRefreshError
 
 from w69b.handlers import JSONMixin
 from w69b.httperr import *
-from sndlatr import models, gmail, auth, mailnotify, validation
+from sndlatr import models, gmail, auth, mailnotify, validation, push
 
 
 JOB_MAX_RETRIES = 15
-
-
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, models.SendJob):
-            return self._encode_send_job(o)
-        if isinstance(o, models.RemindJob):
-            return self._encode_remind_job(o)
-        if isinstance(o, models.DisabledReply):
-            return self._encode_disabled_reply(o)
-        if isinstance(o, models.Snippet):
-            return self._encode_snippet(o)
-        if isinstance(o, datetime.datetime):
-            return o.replace(tzinfo=UTC).isoformat()
-        if isinstance(o, datetime.date):
-            return o.isoformat()
-        return json.JSONEncoder.default(self, o)
-
-    def _encode_snippet(self, snippet):
-        return {
-            'id': snippet.key.id(),
-            'usageCnt': snippet.usage_cnt,
-            'updatedAt': snippet.updated_at,
-            'subject': snippet.subject,
-            'body': snippet.body,
-            'name': snippet.name,
-        }
-
-    def _encode_base_job(self, job):
-        return {'id': job.key.id(),
-                'state': job.state,
-                'scheduledAt': job.scheduled_at,
-                'createdAt': job.created_at,
-                'utcOffset': job.utc_offset}
-
-    def _encode_send_job(self, job):
-        json = self._encode_base_job(job)
-        json.update({
-            'subject': job.subject,
-            'messageId': job.message_id
-        })
-        return json
-
-    def _encode_remind_job(self, job):
-        json = self._encode_base_job(job)
-        json.update({
-            'subject': job.subject,
-            'threadId': job.thread_id,
-            'knownMessageIds': job.known_message_ids,
-            'onlyIfNoreply': job.only_if_noreply,
-            'disabledReply': job.disabled_reply
-        })
-        return json
-
-    def _encode_disabled_reply(self, reply):
-        return {
-            'rfcMessageId': reply.rfc_message_id,
-            'messageId': reply.message_id,
-            'fromName': reply.from_name,
-            'fromEmail': reply.from_email,
-            'date': reply.date,
-        }
+# maximal number of jobs of a user checked for replies by one task.
+CHECK_REPLY_BATCH_SIZE = 500
+# ids of a get of multiple jobs or snippets are read in pages of this size,
+# the datastore gets at most 1000 keys with one rpc.
+MAX_GET_IDS = 1000
+# maximal number of operations of a batch mutation written in one
+# transaction. An operation writes at most two entity groups, its model and
+# the old key of a model that is re-keyed (see models.Dashboard.save_multi).
+BATCH_WRITE_CHUNK_SIZE = models.XG_MAX_ENTITY_GROUPS // 2
 
 
 class ValidationErrorMixin(object):
@@ -94,7 +39,9 @@ class ValidationErrorMixin(object):
 class AllowOriginMixin(object):
     """ Allows gmail for xs origin request. """
     _allowed_headers = ['x-w69b-idtoken', 'Origin', 'Content-Type',
-                        'Cache-Control', 'Pragma', 'Referer', 'User-Agent']
+                        'Cache-Control', 'Pragma', 'Referer', 'User-Agent',
+                        'If-None-Match']
+    _exposed_headers = ['ETag']
 
     def add_headers(self):
         headers = self.response.headers
@@ -105,6 +52,8 @@ class AllowOriginMixin(object):
         headers['Access-Control-Allow-Methods'] = \
             'GET, POST, PUT, DELETE, OPTIONS'
         headers['Access-Control-Max-Age'] = '86400'
+        headers['Access-Control-Expose-Headers'] = ', '.join(
+            self._exposed_headers)
 
     def options(self, *args, **kwargs):
         self.add_headers()
@@ -118,7 +67,24 @@ class AllowOriginMixin(object):
 class BaseHandler(AllowOriginMixin, HTTPErrorMixin, JSONMixin,
                   ValidationErrorMixin, webapp2.RequestHandler):
     """ Base class for all api request handlers """
-    json_encoder = JSONEncoder
+    json_encoder = models.JSONEncoder
+
+    def check_not_modified(self):
+        """
+        Conditional GET for responses that only depend on data of the
+        current user. Sets a strong ETag from the dashboard version of the
+        user (see models.Dashboard.get_version) and raises HTTPNotModified
+        if the client already has it. Must be called before any data is
+        loaded.
+        """
+        user_id = auth.get_current_user().user_id()
+        version = models.Dashboard.get_version(user_id)
+        etag = '{}-{}'.format(user_id, version)
+        self.response.etag = etag
+        # browsers revalidate on every request
+        self.response.cache_control = 'private, no-cache'
+        if etag in self.request.if_none_match:
+            raise HTTPNotModified()
 
 
 class BaseCRUDHandler(BaseHandler):
@@ -127,12 +93,61 @@ class BaseCRUDHandler(BaseHandler):
     model_cls = None
     validator = None
 
+    def build_model(self, data):
+        """ Returns new unsaved model of the current user with data. """
+        user = auth.get_current_user()
+        model = self.model_cls(user_id=user.user_id())
+        self._set_model_data(model, data)
+        return model
+
+    def prepare_update(self, model, data):
+        """
+        Sets data on model before it is saved. Returns a value passed to
+        after_update.
+        """
+        self._set_model_data(model, data)
+
+    def check_delete(self, model):
+        """
+        Returns True if model should be deleted, False if the delete is
+        ignored. Raises HTTPNotFound if model cannot be deleted.
+        """
+        return True
+
+    def after_create(self, model):
+        """ Called after a new model was saved. """
+
+    def after_update(self, model, prepared):
+        """
+        Called after model was updated with the result of prepare_update.
+        """
+
+    def after_delete(self, model):
+        """ Called after model was deleted. """
+
+    def after_create_multi(self, created):
+        """ Called after the new models in created were saved. """
+        for model in created:
+            self.after_create(model)
+
+    def after_update_multi(self, updated):
+        """
+        Called after models of (model, prepared) tuples in updated were
+        saved, see after_update.
+        """
+        for model, prepared in updated:
+            self.after_update(model, prepared)
+
+    def after_delete_multi(self, deleted):
+        """ Called after the models in deleted were deleted. """
+        for model in deleted:
+            self.after_delete(model)
+
     def create_model(self, data):
         """ create a new model from given data """
-        user = auth.get_current_user()
-        job = self.model_cls(user_id=user.user_id())
-        self._set_model_data(job, data)
-        job.put()
+        job = self.build_model(data)
+        job.save()
+        self.after_create(job)
         logging.debug('created Model {}'.format(job.key))
         self.response_json(job)
 
@@ -142,7 +157,8 @@ class BaseCRUDHandler(BaseHandler):
         except ValueError:
             raise HTTPBadRequest('invalid job id')
         user = auth.get_current_user()
-        model = self.model_cls.get_by_id(id)
+        model = self.model_cls.get_by_ids_async(user.user_id(),
+                                                [id]).get_result()[0]
         if model is None:
             raise HTTPNotFound()
         if model.user_id != user.user_id():
@@ -152,25 +168,31 @@ class BaseCRUDHandler(BaseHandler):
     def update_model(self, id, data):
         """ updates existing job with id with given data """
         job = self.get_model(id)
-        self._set_model_data(job, data)
-        job.put()
+        prepared = self.prepare_update(job, data)
+        job.save()
+        self.after_update(job, prepared)
         logging.debug('updated Job {}'.format(job.key))
         self.response_json(job)
 
     @auth.login_required
     def get(self, id=None):
+        self.check_not_modified()
         if id is not None:
             return self.response_json(self.get_model(id))
         else:
             user = auth.get_current_user()
-            # ignore ids > 100
             try:
-                ids = [int(id) for id in self.request.GET.getall('id')[0:100]]
+                ids = [int(id) for id in self.request.GET.getall('id')]
             except ValueError:
                 raise HTTPBadRequest()
-            job_futures = [self.model_cls.get_by_id_async(id) for id in ids]
-            jobs = [future.get_result() for future in job_futures]
-            jobs = filter(None, jobs)
+            if any(id <= 0 for id in ids):
+                raise HTTPBadRequest()
+            # batch gets of pages of ids, run in parallel
+            futures = [self.model_cls.get_by_ids_async(
+                user.user_id(), ids[i:i + MAX_GET_IDS])
+                for i in xrange(0, len(ids), MAX_GET_IDS)]
+            jobs = [job for future in futures
+                    for job in future.get_result() if job is not None]
             if any(job.user_id != user.user_id() for job in jobs):
                 raise HTTPForbidden()
             return self.response_json(jobs)
@@ -186,7 +208,9 @@ class BaseCRUDHandler(BaseHandler):
     @auth.login_required
     def delete(self, id):
         job = self.get_model(id)
-        job.key.delete()
+        if self.check_delete(job):
+            job.remove()
+            self.after_delete(job)
         self.response_json(None)
 
     def _set_model_data(self, job, data):
@@ -210,28 +234,57 @@ class JobBaseHandler(BaseCRUDHandler):
     # delete in this state will succeed but do nothing
     ignore_delete_states = []
 
-    def create_model(self, data):
+    def build_model(self, data):
         """ create a new job from given data """
         user = auth.get_current_user()
         job = self.model_cls(user_email=user.email(),
                              user_id=user.user_id())
         self._set_model_data(job, data)
-        job.put()
-        logging.debug(u'created Job {} for {}'.format(job.key, job.user_email))
-        self.response_json(job)
+        return job
 
-    @auth.login_required
-    def delete(self, id):
-        job = self.get_model(id)
+    def prepare_update(self, job, data):
+        """ Returns schedule date of job before the update. """
+        old_scheduled_at = job.scheduled_at
+        self._set_model_data(job, data)
+        return old_scheduled_at
+
+    def check_delete(self, job):
         if job.state in self.allowed_delete_states:
-            job.key.delete()
-            self.response_json(None)
+            return True
         elif job.state in self.ignore_delete_states:
             # ignore command
-            self.response_json(None)
+            return False
         else:
             raise HTTPNotFound()
 
+    def after_create(self, job):
+        self.after_create_multi([job])
+
+    def after_update(self, job, old_scheduled_at):
+        self.after_update_multi([(job, old_scheduled_at)])
+
+    def after_delete(self, job):
+        self.after_delete_multi([job])
+
+    def after_create_multi(self, jobs):
+        self.model_cls.add_eta_tasks(jobs)
+
+    def after_update_multi(self, updated):
+        """
+        Moves rescheduled jobs of (job, old_scheduled_at) tuples to their
+        new dispatch buckets.
+        """
+        moved = [(job, old_scheduled_at)
+                 for job, old_scheduled_at in updated
+                 if job.scheduled_at != old_scheduled_at]
+        if moved:
+            self.model_cls.remove_multi_from_dispatch_index(moved)
+            self.model_cls.add_eta_tasks([job for job, _ in moved])
+
+    def after_delete_multi(self, jobs):
+        self.model_cls.remove_multi_from_dispatch_index(
+            [(job, job.scheduled_at) for job in jobs])
+
 
 class ScheduleSendHandler(JobBaseHandler):
     """ Allows to add send jobs or modify existing jobs. """
@@ -250,9 +303,14 @@ class ScheduleRemindHandler(JobBaseHandler):
     model_cls = models.RemindJob
     validator = validation.remind_job_schema
     allowed_delete_states = ['scheduled', 'disabled']
-    ignore_delete_states = ['queued', 'done']
+    ignore_delete_states = ['queued', 'sending', 'done']
 
     def _set_model_data(self, job, data):
+        if (job.thread_id != data['threadId'] or
+                set(job.known_message_ids) != set(data['knownMessageIds'])):
+            # messages checked so far have to be checked again
+            job.last_seen_uid = None
+            job.highest_modseq = None
         job.thread_id = data['threadId']
         job.scheduled_at = data['scheduledAt']
         job.utc_offset = data['utcOffset']
@@ -264,8 +322,9 @@ class ScheduleRemindHandler(JobBaseHandler):
 class ScheduleCheckReplyHandler(BaseHandler):
     @auth.login_required
     def post(self, id):
-        job = models.RemindJob.get_by_id(int(id))
         user = auth.get_current_user()
+        job = models.RemindJob.get_by_ids_async(user.user_id(),
+                                                [int(id)]).get_result()[0]
         if job is None:
             raise HTTPNotFound()
         if job.user_id != user.user_id():
@@ -282,18 +341,135 @@ class ScheduleCheckReplyHandler(BaseHandler):
         self.response_json(None)
 
 
+class BatchMutationHandler(BaseHandler):
+    """
+    Creates, updates and deletes multiple jobs and snippets of the current
+    user with a single request. All operations are validated and checked
+    for ownership before any of them is written. Operations are written in
+    chunks of BATCH_WRITE_CHUNK_SIZE, each in a single transaction, and the
+    hooks run for the chunks that committed. Returns a result for each
+    operation: the saved model (status 200), nothing (status 204) or an
+    error status if a model does not exist, cannot be deleted or its chunk
+    was not written (status 500).
+    """
+    handler_classes = {'sendJob': ScheduleSendHandler,
+                       'remindJob': ScheduleRemindHandler,
+                       'snippet': SnippetHandler}
+
+    @auth.login_required
+    def post(self):
+        operations = validation.batch_schema(self.json)['operations']
+        user_id = auth.get_current_user().user_id()
+        # CRUD handlers of the types, for their hooks only
+        handlers = {type_name: handler_cls(self.request, self.response)
+                    for type_name, handler_cls
+                    in self.handler_classes.iteritems()}
+        futures = []
+        for type_name, handler in handlers.iteritems():
+            ids = [operation['id'] for operation in operations
+                   if operation['type'] == type_name and 'id' in operation]
+            futures.append((type_name, ids,
+                            handler.model_cls.get_by_ids_async(user_id, ids)))
+        # (type, id) to model
+        existing = {}
+        for type_name, ids, future in futures:
+            existing.update(((type_name, id), model)
+                            for id, model in zip(ids, future.get_result()))
+        if any(model is not None and model.user_id != user_id
+               for model in existing.itervalues()):
+            raise HTTPForbidden()
+
+        results = []
+        # (result, write) tuples of operations that write a model, see
+        # _prepare_operation.
+        writes = []
+        for operation in operations:
+            try:
+                result, write = self._prepare_operation(
+                    handlers[operation['type']], operation, existing)
+            except HTTPError, err:
+                result, write = {'status': err.status_code,
+                                 'error': str(err)}, None
+            results.append(result)
+            if write is not None:
+                writes.append((result, write))
+
+        # (handler, action) to hook arguments of written operations
+        applied = {}
+        for i in xrange(0, len(writes), BATCH_WRITE_CHUNK_SIZE):
+            chunk = writes[i:i + BATCH_WRITE_CHUNK_SIZE]
+            try:
+                models.Dashboard.save_multi(
+                    [model for _, (_, action, _, model) in chunk
+                     if action != 'delete'],
+                    [model for _, (_, action, _, model) in chunk
+                     if action == 'delete'])
+            except Exception:
+                logging.error('writing {} operations of batch failed'.format(
+                    len(chunk)), exc_info=True)
+                for result, _ in chunk:
+                    result.clear()
+                    result.update({'status': 500,
+                                   'error': 'operation was not written'})
+                continue
+            for _, (handler, action, hook_arg, _) in chunk:
+                applied.setdefault((handler, action), []).append(hook_arg)
+        self._run_hooks(applied)
+        logging.debug('batch of {} operations, {} writes'.format(
+            len(operations), len(writes)))
+        self.response_json({'results': results})
+
+    def _prepare_operation(self, handler, operation, existing):
+        """
+        Prepares operation with the hooks of its CRUD handler. Returns
+        result of operation and its write, a (handler, action, hook
+        argument, model) tuple, or None if it does not write
+        anything. The hook argument is passed to the hook that is called
+        once the model was written (see _run_hooks).
+        """
+        action = operation['action']
+        if action == 'create':
+            model = handler.build_model(operation['data'])
+            return ({'status': 200, 'data': model},
+                    (handler, action, model, model))
+        model = existing[(operation['type'], operation['id'])]
+        if model is None:
+            raise HTTPNotFound('{} does not exist'.format(operation['id']))
+        if action == 'update':
+            prepared = handler.prepare_update(model, operation['data'])
+            return ({'status': 200, 'data': model},
+                    (handler, action, (model, prepared), model))
+        if handler.check_delete(model):
+            return {'status': 204}, (handler, action, model, model)
+        return {'status': 204}, None
+
+    def _run_hooks(self, applied):
+        """
+        Calls the after_*_multi hooks of the CRUD handlers once per handler
+        and action with the written operations of applied. The models are
+        written already, so a failing hook is logged and the others still
+        run. Jobs whose eta task was not added are dispatched by the enqueue
+        cron, stale dispatch index entries are skipped.
+        """
+        hook_names = {'create': 'after_create_multi',
+                      'update': 'after_update_multi',
+                      'delete': 'after_delete_multi'}
+        for (handler, action), args in applied.iteritems():
+            try:
+                getattr(handler, hook_names[action])(args)
+            except Exception:
+                logging.error('{} hook of {} failed'.format(
+                    action, handler.model_cls.__name__), exc_info=True)
+
+
 class InitializeHanlder(BaseHandler):
     @auth.login_required
     def get(self):
+        self.check_not_modified()
         user = auth.get_current_user()
         account_future = models.Account.get_by_id_async(user.user_id())
-
-        send_jobs_future = models.SendJob.query_display(
-            user.user_id()).fetch_async()
-        remind_jobs_future = models.RemindJob.query_display(
-            user.user_id()).fetch_async()
-        snippets_future = models.Snippet.query_display(
-            user.user_id()).fetch_async()
+        displayed_future = models.Dashboard.get_displayed_async(
+            user.user_id())
 
         account = account_future.get_result()
 
@@ -301,10 +477,13 @@ class InitializeHanlder(BaseHandler):
             self.response_json({'auth': 'need_code'})
             return
 
-        self.response_json(
-            {'sendJobs': send_jobs_future.get_result(),
-             'remindJobs': remind_jobs_future.get_result(),
-             'snippets': snippets_future.get_result()})
+        displayed, version = displayed_future.get_result()
+        result = models.group_jobs(displayed)
+        result.update({
+            'snippets': [entity for entity in displayed
+                         if isinstance(entity, models.Snippet)],
+            'changesToken': str(version)})
+        self.response_json(result)
 
     def post(self):
         """
@@ -329,9 +508,43 @@ class InitializeHanlder(BaseHandler):
             user_id = id_token['sub']
         except KeyError:
             raise HTTPForbidden('no valid id')
+        old_account = models.Account.get_by_id(user_id)
+        if old_account is None:
+            layout = models.NEW_ACCOUNT_LAYOUT
+        else:
+            layout = old_account.layout
         account = models.Account(email=email, id=user_id,
-                                 credentials=credentials)
+                                 credentials=credentials, layout=layout)
         account.put()
+        models.Dashboard.bump_version(user_id)
+
+
+class ChangesHandler(BaseHandler):
+    """
+    Returns jobs that changed since the token of a previous call (or of
+    /api/init) and the token for the next call.
+    """
+
+    @auth.login_required
+    def get(self):
+        user = auth.get_current_user()
+        since = validation.parse_changes_token(self.request.GET.get('since'))
+        jobs, version = models.Dashboard.get_changes(user.user_id(), since)
+        result = models.group_jobs(jobs)
+        result['token'] = str(version)
+        self.response_json(result)
+
+
+class ChannelHandler(BaseHandler):
+    """
+    Opens a new push channel (see push.create_channel). Called by clients
+    after /api/init, which is cached, and when their channel expired.
+    """
+
+    @auth.login_required
+    def post(self):
+        user = auth.get_current_user()
+        self.response_json({'token': push.create_channel(user.user_id())})
 
 
 class JobTaskBaseHandler(BaseHandler):
@@ -345,7 +558,7 @@ class JobTaskBaseHandler(BaseHandler):
         """
         if job.error_cnt <= max_retries:
             # this raises so put here
-            job.put()
+            job.save()
             return self.retry_task()
 
     def retry_task(self):
@@ -366,19 +579,20 @@ class JobTaskBaseHandler(BaseHandler):
             raise HTTPSuccess()
         return job
 
-    def get_credentials(self, job):
-        credentials = models.get_credentials(job.user_id)
-        if not credentials:
-            logging.error(
-                'no credentials stored for user {}'.format(job.user_id))
-            raise HTTPSuccess()
-        logging.debug('refreshing oauth token')
+    def get_access_token(self, job):
+        """
+        Returns access token of the user of job (see models.get_access_token).
+        """
         try:
-            credentials.refresh(httplib2.Http())
+            access_token = models.get_access_token(job.user_id)
         except AccessTokenRefreshError, e:
             logging.warning('refreshing token failed: ' + str(e))
             raise gmail.AuthenticationError()
-        return credentials
+        if not access_token:
+            logging.error(
+                'no credentials stored for user {}'.format(job.user_id))
+            raise HTTPSuccess()
+        return access_token
 
 
 class SendHandler(JobTaskBaseHandler):
@@ -390,6 +604,7 @@ class SendHandler(JobTaskBaseHandler):
         logging.debug('handling error ' + str(err))
         job.error_cnt += 1
         if isinstance(err, gmail.AuthenticationError):
+            models.invalidate_access_token(job.user_id)
             # auth errors can be temporary (eg too many connections).
             self.raise_retry_if_possible(job)
             mailnotify.notify_send_later_failed(job, 'auth')
@@ -407,7 +622,7 @@ class SendHandler(JobTaskBaseHandler):
             self.raise_retry_if_possible(job)
             mailnotify.notify_send_later_failed(job, 'unknown')
         job.state = 'failed'
-        job.put()
+        job.save()
 
     @auth.task_only
     def post(self):
@@ -418,8 +633,7 @@ class SendHandler(JobTaskBaseHandler):
         job = self.get_model()
         logging.info('send: processing job {}'.format(job.key))
         try:
-            credentials = self.get_credentials(job)
-            job.send_mail(credentials.access_token)
+            job.send_mail(self.get_access_token(job))
         except Exception, err:
             self.handle_error(job, err)
 
@@ -429,6 +643,7 @@ class RemindHandler(JobTaskBaseHandler):
         logging.debug('handling error ' + str(err))
         job.error_cnt += 1
         if isinstance(err, gmail.AuthenticationError):
+            models.invalidate_access_token(job.user_id)
             # auth errors can be temporary (eg too many connections).
             self.raise_retry_if_possible(job)
             mailnotify.notify_reminder_failed(job, 'auth')
@@ -446,7 +661,7 @@ class RemindHandler(JobTaskBaseHandler):
             self.raise_retry_if_possible(job)
             mailnotify.notify_reminder_failed(job, 'unknown')
         job.state = 'failed'
-        job.put()
+        job.save()
 
     @auth.task_only
     def post(self):
@@ -457,8 +672,7 @@ class RemindHandler(JobTaskBaseHandler):
         job = self.get_model()
         logging.info('reply: processing job {}'.format(job.key))
         try:
-            credentials = self.get_credentials(job)
-            job.remind(credentials.access_token)
+            job.remind(self.get_access_token(job))
         except Exception, err:
             self.handle_error(job, err)
 
@@ -472,12 +686,14 @@ class CheckReplyHandler(JobTaskBaseHandler):
         """
         if job.error_cnt <= max_retries:
             # this raises so put here
-            job.put()
+            job.save()
             return self.retry_task()
 
     def handle_error(self, job, err):
         logging.info('handling error ' + str(err))
         job.error_cnt += 1
+        if isinstance(err, gmail.AuthenticationError):
+            models.invalidate_access_token(job.user_id)
 
         self.raise_retry_if_possible(job, 2)
         logging.warn('check_reply failed completely, no more retries',
@@ -485,31 +701,235 @@ class CheckReplyHandler(JobTaskBaseHandler):
         # reset error count
         job.state = 'scheduled'
         job.error_cnt = 0
-        job.put()
+        job.save()
 
     @auth.task_only
     def post(self):
         """
-        Called by taskqueue, process a check_reply job.
+        Called by taskqueue, process a check_reply job. All other jobs of the
+        user that wait for a reply check are checked with it.
         """
         logging.debug('running check_reply handler')
         job = self.get_model()
-        logging.info('check_reply: processing job {}'.format(job.key))
+        if job.state != 'checking':
+            logging.info('job {} was already checked'.format(job.key))
+            return
+        jobs = models.fetch_user_entities_async(
+            job.user_id, models.RemindJob.query_checking,
+            limit=CHECK_REPLY_BATCH_SIZE).get_result()
+        # the query is eventually consistent
+        jobs = [job] + [other for other in jobs if other.key != job.key]
+        logging.info('check_reply: processing job {} and {} more'.format(
+            job.key, len(jobs) - 1))
         try:
-            credentials = self.get_credentials(job)
-            job.disable_if_replied(credentials.access_token)
+            models.RemindJob.disable_replied(jobs,
+                                             self.get_access_token(job))
         except Exception, err:
+            # the other jobs are retried by their own tasks
             self.handle_error(job, err)
 
 
+class BatchHandler(JobTaskBaseHandler):
+    """
+    Processes queued jobs of a single user with one token refresh and one
+    mail session (used by taskqueue).
+    """
+    job_handlers = {models.SendJob._get_kind(): SendHandler,
+                    models.RemindJob._get_kind(): RemindHandler}
+
+    def get_models(self):
+        """
+        Returns jobs of batch that still have to be processed ordered by
+        schedule date.
+        """
+        if not isinstance(self.json, dict):
+            raise HTTPSuccess()
+        keys = self.json.get('keys', None)
+        if not keys:
+            logging.warn('batch handler called without keys')
+            raise HTTPSuccess()
+        jobs = ndb.get_multi([ndb.Key(urlsafe=key) for key in keys])
+        jobs = [job for job in jobs
+                if job is not None and job.state in ('queued', 'sent')]
+        return sorted(jobs, key=lambda job: job.scheduled_at)
+
+    def handle_error(self, job, err):
+        """
+        Handles error of a single job like its own task handler does, but
+        retries the job on its own instead of retrying the whole batch.
+        """
+        handler = self.job_handlers[job.key.kind()](self.request,
+                                                    self.response)
+        try:
+            handler.handle_error(job, err)
+        except HTTPError:
+            job.add_retry_task()
+
+    @auth.task_only
+    def post(self):
+        """
+        Called by taskqueue, process batch of jobs.
+        """
+        jobs = self.get_models()
+        if not jobs:
+            return
+        logging.info('batch: processing {} jobs'.format(len(jobs)))
+        try:
+            access_token = self.get_access_token(jobs[0])
+        except gmail.AuthenticationError, err:
+            for job in jobs:
+                self.handle_error(job, err)
+            return
+        user_email = jobs[0].user_email
+        mailman = gmail.Mailman(user_email, access_token)
+        try:
+            for job in jobs:
+                try:
+                    job.process(access_token, mailman=mailman)
+                except Exception, err:
+                    self.handle_error(job, err)
+                    # session might be broken, use a new one for other jobs
+                    mailman.quit()
+                    mailman = gmail.Mailman(user_email, access_token)
+        finally:
+            mailman.quit()
+
+
+class DispatchHandler(JobTaskBaseHandler):
+    """
+    Called by eta tasks at the schedule date of jobs. Adds the jobs that
+    are due to the queue (see models._ScheduledJob.add_eta_task).
+    """
+
+    @auth.task_only
+    def post(self):
+        data = validation.dispatch_schema(self.json)
+        job_cls = QueueJobHandler.job_classes.get(data['kind'])
+        if job_cls is None:
+            logging.warn('unknown job kind {}'.format(data['kind']))
+            return
+        cnt = job_cls.dispatch_due(data['due_at'])
+        logging.info('dispatch: added {} {} jobs due at {}'.format(
+            cnt, data['kind'], data['due_at']))
+
+
 class QueueJobHandler(BaseHandler):
     """
     Called in cron job. Looks for due jobs and adds them to taskqueue.
     """
 
+    job_classes = {cls._get_kind(): cls
+                   for cls in (models.SendJob, models.RemindJob)}
+
     @auth.cron_only
     def get(self):
-        models.SendJob.add_all_due_to_queue()
-        models.RemindJob.add_all_due_to_queue()
+        # jobs are dispatched by their eta tasks, only pick up those whose
+        # task got lost.
+        now = datetime.datetime.utcnow() - models.ETA_TASK_GRACE
+        models.SendJob.add_all_due_to_queue(now=now)
+        models.RemindJob.add_all_due_to_queue(now=now)
+        models.add_prewarm_tasks()
+
+    @auth.task_only
+    def post(self):
+        """
+        Called by taskqueue, continues a add_all_due_to_queue run that ran
+        out of time.
+        """
+        data = validation.dispatch_continuation_schema(self.json)
+        job_cls = self.job_classes.get(data['kind'])
+        if job_cls is None:
+            logging.warn('unknown job kind {}'.format(data['kind']))
+            return
+        job_cls.add_all_due_to_queue(cursor=data['cursor'], now=data['now'])
+
 
+class BackfillDispatchIndexHandler(BaseHandler):
+    """
+    Adds jobs that were scheduled before the dispatch index existed to it
+    (see models._ScheduledJob.backfill_dispatch_index). Started by an admin.
+    """
 
+    job_classes = QueueJobHandler.job_classes
+
+    @auth.admin_required
+    def get(self):
+        for kind in self.job_classes:
+            taskqueue.add(url=models.BACKFILL_URL,
+                          payload=json.dumps({'kind': kind}))
+
+    @auth.task_only
+    def post(self):
+        """
+        Called by taskqueue, backfills jobs of a kind starting at cursor.
+        """
+        data = validation.backfill_dispatch_index_schema(self.json)
+        job_cls = self.job_classes.get(data['kind'])
+        if job_cls is None:
+            logging.warn('unknown job kind {}'.format(data['kind']))
+            return
+        job_cls.backfill_dispatch_index(cursor=data.get('cursor'))
+
+
+class MigrateLayoutHandler(BaseHandler):
+    """
+    Moves jobs and snippets of all accounts under their account key (see
+    models.migrate_layout). Started by an admin.
+    """
+
+    @auth.admin_required
+    def get(self):
+        models.add_migrate_layout_tasks()
+
+    @auth.task_only
+    def post(self):
+        """
+        Called by taskqueue, migrates an account or adds tasks for the next
+        page of accounts.
+        """
+        data = validation.migrate_layout_schema(self.json)
+        if 'user_id' in data:
+            models.migrate_layout(**data)
+        else:
+            models.add_migrate_layout_tasks(data.get('cursor'))
+
+
+class PublishHandler(BaseHandler):
+    """
+    Called by taskqueue, sends a message to the open channels of a user,
+    see push.publish_async.
+    """
+
+    @auth.task_only
+    def post(self):
+        data = validation.publish_schema(self.json)
+        push.publish(data['user_id'], data['message'])
+
+
+class InvalidateDashboardHandler(BaseHandler):
+    """
+    Called by taskqueue when the dashboard of a user could not be updated
+    after a write, see models.Dashboard.invalidate.
+    """
+
+    @auth.task_only
+    def post(self):
+        data = validation.invalidate_dashboard_schema(self.json)
+        models.Dashboard.invalidate(data['user_id'])
+
+
+class PrewarmHandler(BaseHandler):
+    """
+    Called by taskqueue shortly before jobs of a user are due, see
+    models.add_prewarm_tasks.
+    """
+
+    @auth.task_only
+    def post(self):
+        data = validation.prewarm_schema(self.json)
+        try:
+            models.prewarm_user(data['user_id'], data['keys'])
+        except Exception:
+            # jobs are processed without prewarming, no need to retry
+            logging.warning('prewarming failed for user {}'.format(
+                data['user_id']), exc_info=True)
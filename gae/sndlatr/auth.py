@@ -5,6 +5,7 @@ from functools import wraps
 
 import oauth2client.appengine
 import oauth2client.client
+from google.appengine.api.users import is_current_user_admin
 
 from w69b.httperr import HTTPForbidden
 from w69b.handlers import TemplateBaseHandler, JSONMixin
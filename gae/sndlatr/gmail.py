@@ -6,14 +6,59 @@ import email.message
 import datetime
 import logging
 import time
+import hashlib
+import hmac
+import os
+import re
+import zlib
 
 from google.appengine.api import mail as gae_mail
+from google.appengine.api import memcache
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
 
 import imapclient
 import imaplib2
 
+from w69b import cache
+from sndlatr import metrics
+
 IMAPError = imaplib2.IMAP4.error
 
+# special-use mailbox flags that are resolved to mailbox names and cached.
+SPECIAL_USE_FLAGS = ('\\All', '\\Trash', '\\Sent', '\\Drafts', '\\Junk',
+                     '\\Flagged', '\\Important')
+# seconds special folders of a user are cached in memcache.
+FOLDER_CACHE_TIME = 6 * 3600
+
+# mails larger than this (in bytes) are fetched and sent in chunks.
+STREAM_MAIL_SIZE = 1024 * 1024
+# bytes fetched per partial imap fetch of streamed mails.
+FETCH_CHUNK_SIZE = 1024 * 1024
+# bytes sent per write during SMTP DATA.
+SMTP_CHUNK_SIZE = 64 * 1024
+
+# header fields fetched for messages of threads.
+THREAD_HEADER_FIELDS = ('MESSAGE-ID', 'IN-REPLY-TO', 'REFERENCES', 'SUBJECT',
+                        'FROM', 'DATE')
+THREAD_HEADER_ITEM = 'BODY.PEEK[HEADER.FIELDS ({})]'.format(
+    ' '.join(THREAD_HEADER_FIELDS))
+# maximal number of threads searched with one imap SEARCH command. Keeps
+# commands well below the line length limit of servers.
+MAX_SEARCH_THREADS = 100
+
+# drafts up to this size (in bytes) are prefetched into memcache by
+# IMAPSession.prefetch_mail, if they are smaller than
+# PREFETCH_MAX_COMPRESSED_SIZE compressed. Memcache values are limited to 1MB.
+PREFETCH_MAX_SIZE = 4 * 1024 * 1024
+PREFETCH_MAX_COMPRESSED_SIZE = 900 * 1024
+# seconds prefetched drafts are kept in memcache. Drafts are prefetched a few
+# minutes before they are sent (see models.PREWARM_LOOKAHEAD).
+PREFETCH_CACHE_TIME = 7 * 60
+
+# in process cache of user -> dict of special-use flag to mailbox name.
+folder_cache = cache.LRUCache(maxsize=1000, ttl=FOLDER_CACHE_TIME)
+
 
 class Error(Exception):
     """ base error class """
@@ -43,11 +88,18 @@ class MailNotFound(Error):
 
 
 class Mail(object):
-    def __init__(self, rfc_str, labels=None):
+    """
+    Mail fetched via imap. rfc_message is the rfc822 encoded mail. It is None
+    for large mails that are fetched in chunks, chunks is an iterable of
+    strings of the rfc822 encoded mail in this case.
+    """
+
+    def __init__(self, rfc_str, labels=None, chunks=None):
         self.rfc_message = rfc_str
         if labels is None:
             labels = []
         self.labels = labels
+        self.chunks = chunks
 
     def get_parsed_message(self):
         """ Return parsed copy of message (email.message.Message). """
@@ -60,6 +112,78 @@ def xoauth2_bearer(username, access_token):
     return base64.b64encode(bearer)
 
 
+def get_body_item(msg):
+    """
+    Returns value of the BODY[...] item of a fetch response for a message or
+    None if there is no such item.
+    """
+    for key, value in msg.iteritems():
+        if key.startswith('BODY['):
+            return value
+    return None
+
+
+_header_field_re = re.compile(r'^([^\s:]+)[ \t]*:[ \t]*(.*(?:\r?\n[ \t].*)*)',
+                              re.MULTILINE)
+
+
+def parse_header_fields(header_block):
+    """
+    Lightweight parser for a block of rfc822 header fields, as returned by
+    HEADER.FIELDS fetches. Returns dict of lower case field names to the
+    value of their first occurrence. Values are returned like
+    email.message.Message.get does, folded lines are not unfolded.
+    """
+    fields = {}
+    for name, value in _header_field_re.findall(header_block):
+        fields.setdefault(name.lower(), value.rstrip('\r\n'))
+    return fields
+
+
+def is_nonexistent_mailbox_error(error):
+    """
+    Returns True if given imap error says that the selected mailbox does not
+    exist.
+    """
+    msg = str(error).lower()
+    return 'nonexistent' in msg or 'unknown mailbox' in msg
+
+
+def _derive_key(secret, purpose):
+    return hmac.new(secret, purpose, hashlib.sha256).digest()
+
+
+def seal(secret, context, data):
+    """
+    Encrypts data with AES-CTR and authenticates it together with context
+    (eg. its cache key) with HMAC-SHA256. Both keys are derived from secret.
+    Returns the sealed string, see unseal.
+    """
+    nonce = os.urandom(8)
+    cipher = AES.new(_derive_key(secret, 'seal-aes'), AES.MODE_CTR,
+                     counter=Counter.new(64, prefix=nonce))
+    sealed = nonce + cipher.encrypt(data)
+    mac = hmac.new(_derive_key(secret, 'seal-mac'), context + sealed,
+                   hashlib.sha256).digest()
+    return mac + sealed
+
+
+def unseal(secret, context, sealed):
+    """
+    Returns data sealed by seal with the same secret and context or None if
+    it was not.
+    """
+    mac, sealed = sealed[:32], sealed[32:]
+    expected = hmac.new(_derive_key(secret, 'seal-mac'), context + sealed,
+                        hashlib.sha256).digest()
+    if len(sealed) < 8 or not hmac.compare_digest(mac, expected):
+        return None
+    nonce = sealed[:8]
+    cipher = AES.new(_derive_key(secret, 'seal-aes'), AES.MODE_CTR,
+                     counter=Counter.new(64, prefix=nonce))
+    return cipher.decrypt(sealed[8:])
+
+
 def make_message_id():
     """
     Generates rfc message id. The returned message id includes the angle
@@ -71,6 +195,8 @@ def make_message_id():
 class IMAPSession(object):
     def __init__(self, user, access_token):
         self._selected_folder = None
+        # response of the last SELECT command
+        self.selected_info = {}
         self.client = imapclient.IMAPClient('imap.gmail.com', use_uid=True,
                                             ssl=True)
         if 'COMPRESS=DEFLATE' in self.client.capabilities:
@@ -83,22 +209,74 @@ class IMAPSession(object):
         except IMAPError, e:
             self.quit()
             raise AuthenticationError('oauth login failed: ' + str(e))
+        self.user = user
         try:
-            self._list_folders()
+            self.condstore = self._enable_condstore()
+            cached = self._load_cached_folders()
+            if not cached:
+                self._list_folders()
             # make sure it fails early if those mailboxes do not exist.
             self.get_trash_box()
             self.get_all_box()
+            if not cached:
+                self._cache_folders()
         except Exception:
             self.quit()
             raise
 
+    def _enable_condstore(self):
+        """
+        Enables CONDSTORE if the server advertised it at login, so
+        mailboxes have a HIGHESTMODSEQ. Returns True if it was enabled.
+        """
+        if 'CONDSTORE' not in self.client.capabilities:
+            return False
+        try:
+            return 'CONDSTORE' in self.client.enable('CONDSTORE')
+        except IMAPError:
+            logging.warning('could not enable CONDSTORE', exc_info=True)
+            return False
+
+    @staticmethod
+    def _get_folder_cache_key(user):
+        return 'imap_folders:' + user
+
+    @classmethod
+    def invalidate_folder_cache(cls, user):
+        """ Removes cached special folders of user. """
+        folder_cache.delete(user)
+        memcache.delete(cls._get_folder_cache_key(user))
+
+    def _load_cached_folders(self):
+        """
+        Loads special folders of user from in process cache or memcache.
+        Returns True on cache hit.
+        """
+        flag_boxes = folder_cache.get(self.user)
+        if flag_boxes is None:
+            flag_boxes = memcache.get(self._get_folder_cache_key(self.user))
+            if flag_boxes is None:
+                return False
+            folder_cache.set(self.user, flag_boxes)
+        self.flag_boxes = flag_boxes
+        return True
+
+    def _cache_folders(self):
+        folder_cache.set(self.user, self.flag_boxes)
+        memcache.set(self._get_folder_cache_key(self.user), self.flag_boxes,
+                     time=FOLDER_CACHE_TIME)
+
     def _list_folders(self):
         """
-        List folders folders and stores mapping of box to list of
-        flags in dict self.boxes_flags.
+        List folders and stores mapping of special-use flags to mailbox
+        names in dict self.flag_boxes.
         """
-        folders = self.client.list_folders()
-        self.boxes_flags = {box: flags for (flags, _, box) in folders}
+        flag_boxes = {}
+        for flags, _, box in self.client.list_folders():
+            for flag in flags:
+                if flag in SPECIAL_USE_FLAGS:
+                    flag_boxes.setdefault(flag, box)
+        self.flag_boxes = flag_boxes
 
     def get_all_box(self):
         """ Returns name of special All mailbox """
@@ -114,8 +292,58 @@ class IMAPSession(object):
         sends a command to the server if it differs.
         """
         if mailbox != self._selected_folder:
+            self._selected_folder = None
+            try:
+                info = self.client.select_folder(mailbox)
+            except IMAPError, e:
+                if not is_nonexistent_mailbox_error(e):
+                    raise
+                mailbox, info = self._select_renamed_folder(mailbox)
+            self.selected_info = info
             self._selected_folder = mailbox
-            self.client.select_folder(mailbox)
+
+    @property
+    def uid_validity(self):
+        """ UIDVALIDITY of selected folder. """
+        return self.selected_info.get('UIDVALIDITY')
+
+    def get_all_box_status(self):
+        """
+        Returns dict with UIDVALIDITY and HIGHESTMODSEQ of the all mailbox
+        from the response of selecting it. HIGHESTMODSEQ changes whenever
+        any message in the mailbox changes. As the box is only selected once
+        per session, the values are as old as the session at most. Returns
+        an empty dict if CONDSTORE is not enabled.
+        """
+        if not self.condstore:
+            return {}
+        self.select_folder(self.get_all_box())
+        return {key: self.selected_info[key]
+                for key in ('UIDVALIDITY', 'HIGHESTMODSEQ')
+                if key in self.selected_info}
+
+    def _select_renamed_folder(self, mailbox):
+        """
+        Called when selecting mailbox failed because it does not exist. The
+        cached special folders might be stale, so they are invalidated and
+        listed again. If mailbox was a special folder that has been renamed
+        the new mailbox is selected. Returns tuple of new mailbox and the
+        select response.
+        """
+        flags = [flag for flag, box in self.flag_boxes.iteritems()
+                 if box == mailbox]
+        logging.info('mailbox {} does not exist, listing folders'.format(
+            mailbox))
+        self.invalidate_folder_cache(self.user)
+        self._list_folders()
+        self._cache_folders()
+        new_box = None
+        if flags:
+            new_box = self.flag_boxes.get(flags[0])
+        if new_box is None or new_box == mailbox:
+            raise MailboxNotFound(
+                'Mailbox {} does not exist'.format(mailbox))
+        return new_box, self.client.select_folder(new_box)
 
     def delete_message(self, message_id):
         """ Deletes draft with given message id completely.
@@ -162,7 +390,8 @@ class IMAPSession(object):
         self.client.noop()
         # copy labels to sent message
         if mail is None:
-            mail = self.get_mail(message_id)
+            # only labels are needed
+            mail = self.get_mail(message_id, max_size=0)
             if mail is None:
                 # mail seems to have been deleted in the meantime,
                 # we don't treat this as an error
@@ -181,55 +410,118 @@ class IMAPSession(object):
         """
         return self.raw_search('rfc822msgid:{}'.format(rfc_msg_id))
 
-    def get_thread(self, thread_id, limit=None, reverse=False):
+    def get_thread(self, thread_id, limit=None, reverse=False,
+                   since_uid=None, uid_validity=None):
         """
         Returns unorderd list of metadata of messages in given thread.
         Each item is a dict with the following keys:
         message_id, rfc_message_id, subject, from_name,
-        from_email, date, in_reply_to, references.
+        from_email, date, in_reply_to, references, uid, uid_validity.
         Values correspond to the mail header values.
         message_id is the internal gmail message id as hex string.
+        uid and uid_validity identify the message in the all mailbox.
+        If since_uid is given, only messages with a greater uid are returned,
+        unless uid_validity differs from the UIDVALIDITY of the all mailbox
+        (uids are not comparable then).
         """
         self.select_folder(self.get_all_box())
-        uids = self.client.search('X-GM-THRID {:d}'.format(thread_id))
+        if since_uid is not None and uid_validity == self.uid_validity:
+            uids = self.client.search('X-GM-THRID {:d} UID {:d}:*'.format(
+                thread_id, since_uid + 1))
+            # n:* always matches the message with the highest uid, even if
+            # it is lower than n.
+            uids = [uid for uid in uids if int(uid) > since_uid]
+            if not uids:
+                return []
+        else:
+            uids = self.client.search('X-GM-THRID {:d}'.format(thread_id))
         if reverse:
             uids = list(reversed(uids))
         if limit is not None:
             uids = uids[0:limit]
-        result = self.client.fetch(uids, ['X-GM-MSGID', 'RFC822.HEADER'])
+        result = self.client.fetch(uids, ['X-GM-MSGID', THREAD_HEADER_ITEM])
+        uid_validity = self.uid_validity
         # restore original order
-        result = [result[uid] for uid in uids]
-        msgs = []
-        for item in result:
-            mail = email.parser.Parser().parsestr(item['RFC822.HEADER'])
-            id = '{:x}'.format(int(item['X-GM-MSGID']))
-            msg = {'message_id': id,
-                   'rfc_message_id': mail.get('message-id'),
-                   'in_reply_to': mail.get('in-reply-to'),
-                   'references': mail.get('references'),
-                   'subject': mail.get('subject')}
-            if 'date' in mail:
-                date = email.utils.parsedate_tz(mail['date'])
-                if date:
-                    msg['date'] = datetime.datetime.fromtimestamp(
-                        email.utils.mktime_tz(date))
-            if 'from' in mail:
-                name, addr = email.utils.parseaddr(mail['from'])
-                msg['from_name'] = name
-                msg['from_email'] = addr
-            msgs.append(msg)
-        return msgs
+        return [self._build_thread_msg(uid, result[uid], uid_validity)
+                for uid in uids]
+
+    def get_threads(self, thread_ids, since_uid=None, uid_validity=None,
+                    chunk_size=MAX_SEARCH_THREADS):
+        """
+        Batch version of get_thread. Searches messages of all given threads
+        with OR-ed X-GM-THRID searches of at most chunk_size threads each.
+        Returns dict of thread id to list of messages ordered by uid.
+        since_uid and uid_validity are applied to all threads.
+        """
+        self.select_folder(self.get_all_box())
+        incremental = (since_uid is not None and
+                       uid_validity == self.uid_validity)
+        thread_ids = list(thread_ids)
+        uids = set()
+        for offset in xrange(0, len(thread_ids), chunk_size):
+            chunk = thread_ids[offset:offset + chunk_size]
+            criteria = ['OR'] * (len(chunk) - 1)
+            criteria.extend('X-GM-THRID {:d}'.format(thread_id)
+                            for thread_id in chunk)
+            if incremental:
+                criteria.append('UID {:d}:*'.format(since_uid + 1))
+            uids.update(int(uid) for uid in self.client.search(
+                ' '.join(criteria)))
+        if incremental:
+            # n:* always matches the message with the highest uid
+            uids = [uid for uid in uids if uid > since_uid]
+        threads = dict((thread_id, []) for thread_id in thread_ids)
+        if not uids:
+            return threads
+        uids = sorted(uids)
+        result = self.client.fetch(
+            uids, ['X-GM-THRID', 'X-GM-MSGID', THREAD_HEADER_ITEM])
+        uid_validity = self.uid_validity
+        for uid in uids:
+            item = result.get(uid)
+            if not item:
+                continue
+            msgs = threads.get(int(item['X-GM-THRID']))
+            if msgs is not None:
+                msgs.append(self._build_thread_msg(uid, item, uid_validity))
+        return threads
+
+    @staticmethod
+    def _build_thread_msg(uid, item, uid_validity):
+        """
+        Returns message dict as described in get_thread for given fetch
+        response item.
+        """
+        mail = parse_header_fields(get_body_item(item) or '')
+        id = '{:x}'.format(int(item['X-GM-MSGID']))
+        msg = {'message_id': id,
+               'rfc_message_id': mail.get('message-id'),
+               'in_reply_to': mail.get('in-reply-to'),
+               'references': mail.get('references'),
+               'subject': mail.get('subject'),
+               'uid': int(uid),
+               'uid_validity': uid_validity}
+        if 'date' in mail:
+            date = email.utils.parsedate_tz(mail['date'])
+            if date:
+                msg['date'] = datetime.datetime.fromtimestamp(
+                    email.utils.mktime_tz(date))
+        if 'from' in mail:
+            name, addr = email.utils.parseaddr(mail['from'])
+            msg['from_name'] = name
+            msg['from_email'] = addr
+        return msg
 
     def box_with_flag(self, flag):
         """
         Returns mailbox that has given flag. Raises MailboxNotFound if no such
         mailbox exists.
         """
-        for box, flags in self.boxes_flags.iteritems():
-            if flag in flags:
-                return box
-        raise MailboxNotFound(
-            'Mailbox with flag {} does not exist'.format(flag))
+        box = self.flag_boxes.get(flag)
+        if box is None:
+            raise MailboxNotFound(
+                'Mailbox with flag {} does not exist'.format(flag))
+        return box
 
     def uid_by_message_id(self, message_id):
         """ Search mail by message_id """
@@ -241,10 +533,15 @@ class IMAPSession(object):
     def raw_search(self, query):
         return self.client.search(u'X-GM-RAW {}'.format(query))
 
-    def get_mail(self, message_id):
+    def get_mail(self, message_id, max_size=None, prefetch_secret=None):
         """
         Get mails as rfc822 encoded string by message_id (64 bit integer).
         Returns None if mail is not found.
+        If max_size is given and the mail is larger, only its labels are
+        fetched. The returned Mail is fetched in chunks when iterating
+        Mail.chunks, see iter_mail_chunks.
+        If prefetch_secret is given, a mail stored by prefetch_mail with the
+        same secret is used (with max_size only).
         """
         # select all-mails mailbox
         self.select_folder(self.get_all_box())
@@ -252,6 +549,21 @@ class IMAPSession(object):
         if not uid:
             return None
             # search by message id (int format needed for imap)
+        if max_size is not None:
+            messages = self.client.fetch(uid, ['RFC822.SIZE', 'X-GM-LABELS'])
+            msg = messages.get(uid)
+            if not msg:
+                return None
+            rfc_message = None
+            if prefetch_secret is not None:
+                rfc_message = self._pop_prefetched_mail(
+                    message_id, uid, prefetch_secret)
+            if rfc_message is not None:
+                return Mail(rfc_message, msg['X-GM-LABELS'])
+            size = msg['RFC822.SIZE']
+            if size > max_size:
+                return Mail(None, msg['X-GM-LABELS'],
+                            chunks=self.iter_mail_chunks(uid, size))
         messages = self.client.fetch(uid, ['RFC822', 'X-GM-LABELS'])
         msg = messages.get(uid)
         if not msg:
@@ -259,6 +571,84 @@ class IMAPSession(object):
 
         return Mail(msg['RFC822'], msg['X-GM-LABELS'])
 
+    def _get_prefetch_cache_key(self, message_id):
+        return 'prefetched_mail:{}:{:d}'.format(self.user, message_id)
+
+    def prefetch_mail(self, message_id, secret, max_size=PREFETCH_MAX_SIZE):
+        """
+        Fetches mail with given message_id and stores it compressed and
+        encrypted with secret (see seal) in memcache for PREFETCH_CACHE_TIME
+        seconds, so a later get_mail call does not have to fetch it again.
+        Mails larger than max_size are not prefetched. Returns True if the
+        mail was stored.
+        """
+        self.select_folder(self.get_all_box())
+        uid = self.uid_by_message_id(message_id)
+        if not uid:
+            return False
+        msg = self.client.fetch(uid, ['RFC822.SIZE']).get(uid)
+        if not msg or msg['RFC822.SIZE'] > max_size:
+            return False
+        msg = self.client.fetch(uid, ['RFC822']).get(uid)
+        if not msg:
+            return False
+        data = zlib.compress(msg['RFC822'])
+        if len(data) > PREFETCH_MAX_COMPRESSED_SIZE:
+            return False
+        # message contents are immutable, the uid in the all mailbox
+        # identifies this version of the mail (labels may still change).
+        key = self._get_prefetch_cache_key(message_id)
+        prefetched = {'uid': int(uid),
+                      'uid_validity': self.uid_validity,
+                      'data': seal(secret, key, data)}
+        memcache.set(key, prefetched, time=PREFETCH_CACHE_TIME)
+        metrics.incr(metrics.MAIL_PREFETCHES)
+        return True
+
+    def _pop_prefetched_mail(self, message_id, uid, secret):
+        """
+        Returns rfc822 encoded mail with given message_id that was stored by
+        prefetch_mail and removes it from memcache, so it is deleted before
+        it is sent. Returns None if it was not prefetched, if it was not
+        encrypted with secret or if it is not the message that currently has
+        given uid in the all mailbox.
+        """
+        key = self._get_prefetch_cache_key(message_id)
+        prefetched = memcache.get(key)
+        if prefetched is None:
+            return None
+        memcache.delete(key)
+        if (prefetched['uid'] != int(uid) or
+                prefetched['uid_validity'] != self.uid_validity):
+            logging.info('prefetched mail {:d} is outdated'.format(
+                message_id))
+            return None
+        data = unseal(secret, key, prefetched['data'])
+        if data is None:
+            logging.warning('prefetched mail {:d} is not authentic'.format(
+                message_id))
+            return None
+        metrics.incr(metrics.PREFETCHED_MAIL_HITS)
+        return zlib.decompress(data)
+
+    def iter_mail_chunks(self, uid, size, chunk_size=FETCH_CHUNK_SIZE):
+        """
+        Generator for the rfc822 encoded mail with given uid in the all
+        mailbox. Yields chunks of at most chunk_size bytes that are fetched
+        with partial fetches (BODY.PEEK[]<offset.length>), so the mail is
+        never loaded completely.
+        """
+        offset = 0
+        while offset < size:
+            self.select_folder(self.get_all_box())
+            item = 'BODY.PEEK[]<{:d}.{:d}>'.format(offset, chunk_size)
+            msg = self.client.fetch(uid, [item]).get(uid, {})
+            data = get_body_item(msg)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+
     def quit(self):
         try:
             self.client.logout()
@@ -289,36 +679,197 @@ class SMTPSession(object):
         """
         Send rfc822 mail as fetched via imap. To and from addresses are
         extracted from the rfc822 envolope.
-        Returns the rfc message id of the sent message.
+        rfc822_mail is a rfc822 encoded string, an email.message.Message or
+        a MailSendRewriter.
         """
-        rewriter = MailSendRewriter(rfc822_mail)
+        if isinstance(rfc822_mail, MailSendRewriter):
+            rewriter = rfc822_mail
+        else:
+            rewriter = MailSendRewriter(rfc822_mail, headers_only=True)
         receivers = rewriter.get_receivers()
         rewriter.rewrite()
         if not receivers:
             raise InvalidEmail('no to address')
             # TODO: check for any rejected recepient. Fail if any fails?
-        try:
-            self.client.sendmail(rewriter.get_from(), receivers,
-                                 rewriter.message_as_str())
-        except smtplib.SMTPRecipientsRefused:
+        self.send_stream(rewriter.get_from(), receivers,
+                         rewriter.message_chunks())
+
+    def send_stream(self, from_addr, receivers, message):
+        """
+        Sends rfc822 encoded message given as iterable of string chunks or
+        file-like object to receivers. The message is encoded for DATA and
+        sent chunk by chunk (see smtp_data_chunks), so it is never held in
+        memory completely.
+        Raises InvalidEmail if all receivers are refused. If reading the
+        message fails, the connection is closed and the error is re-raised.
+        Returns dict of refused receivers like smtplib.SMTP.sendmail.
+        """
+        client = self.client
+        if hasattr(message, 'read'):
+            fd = message
+            message = iter(lambda: fd.read(SMTP_CHUNK_SIZE), '')
+        client.ehlo_or_helo_if_needed()
+        (code, resp) = client.mail(from_addr)
+        if code != 250:
+            client.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        refused = {}
+        for addr in receivers:
+            (code, resp) = client.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(receivers):
+            client.rset()
             raise InvalidEmail('server rejected recepients')
+        (code, resp) = client.docmd('data')
+        if code != 354:
+            client.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        try:
+            for data in smtp_data_chunks(message):
+                client.send(data)
+        except Exception:
+            # the message can't be aborted once DATA started. Drop the
+            # connection without terminating it, so the server discards the
+            # partial message instead of sending it.
+            client.close()
+            raise
+        (code, resp) = client.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
 
     def quit(self):
         self.client.quit()
 
 
+def _find_header_end(rfc822_mail):
+    """
+    Returns tuple (end of header block, start of body) or None if there is
+    no empty line in rfc822_mail.
+    """
+    found = [(rfc822_mail.find(sep), sep) for sep in ('\r\n\r\n', '\n\n')]
+    found = [(pos, sep) for pos, sep in found if pos != -1]
+    if not found:
+        return None
+    pos, sep = min(found)
+    header_end = pos + len(sep) / 2
+    return header_end, header_end + len(sep) / 2
+
+
+def split_rfc822(rfc822_mail):
+    """
+    Splits rfc822 encoded mail string into header block and body.
+    Returns the header block (with its last line break) as string and the
+    body (without the separating empty line) as memoryview of rfc822_mail,
+    so the body is not copied.
+    """
+    bounds = _find_header_end(rfc822_mail)
+    if bounds is None:
+        return rfc822_mail, memoryview('')
+    header_end, body_start = bounds
+    return rfc822_mail[:header_end], memoryview(rfc822_mail)[body_start:]
+
+
+def split_rfc822_chunks(chunks):
+    """
+    Like split_rfc822 for rfc822 encoded mail given as iterable of chunks.
+    Returns the header block as string and a generator for the body chunks.
+    Only the chunks up to the end of the header block are read.
+    """
+    chunks = iter(chunks)
+    head = ''
+    bounds = None
+    for chunk in chunks:
+        head += chunk
+        bounds = _find_header_end(head)
+        if bounds is not None:
+            break
+    if bounds is None:
+        return head, iter([])
+    header_end, body_start = bounds
+
+    def body():
+        yield memoryview(head)[body_start:]
+        for chunk in chunks:
+            yield chunk
+
+    return head[:header_end], body()
+
+
+def iter_slices(data, size):
+    """ Generator for memoryview slices of at most size bytes of data. """
+    view = memoryview(data)
+    for offset in xrange(0, len(view), size):
+        yield view[offset:offset + size]
+
+
+_line_break_re = re.compile(r'\r\n|\n|\r')
+
+
+def smtp_data_chunks(chunks):
+    """
+    Generator that encodes message given as iterable of string chunks for
+    the SMTP DATA command: Line breaks are normalized to CRLF, lines starting
+    with a dot are dot-stuffed and the terminating <CRLF>.<CRLF> is appended.
+    Chunks are encoded one by one, so only about one chunk is held in memory.
+    """
+    # a CR at the end of a chunk might start a CRLF continued in the next
+    pending = ''
+    line_start = True
+    for chunk in chunks:
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        data = pending + chunk
+        pending = ''
+        if data.endswith('\r'):
+            data, pending = data[:-1], '\r'
+        if not data:
+            continue
+        data = _line_break_re.sub('\r\n', data).replace('\r\n.', '\r\n..')
+        if line_start and data.startswith('.'):
+            data = '.' + data
+        line_start = data.endswith('\n')
+        yield data
+    if pending:
+        line_start = True
+        yield '\r\n'
+    if not line_start:
+        yield '\r\n'
+    yield '.\r\n'
+
+
 class MailSendRewriter(object):
     """
     Helper class to rewrite a rfc822 mail that was fetched via imap to
     prepare it for sending via SMTP.
+    If headers_only is True, only the header block of the mail is parsed and
+    the body is kept as memoryview of the original string in self.body.
+    It is sent as is, without parsing and re-encoding its MIME parts.
     """
 
-    def __init__(self, mail_rfc822):
+    def __init__(self, mail_rfc822, headers_only=False):
+        self.body = None
         if isinstance(mail_rfc822, email.message.Message):
             self.message = mail_rfc822
+        elif headers_only:
+            header, self.body = split_rfc822(mail_rfc822)
+            self.message = email.parser.HeaderParser().parsestr(header)
         else:
             self.message = email.parser.Parser().parsestr(mail_rfc822)
 
+    @classmethod
+    def from_chunks(cls, chunks):
+        """
+        Creates rewriter in headers_only mode for mail given as iterable of
+        string chunks. self.body is a generator of the body chunks then,
+        that can only be consumed once.
+        """
+        header, body = split_rfc822_chunks(chunks)
+        rewriter = cls(header, headers_only=True)
+        rewriter.body = body
+        return rewriter
+
     def rewrite(self):
         """ Performs the following modifications to message headers:
         - Updates date in message to current date
@@ -394,7 +945,38 @@ class MailSendRewriter(object):
 
     def message_as_str(self):
         """ RFC822 encoded message """
-        return self.message.as_string()
+        if self.body is None:
+            return self.message.as_string()
+        return ''.join(self.message_chunks())
+
+    def message_chunks(self, chunk_size=SMTP_CHUNK_SIZE):
+        """
+        Generator for the RFC822 encoded message in chunks. In headers_only
+        mode the header block is followed by slices of at most chunk_size
+        bytes of the original body.
+        """
+        if self.body is None:
+            yield self.message.as_string()
+            return
+        yield self.header_as_str()
+        if isinstance(self.body, memoryview):
+            for chunk in iter_slices(self.body, chunk_size):
+                yield chunk.tobytes()
+        else:
+            for chunk in self.body:
+                if isinstance(chunk, memoryview):
+                    chunk = chunk.tobytes()
+                yield chunk
+
+    def header_as_str(self):
+        """
+        Header block followed by the empty line that separates it from the
+        body. Folded header values are written unchanged.
+        """
+        lines = ['{}: {}\r\n'.format(name, value)
+                 for name, value in self.message.items()]
+        lines.append('\r\n')
+        return ''.join(lines)
 
 
 class Mailman(object):
@@ -407,6 +989,7 @@ class Mailman(object):
         self.user = user
         self.auth_token = auth_token
         self._imap_session = None
+        self._smtp_session = None
 
     def open_imap_session(self):
         """ Returns opened imap session. """
@@ -427,6 +1010,17 @@ class Mailman(object):
             self._imap_session = imap
         return imap
 
+    def get_opened_smtp_session(self):
+        """
+        Returns smtp session. Opens new session if there is no opened
+        session yet.
+        """
+        smtp = self._smtp_session
+        if smtp is None:
+            smtp = self.open_smtp_session()
+            self._smtp_session = smtp
+        return smtp
+
     def safe_smtp_quit(self, smtp):
         try:
             smtp.quit()
@@ -435,25 +1029,38 @@ class Mailman(object):
             # ignore
             pass
 
-    def send_draft(self, message_id, send_rfc_message_id):
+    def send_draft(self, message_id, send_rfc_message_id,
+                   prefetch_secret=None):
         """
         Fetches message with given id from imap and sends it using smtp.
+        Uses the mail prefetched with prefetch_secret if there is one (see
+        prefetch_draft).
         Returns the original mail as a gmail.Mail object.
         """
         imap = self.get_opened_imap_session()
-        mail = imap.get_mail(message_id)
+        mail = imap.get_mail(message_id, max_size=STREAM_MAIL_SIZE,
+                             prefetch_secret=prefetch_secret)
         if mail is None:
             raise MailNotFound('Mail with id {} not found'.format(message_id))
-        message = mail.get_parsed_message()
+        # only parse headers, the body is sent as fetched
+        if mail.rfc_message is None:
+            rewriter = MailSendRewriter.from_chunks(mail.chunks)
+        else:
+            rewriter = MailSendRewriter(mail.rfc_message, headers_only=True)
+        message = rewriter.message
         if 'Message-Id' in message:
             del message['Message-Id']
         message['Message-Id'] = send_rfc_message_id
 
-        smtp = self.open_smtp_session()
-        smtp.send_rfc822(message)
-        self.safe_smtp_quit(smtp)
+        smtp = self.get_opened_smtp_session()
+        smtp.send_rfc822(rewriter)
         return mail
 
+    def prefetch_draft(self, message_id, secret):
+        """ See IMAPSession.prefetch_mail. """
+        return self.get_opened_imap_session().prefetch_mail(message_id,
+                                                            secret)
+
     def mark_as_sent(self, message_id, sent_message_rfc_id, mail=None):
         """  moves message from drafts to sent folder """
         imap = self.get_opened_imap_session()
@@ -463,6 +1070,15 @@ class Mailman(object):
         """ See IMAPSession.get_thread. """
         return self.get_opened_imap_session().get_thread(thread_id, **kwargs)
 
+    def get_threads(self, thread_ids, **kwargs):
+        """ See IMAPSession.get_threads. """
+        return self.get_opened_imap_session().get_threads(thread_ids,
+                                                          **kwargs)
+
+    def get_all_box_status(self):
+        """ See IMAPSession.get_all_box_status. """
+        return self.get_opened_imap_session().get_all_box_status()
+
     def build_reply(self, thread_id, mail=None):
         """
         Modify mail (gae mail.EmailMessage) to a reply of the given thread_id.
@@ -495,11 +1111,14 @@ class Mailman(object):
 
     def send_mail(self, mail):
         """ Sends gae mail.EmailMessage via SMTP. """
-        smtp = self.open_smtp_session()
+        smtp = self.get_opened_smtp_session()
         smtp.send_rfc822(mail.to_mime_message())
-        self.safe_smtp_quit(smtp)
 
     def quit(self):
+        smtp = self._smtp_session
+        if smtp is not None:
+            self.safe_smtp_quit(smtp)
+            self._smtp_session = None
         imap = self._imap_session
         if imap is not None:
             imap.quit()
@@ -0,0 +1,32 @@
+"""
+Counters of work done and avoided by background tasks. They are kept in
+memcache, so they are approximate and may be reset at any time.
+"""
+from google.appengine.api import memcache
+
+NAMESPACE = 'metrics'
+
+# reply checks that skipped the imap thread search and fetch because the
+# all mailbox did not change.
+THREAD_FETCHES_AVOIDED = 'thread_fetches_avoided'
+# reply checks that searched and fetched the thread.
+THREAD_FETCHES = 'thread_fetches'
+# access tokens served from cache without calling the token endpoint.
+ACCESS_TOKEN_CACHE_HITS = 'access_token_cache_hits'
+# calls of the oauth token endpoint and the milliseconds spent in them.
+ACCESS_TOKEN_REFRESHES = 'access_token_refreshes'
+ACCESS_TOKEN_REFRESH_MS = 'access_token_refresh_ms'
+# drafts prefetched before they were due and drafts sent without fetching
+# them again.
+MAIL_PREFETCHES = 'mail_prefetches'
+PREFETCHED_MAIL_HITS = 'prefetched_mail_hits'
+
+
+def incr(name, delta=1):
+    """ Increments counter with given name by delta. """
+    memcache.incr(name, delta, namespace=NAMESPACE, initial_value=0)
+
+
+def get(name):
+    """ Returns current value of counter with given name. """
+    return memcache.get(name, namespace=NAMESPACE) or 0
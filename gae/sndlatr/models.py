@@ -1,24 +1,47 @@
 import datetime
 import logging
+import os
 import json
 import itertools
+import zlib
+import hashlib
+import time
+import calendar
+import threading
+import cPickle as pickle
 
 from google.appengine.ext import ndb
-from google.appengine.api import taskqueue
+from google.appengine.api import taskqueue, memcache
+import httplib2
+from iso8601 import UTC
 
 from oauth2client.appengine import CredentialsNDBProperty
-from sndlatr import gmail, mailnotify, validation
+from w69b import cache
+from sndlatr import gmail, mailnotify, validation, metrics, push
 
 
 class Error(Exception):
     """ Base class for model errors """
 
 
+# layouts of the jobs and snippets of an account: root entities filtered by
+# user_id, moving under the account key (read from both places) and children
+# of the account key (see migrate_layout).
+LAYOUT_ROOT = 'root'
+LAYOUT_MIGRATING = 'migrating'
+LAYOUT_ANCESTOR = 'ancestor'
+# layout of accounts created from now on
+NEW_ACCOUNT_LAYOUT = LAYOUT_ROOT
+
+
 class Account(ndb.Model):
     """ Identifies a user of the service. Keyed by gae user_id """
     # last seen email address
     email = ndb.StringProperty()
     credentials = CredentialsNDBProperty(required=True)
+    layout = ndb.StringProperty(default=LAYOUT_ROOT, indexed=False,
+                                choices=[LAYOUT_ROOT, LAYOUT_MIGRATING,
+                                         LAYOUT_ANCESTOR])
 
     def user_id(self):
         """ return user_id part of key """
@@ -54,7 +77,85 @@ class DisabledReply(ndb.Model):
         return reply
 
 
-class Snippet(ndb.Model):
+class AppSecret(ndb.Model):
+    """
+    Random secret of the application that is created on first use. Keyed by
+    name.
+    """
+    value = ndb.BlobProperty(required=True)
+
+    @classmethod
+    def get_value(cls, name):
+        """ Returns value of secret with given name. """
+        value = app_secret_cache.get(name)
+        if value is None:
+            value = cls.get_or_insert(name, value=os.urandom(32)).value
+            app_secret_cache.set(name, value)
+        return value
+
+
+def get_prefetch_secret():
+    """ Returns secret prefetched drafts are encrypted with. """
+    return AppSecret.get_value('prefetch')
+
+
+class DisplayedMixin(object):
+    """
+    Mixin for models that are shown to their user (jobs and snippets). Write
+    them with save and remove instead of put and delete, so the dashboard of
+    the user is updated with them (see Dashboard).
+    """
+
+    def is_displayed(self, now):
+        """ Returns True if the client shows this entity at now. """
+        return True
+
+    def is_movable(self):
+        """
+        Returns True if entity may be re-keyed under its account. Entities
+        that are referenced by their key elsewhere (eg. in tasks) are not.
+        """
+        return True
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_ids_async(cls, user_id, ids):
+        """
+        Gets entities of user by their ids in the layout of the account of
+        user. Returns list of entities, None for missing ones.
+        """
+        layout = yield get_layout_async(user_id)
+        parents = _get_read_parents(user_id, layout)
+        entities = yield ndb.get_multi_async(
+            [ndb.Key(cls, id, parent=parent)
+             for parent in parents for id in ids])
+        # first one found in the order of parents
+        raise ndb.Return([
+            next((entity for entity in entities[i::len(ids)]
+                  if entity is not None), None)
+            for i in xrange(len(ids))])
+
+    @classmethod
+    def query_user(cls, user_id, parent, *filters):
+        """
+        Query for entities of user matching filters. Ancestor query if
+        parent (the account key) is given, query for root entities of user
+        otherwise. See fetch_user_entities_async.
+        """
+        if parent is None:
+            filters += (cls.user_id == user_id,)
+        return cls.query(*filters, ancestor=parent)
+
+    def save(self):
+        """ Puts entity and updates dashboard of its user. """
+        Dashboard.save_multi([self])
+
+    def remove(self):
+        """ Deletes entity and removes it from dashboard of its user. """
+        Dashboard.save_multi(deleted=[self])
+
+
+class Snippet(DisplayedMixin, ndb.Model):
     created_at = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
     updated_at = ndb.DateTimeProperty(auto_now=True, indexed=False)
     usage_cnt = ndb.IntegerProperty(default=0, indexed=False)
@@ -64,11 +165,202 @@ class Snippet(ndb.Model):
     user_id = ndb.StringProperty(required=True)
 
     @classmethod
-    def query_display(cls, user_id):
-        return cls.query(cls.user_id == user_id)
+    def query_display(cls, user_id, parent=None):
+        return cls.query_user(user_id, parent)
+
+
+# number of dispatch index shards per minute. Spreads writes of jobs that are
+# due at the same minute over multiple entity groups.
+DISPATCH_SHARDS = 8
+# maximal number of tasks added with a single taskqueue call.
+QUEUE_ADD_BATCH_SIZE = 100
+# lease of queued jobs. Jobs that are queued for longer than this and did not
+# start sending are queued again in case their task got lost (see
+# requeue_lost_jobs).
+REQUEUE_AFTER = datetime.timedelta(minutes=10)
+# number of dispatch buckets read per page by add_all_due_to_queue.
+DISPATCH_PAGE_SIZE = 50
+BACKFILL_URL = '/api/tasks/backfill_dispatch_index'
+# number of jobs read per page and seconds a run may take before it continues
+# in a task for backfill_dispatch_index.
+BACKFILL_PAGE_SIZE = 200
+BACKFILL_TIME_BUDGET = 60
+# seconds add_all_due_to_queue may run before it continues in a task.
+DISPATCH_TIME_BUDGET = 30
+# due jobs of a user are processed in batches of this size by a single task.
+# Further batches are delayed by USER_BATCH_MARGIN seconds each.
+USER_BATCH_SIZE = 10
+USER_BATCH_MARGIN = 30
+USER_BATCH_URL = '/api/tasks/batch'
+# seconds until a job that failed in a batch is retried on its own.
+USER_BATCH_RETRY_COUNTDOWN = 10
+# jobs are dispatched by eta tasks (see add_eta_task), the enqueue cron only
+# picks up jobs that are due for longer than this.
+ETA_TASK_GRACE = datetime.timedelta(minutes=2)
+# dispatch index entries of scheduled jobs that are stored with an earlier
+# schedule date than their bucket are only removed once the bucket is due for
+# this long (see _dispatch_buckets).
+DISPATCH_STALE_GRACE = datetime.timedelta(minutes=10)
+DISPATCH_URL = '/api/tasks/dispatch'
+# maximal eta of tasks supported by the task queue (minus some margin).
+MAX_TASK_ETA = datetime.timedelta(days=29)
+# users with jobs that are due in PREWARM_LOOKAHEAD get their access token
+# refreshed and their drafts prefetched in advance (see add_prewarm_tasks).
+PREWARM_LOOKAHEAD = datetime.timedelta(minutes=5)
+PREWARM_URL = '/api/tasks/prewarm'
+# prefetch drafts of send jobs while prewarming. Prefetched drafts are kept
+# encrypted in memcache until they are sent (see gmail.IMAPSession
+# .prefetch_mail), so this is off unless memcache may hold them.
+PREFETCH_DRAFTS = False
+# maximal number of entity groups of a cross group transaction.
+XG_MAX_ENTITY_GROUPS = 25
+# maximal size of the compressed entities of a dashboard. Dashboards of users
+# with more displayed entities are left incomplete, /api/init queries them.
+DASHBOARD_MAX_SIZE = 900 * 1024
+# rebuilt dashboards are only stored if they were not written for this long,
+# so the eventually consistent queries they are built from see all writes.
+DASHBOARD_REBUILD_DELAY = datetime.timedelta(minutes=1)
+# changed jobs are looked up with eventually consistent queries, so the token
+# returned by Dashboard.get_changes only covers versions that were written
+# for this long.
+CHANGES_SETTLE_TIME = datetime.timedelta(seconds=10)
+# seconds versions of dashboards are cached in memcache (see
+# Dashboard.get_version). Bounds how long a version that could not be
+# updated after a write is served.
+DASHBOARD_VERSION_CACHE_TIME = 600
+# tries to raise a cached dashboard version with compare and set.
+DASHBOARD_VERSION_CACHE_RETRIES = 5
+MIGRATE_LAYOUT_URL = '/api/tasks/migrate_layout'
+DASHBOARD_INVALIDATE_URL = '/api/tasks/invalidate_dashboard'
+# seconds between passes of migrate_layout, so its queries see what the
+# previous pass and concurrent writers wrote.
+MIGRATE_PASS_DELAY = 60
+# accounts that still have root entities after this many passes (eg. jobs
+# that are stuck while being processed) are left in the migrating layout.
+MIGRATE_MAX_PASSES = 30
+# seconds a migrate_layout task may run before it continues in a task.
+MIGRATE_TIME_BUDGET = 60
+# number of keys read per page by migrate_layout.
+MIGRATE_PAGE_SIZE = 200
+# cached access tokens are refreshed this many seconds before they expire, so
+# they stay valid while a task uses them.
+ACCESS_TOKEN_EXPIRY_MARGIN = 300
+
+# user_id to access token, entries expire ACCESS_TOKEN_EXPIRY_MARGIN before
+# the token.
+access_token_cache = cache.LRUCache(maxsize=1000)
+# user_id -> _PendingRefresh of access tokens being refreshed by this
+# instance, guarded by _refresh_lock.
+_pending_refreshes = {}
+_refresh_lock = threading.Lock()
+# name -> value of AppSecrets loaded by this instance.
+app_secret_cache = cache.LRUCache(maxsize=10)
+
+
+class DispatchBucket(ndb.Model):
+    """
+    Dispatch index of scheduled jobs. A bucket holds the keys of all
+    jobs of one kind that are due within the same minute (and shard).
+    Entries may be stale, consumers have to check the job itself.
+    """
+    kind = ndb.StringProperty(required=True)
+    # start of the minute the jobs of this bucket are due (utc)
+    due_at = ndb.DateTimeProperty(required=True)
+    job_keys = ndb.KeyProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def get_key(cls, job_key, scheduled_at):
+        """ Key of bucket job with given key and schedule date belongs to. """
+        shard = (zlib.crc32(job_key.urlsafe()) & 0xffffffff) % DISPATCH_SHARDS
+        return cls._get_shard_key(job_key.kind(), scheduled_at, shard)
+
+    @classmethod
+    def get_minute_keys(cls, kind, time):
+        """ Keys of all shards of buckets of kind due at minute of time. """
+        return [cls._get_shard_key(kind, time, shard)
+                for shard in xrange(DISPATCH_SHARDS)]
+
+    @classmethod
+    def _get_shard_key(cls, kind, time, shard):
+        return ndb.Key(cls, '{}-{}-{:d}'.format(
+            kind, time.strftime('%Y%m%d%H%M'), shard))
+
+    @classmethod
+    def query_due(cls, kind, time):
+        """ Returns query for buckets of given kind due at given datetime. """
+        return cls.query(cls.kind == kind, cls.due_at <= time)
+
+    @classmethod
+    def query_due_between(cls, kind, start, end):
+        """
+        Returns query for buckets of given kind due after start and at or
+        before end.
+        """
+        return cls.query(cls.kind == kind, cls.due_at > start,
+                         cls.due_at <= end)
+
+    @classmethod
+    def add_job(cls, job_key, scheduled_at):
+        """
+        Adds job key to its bucket. Does nothing if it is already there.
+        Runs in its own transaction, so jobs can be saved in transactions
+        of their own entity groups.
+        """
+        cls.add_jobs(cls.get_key(job_key, scheduled_at), [job_key],
+                     scheduled_at)
+
+    @classmethod
+    @ndb.transactional(propagation=ndb.TransactionOptions.INDEPENDENT)
+    def add_jobs(cls, bucket_key, job_keys, scheduled_at):
+        """
+        Adds job keys that belong to bucket_key and are due at scheduled_at
+        to the bucket in its own transaction. Keys that are already there are
+        skipped.
+        """
+        bucket = bucket_key.get()
+        if bucket is None:
+            bucket = cls(key=bucket_key, kind=job_keys[0].kind(),
+                         due_at=scheduled_at.replace(second=0, microsecond=0))
+        new_keys = [key for key in job_keys if key not in bucket.job_keys]
+        if not new_keys:
+            return
+        bucket.job_keys.extend(new_keys)
+        bucket.put()
+
+    @classmethod
+    def remove_jobs(cls, bucket_key, job_keys):
+        """
+        Removes given job keys from bucket. Deletes bucket if it is empty
+        afterwards.
+        """
+        cls.remove_jobs_async(bucket_key, job_keys).get_result()
+
+    @classmethod
+    @ndb.transactional_tasklet(
+        propagation=ndb.TransactionOptions.INDEPENDENT)
+    def remove_jobs_async(cls, bucket_key, job_keys):
+        """ Async version of remove_jobs, runs in its own transaction. """
+        bucket = yield bucket_key.get_async()
+        if bucket is None:
+            return
+        job_keys = set(job_keys)
+        bucket.job_keys = [key for key in bucket.job_keys
+                           if key not in job_keys]
+        if bucket.job_keys:
+            yield bucket.put_async()
+        else:
+            yield bucket_key.delete_async()
+
+
+class DispatchBackfill(ndb.Model):
+    """
+    Keyed by job kind. Exists once backfill_dispatch_index added all jobs of
+    the kind that were scheduled before the dispatch index existed.
+    """
+    done_at = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
 
 
-class _ScheduledJob(ndb.Model):
+class _ScheduledJob(DisplayedMixin, ndb.Model):
     queue_name = 'scheduled'
     queue_url = '/api/task/override_this'
     created_at = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
@@ -80,29 +372,123 @@ class _ScheduledJob(ndb.Model):
     user_id = ndb.StringProperty(required=True)
     user_email = ndb.StringProperty(required=True, indexed=False)
     error_cnt = ndb.IntegerProperty(indexed=False, default=0)
+    # date the job was queued at last (utc), see add_batches_to_queue.
+    queued_at = ndb.DateTimeProperty(indexed=False)
+    # version the job was saved with last, see get_write_version.
+    version = ndb.IntegerProperty()
     # state, if overwritten in child classes, choices have to include
-    # scheduled and queued
+    # scheduled, queued and sending
     state = ndb.StringProperty(required=True,
                                default='scheduled',
-                               choices=['scheduled', 'queued', 'done'])
+                               choices=['scheduled', 'queued', 'sending',
+                                        'done'])
 
     @classmethod
     def query_due(cls, time):
         """
         Returns query for scheduled tasks that are due at given datetime.
+        Only used until the dispatch index is backfilled, see
+        is_dispatch_index_complete.
         """
         return cls.query(cls.state == 'scheduled', cls.scheduled_at <= time)
 
-    @ndb.transactional
+    @classmethod
+    def is_dispatch_index_complete(cls):
+        """
+        Returns True if all scheduled jobs of this kind are in the dispatch
+        index, which is the case once backfill_dispatch_index is done.
+        """
+        return ndb.Key(DispatchBackfill, cls._get_kind()).get() is not None
+
+    @classmethod
+    def backfill_dispatch_index(cls, cursor=None,
+                                time_budget=BACKFILL_TIME_BUDGET):
+        """
+        Adds all scheduled jobs to the dispatch index, so jobs that were
+        scheduled before it existed are dispatched from it. Jobs are read in
+        pages of BACKFILL_PAGE_SIZE and added with one transaction per
+        bucket. When time_budget (seconds) runs out, the run is continued in
+        a task at cursor. Marks the index as complete when done.
+        """
+        start = time.time()
+        query = cls.query(cls.state == 'scheduled')
+        more = True
+        while more:
+            jobs, cursor, more = query.fetch_page(BACKFILL_PAGE_SIZE,
+                                                  start_cursor=cursor)
+            buckets = {}
+            for job in jobs:
+                bucket_key = DispatchBucket.get_key(job.key, job.scheduled_at)
+                buckets.setdefault(bucket_key, []).append(job)
+            for bucket_key, bucket_jobs in buckets.iteritems():
+                DispatchBucket.add_jobs(bucket_key,
+                                        [job.key for job in bucket_jobs],
+                                        bucket_jobs[0].scheduled_at)
+            if more and time.time() - start > time_budget:
+                taskqueue.add(url=BACKFILL_URL,
+                              payload=json.dumps({
+                                  'kind': cls._get_kind(),
+                                  'cursor': cursor.urlsafe()}))
+                return
+        DispatchBackfill(id=cls._get_kind()).put()
+        logging.info('dispatch index of {} is complete'.format(
+            cls._get_kind()))
+
+    def is_movable(self):
+        """ Jobs that are processed are referenced by tasks. """
+        return self.state not in ('queued', 'sending', 'sent', 'checking')
+
+    def _post_put_hook(self, future):
+        """
+        Adds job to dispatch index whenever it is saved in scheduled state.
+        Jobs put in a transaction are added once it committed, so
+        dispatchers never see an entry of a job that is not stored yet.
+        """
+        if future.get_exception() is None and self.state == 'scheduled':
+            if ndb.in_transaction():
+                key, scheduled_at = self.key, self.scheduled_at
+                ndb.get_context().call_on_commit(
+                    lambda: DispatchBucket.add_job(key, scheduled_at))
+            else:
+                DispatchBucket.add_job(self.key, self.scheduled_at)
+
+    def remove_from_dispatch_index(self, scheduled_at=None):
+        """
+        Removes job from dispatch bucket of given schedule date (defaults to
+        the current one). Used when a job is deleted or rescheduled.
+        """
+        if scheduled_at is None:
+            scheduled_at = self.scheduled_at
+        self.remove_multi_from_dispatch_index([(self, scheduled_at)])
+
+    @staticmethod
+    def remove_multi_from_dispatch_index(jobs_scheduled_ats):
+        """
+        Removes jobs of (job, scheduled_at) tuples from their dispatch
+        buckets of scheduled_at, the buckets are updated in parallel.
+        """
+        bucket_keys = {}
+        for job, scheduled_at in jobs_scheduled_ats:
+            bucket_keys.setdefault(
+                DispatchBucket.get_key(job.key, scheduled_at),
+                []).append(job.key)
+        futures = [DispatchBucket.remove_jobs_async(bucket_key, job_keys)
+                   for bucket_key, job_keys in bucket_keys.iteritems()]
+        for future in futures:
+            future.get_result()
+
+    @ndb.transactional(xg=True)
     def add_to_queue(self, url=None, target_state='queued', countdown=0):
         """
         Adds job to task queue and transactionally updates state to 'queued'
         and saves job.
-        Does nothing if state is not 'scheduled'.
+        Does nothing if the stored job is not in state 'scheduled'.
         """
-        if self.state != 'scheduled':
+        stored = self.key.get()
+        if stored is None or stored.state != 'scheduled':
             logging.warn('tried to add job {} with state {}, to queue, '
-                         'doing nothing'.format(self.key, self.state))
+                         'doing nothing'.format(
+                             self.key, stored and stored.state))
             return
         if url is None:
             url = self.queue_url
@@ -114,19 +500,403 @@ class _ScheduledJob(ndb.Model):
                       countdown=countdown,
                       transactional=True)
         self.state = target_state
-        self.put()
+        self.queued_at = datetime.datetime.utcnow()
+        self.save()
+
+    @ndb.transactional(xg=True)
+    def start_sending(self):
+        """
+        Transactionally sets state of queued job to sending and saves it.
+        Called before its mail is sent, so other tasks of the job (eg. a
+        task that was delivered twice or one added by requeue_lost_jobs)
+        leave it alone from then on. Returns False if the stored job is not
+        queued (anymore), the mail must not be sent then.
+        """
+        stored = self.key.get()
+        if stored is None or stored.state != 'queued':
+            logging.warn('job {} is {}, not sending'.format(
+                self.key, stored and stored.state))
+            return False
+        self.state = 'sending'
+        self.save()
+        return True
+
+    def get_task_name(self):
+        """
+        Deterministic name prefix of tasks that process this job since it
+        was queued last.
+        """
+        return '{}-{}-{}'.format(
+            self.key.kind(), self.key.id(),
+            (self.queued_at or self.scheduled_at).strftime('%Y%m%d%H%M%S%f'))
+
+    def build_task(self, countdown=0, name=None):
+        """
+        Returns taskqueue.Task that processes this job. Tasks that are added
+        in transactions cannot be named.
+        """
+        return taskqueue.Task(url=self.queue_url,
+                              payload=json.dumps({'key': self.key.urlsafe()}),
+                              name=name,
+                              countdown=countdown)
+
+    @classmethod
+    def build_batch_task(cls, jobs, countdown=0):
+        """
+        Returns taskqueue.Task that processes all given jobs of one user
+        with a single mail session (see api.BatchHandler). A single job gets
+        a regular task (see build_task).
+        """
+        if len(jobs) == 1:
+            return jobs[0].build_task(countdown)
+        payload = json.dumps({'keys': [job.key.urlsafe() for job in jobs]})
+        return taskqueue.Task(url=USER_BATCH_URL, payload=payload,
+                              countdown=countdown)
+
+    def add_retry_task(self, countdown=USER_BATCH_RETRY_COUNTDOWN):
+        """
+        Adds task that retries this job on its own after it failed while
+        being processed in a batch. Named by error count so every retry is
+        added at most once.
+        """
+        name = '{}-retry{:d}'.format(self.get_task_name(), self.error_cnt)
+        self._add_tasks([self.build_task(countdown, name=name)])
+
+    def get_eta(self):
+        """ Schedule date of job rounded up to whole seconds. """
+        eta = self.scheduled_at.replace(microsecond=0)
+        if eta < self.scheduled_at:
+            eta += datetime.timedelta(seconds=1)
+        return eta
+
+    def get_eta_task_name(self):
+        """ Name of eta task that dispatches this job (see add_eta_task). """
+        return '{}-{}-eta'.format(self.key.kind(),
+                                  self.get_eta().strftime('%Y%m%d%H%M%S'))
+
+    def add_eta_task(self):
+        """
+        Adds task that dispatches all jobs of this kind that are due at the
+        schedule date of this job (see dispatch_due) at that date. Jobs that
+        are due at the same second share the task, so they are queued in
+        batches per user like the enqueue cron queues them. Deleted or
+        rescheduled jobs are skipped by the task.
+        Jobs scheduled further ahead than MAX_TASK_ETA, or whose eta task
+        cannot be added, are left to the enqueue cron.
+        """
+        self.add_eta_tasks([self])
 
     @classmethod
-    def add_all_due_to_queue(cls):
+    def add_eta_tasks(cls, jobs):
         """
-        Schedules all due jobs queried by queue_due(now) to the send
-        queue.
+        Adds eta tasks of given jobs (see add_eta_task) with a single
+        taskqueue rpc.
         """
         now = datetime.datetime.utcnow()
-        for job, countdown in cls.spread_user_jobs(jobs=cls.query_due(now),
-                                                   bucket_size=10,
-                                                   bucket_margin=30):
-            job.add_to_queue(countdown=countdown)
+        # name (or payload of unnamed tasks) to task
+        tasks = {}
+        for job in jobs:
+            task = job._build_eta_task(now)
+            if task is not None:
+                tasks.setdefault(task.name or task.payload, task)
+        if not tasks:
+            return
+        try:
+            taskqueue.Queue(cls.queue_name).add(tasks.values())
+        except taskqueue.TaskAlreadyExistsError:
+            logging.debug('some eta tasks exist')
+        except taskqueue.TombstonedTaskError:
+            logging.warn('some eta tasks were run before, leaving jobs '
+                         'to cron')
+
+    def _build_eta_task(self, now):
+        """
+        Returns eta task of job (see add_eta_task) or None if it is
+        scheduled too far ahead.
+        """
+        if self.scheduled_at - now > MAX_TASK_ETA:
+            return None
+        eta = self.get_eta()
+        # the task of a past date might have run already, due jobs get one
+        # of their own.
+        name = self.get_eta_task_name() if eta > now else None
+        payload = json.dumps({'kind': self.key.kind(),
+                              'due_at': eta.isoformat()})
+        return taskqueue.Task(url=DISPATCH_URL, payload=payload, name=name,
+                              eta=eta)
+
+    @classmethod
+    def dispatch_due(cls, due_at, now=None):
+        """
+        Called by eta tasks (see add_eta_task). Adds the jobs of the
+        dispatch buckets of the minute of due_at that are due at now
+        (defaults to the current time) to the queue, in batches per user.
+        Returns number of jobs added.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        return cls._dispatch_buckets(
+            DispatchBucket.get_minute_keys(cls._get_kind(), due_at), now)
+
+    @classmethod
+    def add_batches_to_queue(cls, batches_countdowns, now=None):
+        """
+        Takes an iterable of (jobs, countdown) tuples, where jobs is a list
+        of jobs of the same user. Adds a single task for every batch
+        (see build_batch_task). Only jobs that are still scheduled and due
+        at now (defaults to the current time) when they are read again in
+        the transaction that queues them are added, so a job is queued once
+        no matter how many dispatchers see it (see _queue_batches).
+        Returns number of jobs added.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        return cls._queue_batches(
+            batches_countdowns,
+            lambda job: job.state == 'scheduled' and job.scheduled_at <= now)
+
+    @classmethod
+    def _queue_batches(cls, batches_countdowns, is_queueable):
+        """
+        Queues every (jobs, countdown) batch of batches_countdowns with
+        _queue_batch_async. Batches of a user are queued one after another,
+        those of different users in parallel. Returns number of jobs queued.
+        """
+        user_batches = {}
+        for jobs, countdown in batches_countdowns:
+            if jobs:
+                user_batches.setdefault(jobs[0].user_id, []).append(
+                    ([job.key for job in jobs], countdown))
+
+        @ndb.tasklet
+        def queue_user_async(batches):
+            cnt = 0
+            for keys, countdown in batches:
+                jobs = yield cls._queue_batch_async(keys, countdown,
+                                                    is_queueable)
+                cnt += len(jobs)
+            raise ndb.Return(cnt)
+
+        user_batches = user_batches.values()
+        cnt = 0
+        for i in xrange(0, len(user_batches), QUEUE_ADD_BATCH_SIZE):
+            futures = [queue_user_async(batches)
+                       for batches in user_batches[i:i + QUEUE_ADD_BATCH_SIZE]]
+            cnt += sum(future.get_result() for future in futures)
+        return cnt
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _queue_batch_async(cls, keys, countdown, is_queueable):
+        """
+        Reads jobs of keys, sets those is_queueable(job) returns True for to
+        queued and adds a single task for them in the same transaction. So
+        the task is added if and only if the jobs were queued by this call.
+        Returns list of queued jobs.
+        """
+        jobs = yield ndb.get_multi_async(keys)
+        jobs = [job for job in jobs if job is not None and is_queueable(job)]
+        if not jobs:
+            raise ndb.Return([])
+        queued_at = datetime.datetime.utcnow()
+        for job in jobs:
+            logging.debug(u'scheduling job {} for {}'.format(job.key,
+                                                            job.user_email))
+            job.state = 'queued'
+            job.queued_at = queued_at
+        yield Dashboard.save_multi_async(jobs)
+        yield taskqueue.Queue(cls.queue_name).add_async(
+            cls.build_batch_task(jobs, countdown), transactional=True)
+        raise ndb.Return(jobs)
+
+    @classmethod
+    def _add_tasks(cls, tasks):
+        """ Adds named tasks, ignoring those that were added before. """
+        try:
+            taskqueue.Queue(cls.queue_name).add(tasks)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            logging.info('some tasks have been added before, ignoring')
+
+    @classmethod
+    def requeue_lost_jobs(cls, now):
+        """
+        Queues jobs again whose lease (REQUEUE_AFTER since they were queued)
+        expired at now, eg. because their task ran out of retries. Only jobs
+        that are still queued, so never started sending (see start_sending),
+        are queued again, and only if they were not queued in the meantime,
+        so concurrent runs requeue a job once. Jobs stuck in sending might
+        have been sent and are only logged.
+        Returns number of jobs queued again.
+        """
+        expired = now - REQUEUE_AFTER
+        for job in cls.query(cls.state == 'sending',
+                             cls.scheduled_at <= expired):
+            if (job.queued_at or job.scheduled_at) <= expired:
+                logging.error('job {} is sending since {}, not '
+                              'requeuing'.format(job.key, job.queued_at))
+        # jobs are queued after their schedule date
+        jobs = [job for job in cls.query(cls.state == 'queued',
+                                         cls.scheduled_at <= expired)
+                if (job.queued_at or job.scheduled_at) <= expired]
+        queued_at = {job.key: job.queued_at for job in jobs}
+        return cls._queue_batches(
+            cls.spread_user_batches(jobs, batch_size=USER_BATCH_SIZE,
+                                    batch_margin=0),
+            lambda job: (job.state == 'queued' and
+                         job.queued_at == queued_at[job.key]))
+
+    @classmethod
+    def add_all_due_to_queue(cls, cursor=None, now=None,
+                             time_budget=DISPATCH_TIME_BUDGET):
+        """
+        Schedules all due jobs to the send queue. Due jobs are looked up in
+        the dispatch index, so only buckets that have come due are read.
+        Buckets are processed in pages of DISPATCH_PAGE_SIZE. When
+        time_budget (seconds) runs out, the run is continued in a task that
+        starts at the current page (see add_continuation_task).
+        Only one run per kind is active at a time (guarded by a memcache
+        lease that is handed over to continuation tasks). cursor and now
+        are used to continue a previous run. Until the dispatch index is
+        backfilled, due jobs are queried as well (see
+        backfill_dispatch_index).
+        Returns number of jobs that were added to the queue.
+        """
+        kind = cls._get_kind()
+        lease_key = 'dispatch_lease:' + kind
+        lease_time = int(time_budget * 2) + 60
+        if cursor is None:
+            if not memcache.add(lease_key, 1, time=lease_time):
+                logging.info('dispatch of {} is running, skipping'.format(kind))
+                return 0
+        else:
+            # continuation run, lease was handed over
+            memcache.set(lease_key, 1, time=lease_time)
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        start = time.time()
+        query = DispatchBucket.query_due(kind, now)
+        job_cnt = page_cnt = 0
+        more = True
+        while more:
+            bucket_keys, cursor, more = query.fetch_page(
+                DISPATCH_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+            job_cnt += cls._dispatch_buckets(bucket_keys, now)
+            page_cnt += 1
+            if more and time.time() - start > time_budget:
+                cls.add_continuation_task(cursor, now)
+                logging.info('dispatched {} {} jobs from {} pages in {:.2f}s, '
+                             'continuing in task'.format(
+                    job_cnt, kind, page_cnt, time.time() - start))
+                return job_cnt
+
+        if not cls.is_dispatch_index_complete():
+            job_cnt += cls._dispatch_unindexed(now)
+        cls.requeue_lost_jobs(now)
+        memcache.delete(lease_key)
+        logging.info('dispatched {} {} jobs from {} pages in {:.2f}s'.format(
+            job_cnt, kind, page_cnt, time.time() - start))
+        return job_cnt
+
+    @classmethod
+    def add_continuation_task(cls, cursor, now):
+        """
+        Adds task that continues add_all_due_to_queue run at given cursor.
+        Task is named by cursor, so a page is continued only once.
+        """
+        cursor = cursor.urlsafe()
+        name = 'dispatch-{}-{}'.format(
+            cls._get_kind(), hashlib.sha1(cursor).hexdigest())
+        payload = json.dumps({'kind': cls._get_kind(),
+                              'cursor': cursor,
+                              'now': now.isoformat()})
+        try:
+            taskqueue.add(url='/api/tasks/enqueue_scheduled',
+                          payload=payload, name=name)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            logging.info('continuation task {} exists'.format(name))
+
+    @classmethod
+    def _dispatch_buckets(cls, bucket_keys, now):
+        """
+        Adds jobs of given dispatch buckets that are due at now to the queue
+        and removes them and stale entries from the buckets.
+        Returns number of jobs added.
+        """
+        buckets = filter(None, ndb.get_multi(bucket_keys))
+        job_keys = list({key for bucket in buckets for key in bucket.job_keys})
+        jobs = dict(zip(job_keys, ndb.get_multi(job_keys)))
+
+        due_jobs = {}
+        # keys to remove from index per bucket key
+        consumed = {}
+        for bucket in buckets:
+            for key in bucket.job_keys:
+                job = jobs[key]
+                if (job is not None and job.state == 'scheduled' and
+                        DispatchBucket.get_key(
+                            key, job.scheduled_at) != bucket.key and
+                        job.scheduled_at < bucket.due_at and
+                        now - bucket.due_at < DISPATCH_STALE_GRACE):
+                    # job might be rescheduled to this bucket by a save that
+                    # did not commit yet, left for a later run.
+                    continue
+                if (job is None or job.state != 'scheduled' or
+                        DispatchBucket.get_key(
+                            key, job.scheduled_at) != bucket.key):
+                    # stale entry
+                    consumed.setdefault(bucket.key, []).append(key)
+                elif job.scheduled_at <= now:
+                    due_jobs[key] = job
+                    consumed.setdefault(bucket.key, []).append(key)
+
+        cnt = cls.add_batches_to_queue(cls.spread_user_batches(
+            jobs=due_jobs.values(), batch_size=USER_BATCH_SIZE,
+            batch_margin=USER_BATCH_MARGIN), now)
+
+        for bucket_key, keys in consumed.iteritems():
+            DispatchBucket.remove_jobs(bucket_key, keys)
+        return cnt
+
+    @classmethod
+    def _dispatch_unindexed(cls, now):
+        """
+        Adds all jobs that are due at now to the queue, including those that
+        are not in the dispatch index yet. Returns number of jobs added.
+        """
+        return cls.add_batches_to_queue(cls.spread_user_batches(
+            jobs=cls.query_due(now), batch_size=USER_BATCH_SIZE,
+            batch_margin=USER_BATCH_MARGIN), now)
+
+    def process(self, auth_token, mailman=None):
+        """
+        Processes queued job with given access token. Uses given mailman
+        if it is not None.
+        """
+        raise NotImplementedError()
+
+    def prewarm(self, mailman):
+        """
+        Called with an opened mailman shortly before the job is due to
+        prepare processing it (see prewarm_user).
+        """
+
+    @staticmethod
+    def spread_user_batches(jobs, batch_size, batch_margin):
+        """
+        Groups jobs by user into batches of at most batch_size jobs ordered
+        by schedule date. Yields (jobs, countdown) tuples, where
+        countdown is batch_margin seconds more for every further batch of a
+        user.
+        """
+        jobs = sorted(jobs, key=lambda j: (j.user_id, j.scheduled_at))
+        for user_id, user_jobs in itertools.groupby(jobs,
+                                                    key=lambda j: j.user_id):
+            user_jobs = list(user_jobs)
+            for num, i in enumerate(xrange(0, len(user_jobs), batch_size)):
+                yield user_jobs[i:i + batch_size], num * batch_margin
 
     @staticmethod
     def spread_user_jobs(jobs, bucket_size, bucket_margin):
@@ -149,12 +919,20 @@ class RemindJob(_ScheduledJob):
     known_message_ids = ndb.StringProperty(indexed=False, repeated=True)
     state = ndb.StringProperty(required=True,
                                default='scheduled',
-                               choices=['scheduled', 'queued', 'done',
-                                        'checking', 'disabled', 'failed'])
+                               choices=['scheduled', 'queued', 'sending',
+                                        'done', 'checking', 'disabled',
+                                        'failed'])
     disabled_reply = ndb.LocalStructuredProperty(DisabledReply, required=False)
+    # highest uid of a message in the thread (in the all mailbox) that was
+    # checked for replies and the UIDVALIDITY it belongs to.
+    last_seen_uid = ndb.IntegerProperty(indexed=False)
+    uid_validity = ndb.IntegerProperty(indexed=False)
+    # HIGHESTMODSEQ of the all mailbox when there was no reply at the last
+    # check.
+    highest_modseq = ndb.IntegerProperty(indexed=False)
 
     @classmethod
-    def query_display(cls, user_id, delta_minutes=60):
+    def query_display(cls, user_id, delta_minutes=60, parent=None):
         """
         Query all jobs that have a scheduled date for at most delta_minutes
         ago.
@@ -162,22 +940,36 @@ class RemindJob(_ScheduledJob):
         shortly_ago = datetime.datetime.utcnow() - datetime.timedelta(
             minutes=delta_minutes)
 
-        return cls.query(cls.scheduled_at >= shortly_ago,
-                         cls.state.IN(['scheduled', 'queued', 'checking',
-                                       'disabled']),
-                         cls.user_id == user_id)
+        return cls.query_user(user_id, parent,
+                              cls.scheduled_at >= shortly_ago,
+                              cls.state.IN(['scheduled', 'queued', 'sending',
+                                            'checking', 'disabled']))
+
+    def is_displayed(self, now, delta_minutes=60):
+        """ Returns True if job is matched by query_display at now. """
+        return (self.state in ('scheduled', 'queued', 'sending', 'checking',
+                               'disabled')
+                and self.scheduled_at >= now - datetime.timedelta(
+                    minutes=delta_minutes))
+
+    def process(self, auth_token, mailman=None):
+        """ See remind. """
+        self.remind(auth_token, mailman=mailman)
 
-    def remind(self, auth_token):
+    def remind(self, auth_token, mailman=None):
         """
         Sends remind mail. If only_if_noreply is true, it is only sent if
          there was no reply.
+        If an opened mailman is given it is used and left open.
         """
         if self.state != 'queued':
             logging.warning(
                 'ignoring remind call for un-queued job {}'.format(self.key))
             return
         logging.info('processing remind for job {}'.format(self.key))
-        mailman = gmail.Mailman(self.user_email, auth_token)
+        own_mailman = mailman is None
+        if own_mailman:
+            mailman = gmail.Mailman(self.user_email, auth_token)
         try:
             if self.only_if_noreply:
                 reply = self.find_reply(mailman)
@@ -187,17 +979,26 @@ class RemindJob(_ScheduledJob):
                     logging.info('reply detected, not sending reminder')
                     self.state = 'done'
                     self.disabled_reply = DisabledReply.from_gmail_dict(reply)
-                    self.put()
+                    self.save()
                     return
 
             logging.info('sending reminder')
             mail = mailnotify.build_remind_message(self)
             mail = mailman.build_reply(self.thread_id_int, mail)
-            mailman.send_mail(mail)
+            if not self.start_sending():
+                return
+            try:
+                mailman.send_mail(mail)
+            except Exception:
+                # nothing was sent, the job may be retried
+                self.state = 'queued'
+                self.save()
+                raise
             self.state = 'done'
-            self.put()
+            self.save()
         finally:
-            mailman.quit()
+            if own_mailman:
+                mailman.quit()
 
     def add_to_check_reply_queue(self):
         self.add_to_queue(url='/api/tasks/check_reply',
@@ -212,7 +1013,7 @@ class RemindJob(_ScheduledJob):
         if not self.only_if_noreply:
             logging.warn('only_if_noreply not configured, skipping')
             self.state = 'scheduled'
-            self.put()
+            self.save()
             return
         mailman = gmail.Mailman(self.user_email, auth_token)
         try:
@@ -223,21 +1024,127 @@ class RemindJob(_ScheduledJob):
             logging.info('reply found, disabling job')
             self.state = 'disabled'
             self.disabled_reply = DisabledReply.from_gmail_dict(reply)
-            self.put()
+            self.save()
         else:
             self.state = 'scheduled'
-            self.put()
+            self.save()
+
+    @classmethod
+    def query_checking(cls, user_id, parent=None):
+        """ Query jobs of user that wait for a reply check. """
+        return cls.query_user(user_id, parent, cls.state == 'checking')
+
+    @classmethod
+    def disable_replied(cls, jobs, auth_token):
+        """
+        Batch version of disable_if_replied for jobs of one user. Checks all
+        threads in one imap session (see find_replies) and saves all jobs
+        with one save_multi.
+        """
+        jobs = [job for job in jobs if job.state == 'checking']
+        if not jobs:
+            return
+        logging.info('processing disable_replied for {} jobs'.format(
+            len(jobs)))
+        to_check = [job for job in jobs if job.only_if_noreply]
+        replies = {}
+        if to_check:
+            mailman = gmail.Mailman(to_check[0].user_email, auth_token)
+            try:
+                replies = cls.find_replies(to_check, mailman)
+            finally:
+                mailman.quit()
+        for job in jobs:
+            reply = replies.get(job.key)
+            if reply is not None:
+                logging.info('reply found, disabling job {}'.format(job.key))
+                job.state = 'disabled'
+                job.disabled_reply = DisabledReply.from_gmail_dict(reply)
+            else:
+                job.state = 'scheduled'
+        Dashboard.save_multi(jobs)
 
     def find_reply(self, mailman):
         """
         Checks if there was a reply. It loads the list of message ids in the
         thread and compares them to the known message ids when the reminder
         was scheduled.
+        Only messages newer than the last checked message are loaded. The
+        thread is not loaded at all if the all mailbox did not change since
+        the last check. If there was no reply, last_seen_uid and
+        highest_modseq are updated (but not saved).
         Returns first unknown message in thread or None if there was no reply.
         """
         logging.debug('checking for replies in thread {}, job: {}'.format(
             self.thread_id_int, self.key.id()))
-        msgs = mailman.get_thread(self.thread_id_int)
+        status = mailman.get_all_box_status()
+        if self._mailbox_unchanged(status):
+            return None
+        metrics.incr(metrics.THREAD_FETCHES)
+        msgs = mailman.get_thread(self.thread_id_int,
+                                  since_uid=self.last_seen_uid,
+                                  uid_validity=self.uid_validity)
+        return self._reply_in_thread(msgs, status)
+
+    @classmethod
+    def find_replies(cls, jobs, mailman):
+        """
+        Batch version of find_reply for jobs of one user. Threads of all jobs
+        are searched and fetched at once, so the number of imap commands
+        does not grow with the number of jobs.
+        Returns dict of job key to first unknown message in its thread or
+        None if there was no reply.
+        """
+        status = mailman.get_all_box_status()
+        replies = {}
+        to_check = []
+        for job in jobs:
+            if job._mailbox_unchanged(status):
+                replies[job.key] = None
+            else:
+                to_check.append(job)
+        if not to_check:
+            return replies
+        metrics.incr(metrics.THREAD_FETCHES, len(to_check))
+        # only load messages newer than the oldest mark if all marks are
+        # comparable
+        since_uid = uid_validity = None
+        if (all(job.last_seen_uid is not None for job in to_check) and
+                len(set(job.uid_validity for job in to_check)) == 1):
+            since_uid = min(job.last_seen_uid for job in to_check)
+            uid_validity = to_check[0].uid_validity
+        threads = mailman.get_threads(
+            set(job.thread_id_int for job in to_check),
+            since_uid=since_uid, uid_validity=uid_validity)
+        for job in to_check:
+            msgs = threads.get(job.thread_id_int, [])
+            if job.last_seen_uid is not None:
+                msgs = [msg for msg in msgs
+                        if msg.get('uid_validity') != job.uid_validity or
+                        msg['uid'] > job.last_seen_uid]
+            replies[job.key] = job._reply_in_thread(msgs, status)
+        return replies
+
+    def _mailbox_unchanged(self, status):
+        """
+        Returns True if the all mailbox did not change since the last check
+        without reply, according to given mailbox status (see
+        gmail.IMAPSession.get_all_box_status).
+        """
+        modseq = status.get('HIGHESTMODSEQ')
+        if (modseq is not None and modseq == self.highest_modseq and
+                status.get('UIDVALIDITY') == self.uid_validity):
+            logging.debug('mailbox unchanged, no reply for {}'.format(
+                self.key))
+            metrics.incr(metrics.THREAD_FETCHES_AVOIDED)
+            return True
+        return False
+
+    def _reply_in_thread(self, msgs, status):
+        """
+        Returns first message in msgs that is not known or None. Updates
+        last_seen_uid and highest_modseq if there is none.
+        """
         known_ids = set(self.known_message_ids)
         for msg in msgs:
             msg_id = msg['message_id']
@@ -245,8 +1152,26 @@ class RemindJob(_ScheduledJob):
                 logging.debug('reply found: ' + msg_id)
                 return msg
         logging.debug('no reply found')
+        self.update_last_seen(msgs)
+        if self.uid_validity is None:
+            self.uid_validity = status.get('UIDVALIDITY')
+        if status.get('UIDVALIDITY') == self.uid_validity:
+            self.highest_modseq = status.get('HIGHESTMODSEQ')
         return None
 
+    def update_last_seen(self, msgs):
+        """
+        Sets last_seen_uid to the highest uid of given messages of the thread.
+        """
+        uids = [msg['uid'] for msg in msgs if msg.get('uid') is not None]
+        if not uids:
+            return
+        uid_validity = msgs[0].get('uid_validity')
+        if uid_validity != self.uid_validity:
+            self.last_seen_uid = None
+        self.uid_validity = uid_validity
+        self.last_seen_uid = max(uids + [self.last_seen_uid or 0])
+
     @property
     def thread_id_int(self):
         """ Thread id as integer. """
@@ -260,28 +1185,45 @@ class SendJob(_ScheduledJob):
     # state
     state = ndb.StringProperty(required=True,
                                default='scheduled',
-                               choices=['scheduled', 'queued', 'sent',
-                                        'done', 'failed'])
+                               choices=['scheduled', 'queued', 'sending',
+                                        'sent', 'done', 'failed'])
     subject = ndb.StringProperty(indexed=False)
     sent_mail_rfc_id = ndb.StringProperty(indexed=False)
 
     @classmethod
-    def query_display(cls, user_id, delta_minutes=60):
+    def query_display(cls, user_id, delta_minutes=60, parent=None):
         """
-        Query all jobs that have state scheduled, queued or sent (but not done)
-        OR are done and have been scheduled for no longer than delta_minutes
-        ago.
+        Query all jobs that have state scheduled, queued, sending or sent (but
+        not done) OR are done and have been scheduled for no longer than
+        delta_minutes ago.
         """
         shortly_ago = datetime.datetime.utcnow() - datetime.timedelta(
             minutes=delta_minutes)
 
         # query all jobs that are
-        return cls.query(ndb.OR(cls.state.IN(['scheduled', 'queued', 'sent']),
-                                ndb.AND(cls.scheduled_at >= shortly_ago,
-                                        cls.state == 'done')),
-                         cls.user_id == user_id)
+        return cls.query_user(
+            user_id, parent,
+            ndb.OR(cls.state.IN(['scheduled', 'queued', 'sending', 'sent']),
+                   ndb.AND(cls.scheduled_at >= shortly_ago,
+                           cls.state == 'done')))
 
-    def send_mail(self, auth_token):
+    def is_displayed(self, now, delta_minutes=60):
+        """ Returns True if job is matched by query_display at now. """
+        if self.state in ('scheduled', 'queued', 'sending', 'sent'):
+            return True
+        return (self.state == 'done' and self.scheduled_at >=
+                now - datetime.timedelta(minutes=delta_minutes))
+
+    def process(self, auth_token, mailman=None):
+        """ See send_mail. """
+        self.send_mail(auth_token, mailman=mailman)
+
+    def prewarm(self, mailman):
+        """ Prefetches the draft, so send_mail does not have to fetch it. """
+        if PREFETCH_DRAFTS:
+            mailman.prefetch_draft(self.message_id_int, get_prefetch_secret())
+
+    def send_mail(self, auth_token, mailman=None):
         """
         Sends mail in to steps (sending, and marking as sent)
         that both can fail and be retried
@@ -289,23 +1231,41 @@ class SendJob(_ScheduledJob):
         that lead to double sendings.
         The mail is guranteed to have been sent when state is sent or done.
         It is guranteed to have been marked as sent when state equals 'done'.
+        The job is moved to state sending before the mail is sent (see
+        start_sending), so it is sent by one task only. Jobs that are left
+        in sending are never sent again.
+        If an opened mailman is given it is used and left open.
         """
         logging.debug('send_mail called mail: {}, job:{}'.format(
             self.message_id, self.key.id()))
 
-        mailman = gmail.Mailman(self.user_email, auth_token)
+        own_mailman = mailman is None
+        if own_mailman:
+            mailman = gmail.Mailman(self.user_email, auth_token)
         mail = None
 
         try:
             # step 1, send mail
             if self.state == 'queued':
-                logging.debug('sending mail')
                 self.sent_mail_rfc_id = gmail.make_message_id()
-                mail = mailman.send_draft(self.message_id_int,
-                                          self.sent_mail_rfc_id)
+                if not self.start_sending():
+                    return
+                logging.debug('sending mail')
+                prefetch_secret = None
+                if PREFETCH_DRAFTS:
+                    prefetch_secret = get_prefetch_secret()
+                try:
+                    mail = mailman.send_draft(self.message_id_int,
+                                              self.sent_mail_rfc_id,
+                                              prefetch_secret=prefetch_secret)
+                except Exception:
+                    # nothing was sent, the job may be retried
+                    self.state = 'queued'
+                    self.save()
+                    raise
                 logging.debug('mail was sent ' + self.sent_mail_rfc_id)
                 self.state = 'sent'
-                self.put()
+                self.save()
 
             # step 2, move to sent folder
             if self.state == 'sent':
@@ -319,15 +1279,613 @@ class SendJob(_ScheduledJob):
                 except gmail.MailNotFound:
                     logging.debug('mail not found, ignoring')
                 self.state = 'done'
-                self.put()
+                self.save()
         finally:
-            mailman.quit()
+            if own_mailman:
+                mailman.quit()
 
     @property
     def message_id_int(self):
         return int(self.message_id, 16)
 
 
+class Dashboard(ndb.Model):
+    """
+    Denormalized copies of the displayed jobs and snippets of a user, keyed
+    by user_id, so /api/init is a single get. Updated after the jobs and
+    snippets were written (see save_multi).
+    Dashboards are incomplete if entities of the user were written before
+    the dashboard existed or if they do not fit. get_displayed_async
+    rebuilds them from queries.
+    """
+    # zlib compressed pickle of the list of displayed entities
+    data = ndb.BlobProperty()
+    # False if data does not hold all displayed entities of the user
+    complete = ndb.BooleanProperty(default=False, indexed=False)
+    # increased on every write, at least to the versions of the written
+    # jobs (see get_write_version)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    updated_at = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @classmethod
+    def get_key(cls, user_id):
+        """ Get Key by given user id """
+        return ndb.Key(cls, user_id)
+
+    def get_entities(self):
+        """ Returns dict of key to entity of all entities in data. """
+        if not self.data:
+            return {}
+        return {entity.key: entity
+                for entity in pickle.loads(zlib.decompress(self.data))}
+
+    def set_entities(self, entities, now):
+        """
+        Stores given entities that are displayed at now in data. Drops data
+        and marks dashboard as incomplete if they are bigger than
+        DASHBOARD_MAX_SIZE.
+        """
+        data = zlib.compress(pickle.dumps(
+            [entity for entity in entities if entity.is_displayed(now)],
+            pickle.HIGHEST_PROTOCOL))
+        self.complete = len(data) <= DASHBOARD_MAX_SIZE
+        self.data = data if self.complete else None
+
+    @classmethod
+    @ndb.tasklet
+    def get_displayed_async(cls, user_id, now=None):
+        """
+        Returns (entities, version) tuple of the jobs and snippets of user
+        that are displayed at now, ordered by key, and the version of the
+        dashboard they are at least as new as (see get_changes). They are
+        read from the dashboard of the user, which is rebuilt from queries
+        if it is missing or incomplete.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        dashboard = yield cls.get_key(user_id).get_async()
+        version = dashboard.version if dashboard is not None else 0
+        if dashboard is not None and dashboard.complete:
+            entities = dashboard.get_entities().values()
+        else:
+            entities = yield cls._rebuild_async(user_id, dashboard, now)
+        entities = sorted(
+            (entity for entity in entities if entity.is_displayed(now)),
+            key=lambda entity: entity.key.pairs())
+        raise ndb.Return((entities, version))
+
+    @classmethod
+    def get_changes(cls, user_id, since, now=None):
+        """
+        Returns (jobs, version) tuple of the jobs of user that were saved
+        after dashboard version since and the version the next call should
+        pass as since. Only the dashboard is read if nothing changed.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        dashboard = cls.get_key(user_id).get()
+        if dashboard is None or dashboard.version <= since:
+            return [], since
+        futures = [fetch_user_entities_async(
+            user_id, lambda user_id, parent, job_cls=job_cls:
+            job_cls.query_user(user_id, parent, job_cls.version > since))
+            for job_cls in (SendJob, RemindJob)]
+        jobs = [job for future in futures for job in future.get_result()]
+        if dashboard.updated_at <= now - CHANGES_SETTLE_TIME:
+            since = dashboard.version
+        return jobs, since
+
+    @classmethod
+    @ndb.tasklet
+    def _rebuild_async(cls, user_id, dashboard, now):
+        """
+        Queries displayed entities of user and stores them as its dashboard,
+        unless dashboard (the one that was read before, may be None) was
+        written shortly before. Returns queried entities.
+        """
+        results = yield [
+            fetch_user_entities_async(user_id, entity_cls.query_display)
+            for entity_cls in (SendJob, RemindJob, Snippet)]
+        entities = [entity for result in results for entity in result]
+        if dashboard is None:
+            yield cls._store_rebuilt_async(user_id, 0, entities, now)
+        elif dashboard.updated_at <= now - DASHBOARD_REBUILD_DELAY:
+            yield cls._store_rebuilt_async(user_id, dashboard.version,
+                                           entities, now)
+        raise ndb.Return(entities)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _store_rebuilt_async(cls, user_id, version, entities, now):
+        """
+        Stores given entities as complete dashboard of user if its version
+        still equals version (the queries might have missed later writes)
+        and they fit.
+        """
+        key = cls.get_key(user_id)
+        dashboard = yield key.get_async()
+        if dashboard is None:
+            dashboard = cls(key=key)
+        if dashboard.version != version:
+            logging.info('dashboard of {} changed while rebuilding'.format(
+                user_id))
+            return
+        # keeps version, it only changes when the data of user changed
+        # (see get_version).
+        dashboard.set_entities(entities, now)
+        if dashboard.complete:
+            yield dashboard.put_async()
+        else:
+            logging.warn('dashboard of {} is too big'.format(user_id))
+
+    @classmethod
+    def save_multi(cls, entities=(), deleted=()):
+        """
+        Puts given jobs and snippets and deletes deleted ones. Entities of a
+        user are written in chunks that fit a transaction, entities of
+        different users in parallel. Jobs are stamped with a new version
+        (see get_write_version). The dashboards of their users are updated
+        and the jobs are pushed to their open clients after the writes
+        committed (see _update_async), so writing jobs does not contend on
+        the dashboard of their user. Called in a
+        transaction, entities are written in it and the dashboards are
+        updated once it committed.
+        """
+        cls.save_multi_async(entities, deleted).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def save_multi_async(cls, entities=(), deleted=()):
+        """ Async version of save_multi. """
+        changes = {}
+        for entity in entities:
+            changes.setdefault(entity.user_id, []).append((entity, False))
+        for entity in deleted:
+            changes.setdefault(entity.user_id, []).append((entity, True))
+        yield [cls._save_user_async(user_id, user_changes)
+               for user_id, user_changes in changes.iteritems()]
+
+    @classmethod
+    @ndb.tasklet
+    def _save_user_async(cls, user_id, changes):
+        """
+        Writes changes, list of (entity, deleted) tuples, of a single user
+        in chunks of transactions and updates the dashboard of user
+        afterwards. Entities of accounts that are not in the root layout
+        are re-keyed under the account (see _move_to_account).
+        """
+        layout = yield get_layout_async(user_id)
+        # lists of entities to put and keys to delete that are written in
+        # the same transaction.
+        units = []
+        # (entity, old key) tuples of re-keyed entities
+        moved = []
+        for entity, deleted in changes:
+            if deleted:
+                units.append([entity.key])
+            elif layout == LAYOUT_ROOT:
+                units.append([entity])
+            else:
+                old_keys = _move_to_account(entity)
+                moved.extend((entity, old_key) for old_key in old_keys)
+                units.append([entity] + old_keys)
+        chunks = [[]]
+        for unit in units:
+            if len(chunks[-1]) + len(unit) > XG_MAX_ENTITY_GROUPS:
+                chunks.append([])
+            chunks[-1].extend(unit)
+        in_transaction = ndb.in_transaction()
+        try:
+            for chunk in chunks:
+                if chunk:
+                    yield cls._write_chunk_async(chunk)
+        except Exception:
+            # saving them again has to move them again
+            for entity, old_key in moved:
+                entity.key = old_key
+            raise
+        writes = [write for chunk in chunks for write in chunk]
+        if in_transaction:
+            ndb.get_context().call_on_commit(
+                lambda: cls._update_async(user_id, writes,
+                                          moved).get_result())
+        else:
+            yield cls._update_async(user_id, writes, moved)
+
+    @classmethod
+    def move_to_account(cls, user_id, keys):
+        """
+        Re-keys root entities of keys under the account of user (see
+        _move_to_account). Entities are read again in the transactions that
+        move them.
+        """
+        # the account takes one entity group
+        chunk_size = XG_MAX_ENTITY_GROUPS - 1
+        for i in xrange(0, len(keys), chunk_size):
+            writes, moved = cls._move_chunk_async(
+                keys[i:i + chunk_size]).get_result()
+            if writes:
+                cls._update_async(user_id, writes, moved).get_result()
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _move_chunk_async(cls, keys):
+        """
+        Moves movable entities of keys in a transaction. Returns (writes,
+        moved) tuple, see _write_chunk_async and _update_async.
+        """
+        entities = yield ndb.get_multi_async(keys)
+        writes = []
+        moved = []
+        for entity in entities:
+            if entity is not None and entity.is_movable():
+                old_keys = _move_to_account(entity)
+                writes.append(entity)
+                writes.extend(old_keys)
+                moved.extend((entity, old_key) for old_key in old_keys)
+        if writes:
+            yield cls._write_chunk_async(writes)
+        raise ndb.Return((writes, moved))
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _write_chunk_async(cls, writes):
+        """
+        Puts entities and deletes keys in writes in a transaction. Jobs are
+        stamped with a new version on every attempt, so it is as close to
+        the commit as possible.
+        """
+        puts = [write for write in writes if not isinstance(write, ndb.Key)]
+        version = get_write_version()
+        for entity in puts:
+            if isinstance(entity, _ScheduledJob):
+                entity.version = version
+        delete_keys = [write for write in writes if isinstance(write, ndb.Key)]
+        yield (ndb.put_multi_async(puts) +
+               ndb.delete_multi_async(delete_keys))
+
+    @classmethod
+    @ndb.tasklet
+    def _update_async(cls, user_id, writes, moved=()):
+        """
+        Applies committed writes (see _write_chunk_async) to the dashboard
+        of user and pushes the written jobs to its open clients in a task
+        (see push.publish_async). Moved, (entity, old key) tuples of
+        entities that were re-keyed by the writes, are removed from the
+        dispatch index (see _unindex_moved_async). Called after the writes
+        committed, so it must not fail: if the dashboard can't be updated, a
+        task invalidates it (see invalidate) and it is rebuilt the next time
+        it is read.
+        """
+        try:
+            version = yield cls._store_update_async(user_id, writes)
+            yield cls._cache_version_async(user_id, version)
+        except Exception:
+            logging.warning('updating dashboard of {} failed'.format(
+                user_id), exc_info=True)
+            try:
+                taskqueue.add(url=DASHBOARD_INVALIDATE_URL,
+                              payload=json.dumps({'user_id': user_id}))
+            except Exception:
+                logging.error('dashboard of {} is outdated'.format(user_id),
+                              exc_info=True)
+        jobs = [write for write in writes if isinstance(write, _ScheduledJob)]
+        if jobs:
+            try:
+                client_ids = yield push.get_client_ids_async(user_id)
+                if client_ids:
+                    yield push.publish_async(user_id, json.dumps(
+                        group_jobs(jobs), cls=JSONEncoder))
+            except Exception:
+                logging.warning('publishing jobs of {} failed'.format(
+                    user_id), exc_info=True)
+        if moved:
+            try:
+                yield _unindex_moved_async(moved)
+            except Exception:
+                # dispatchers skip stale entries
+                logging.warning('removing moved jobs of {} from dispatch '
+                                'index failed'.format(user_id), exc_info=True)
+
+    @classmethod
+    @ndb.transactional_tasklet(
+        propagation=ndb.TransactionOptions.INDEPENDENT)
+    def _store_update_async(cls, user_id, writes):
+        """
+        Applies writes to the dashboard of user. Returns its new version.
+        """
+        key = cls.get_key(user_id)
+        dashboard = yield key.get_async()
+        if dashboard is None:
+            # entities written before are unknown
+            dashboard = cls(key=key)
+        puts = [write for write in writes if not isinstance(write, ndb.Key)]
+        # also makes running rebuilds discard their results
+        dashboard.version = max(
+            [dashboard.version + 1] +
+            [entity.version for entity in puts
+             if isinstance(entity, _ScheduledJob)])
+        if dashboard.complete:
+            entities = dashboard.get_entities()
+            for write in writes:
+                if isinstance(write, ndb.Key):
+                    entities.pop(write, None)
+            for entity in puts:
+                # updates of concurrent writes may arrive out of order
+                stored = entities.get(entity.key)
+                if (isinstance(stored, _ScheduledJob) and
+                        stored.version > entity.version):
+                    continue
+                entities[entity.key] = entity
+            dashboard.set_entities(entities.values(),
+                                   datetime.datetime.utcnow())
+        yield dashboard.put_async()
+        raise ndb.Return(dashboard.version)
+
+    @classmethod
+    def get_version(cls, user_id):
+        """
+        Returns version of the dashboard of user, 0 if there is none. It
+        changes after every committed write of jobs, snippets or the
+        account of user. The version is read through memcache, writers
+        cache the committed version (see _cache_version_async).
+        """
+        cache_key = _get_dashboard_version_cache_key(user_id)
+        version = memcache.get(cache_key)
+        if version is None:
+            dashboard = cls.get_key(user_id).get()
+            version = dashboard.version if dashboard is not None else 0
+            # does not replace a version cached by a later write
+            memcache.add(cache_key, version,
+                         time=DASHBOARD_VERSION_CACHE_TIME)
+        return version
+
+    @classmethod
+    @ndb.tasklet
+    def _cache_version_async(cls, user_id, version):
+        """
+        Raises the cached version of the dashboard of user to version,
+        which was committed. Cached versions only increase, so updates that
+        arrive out of order do not cache an older one. The cached version
+        is deleted if it can't be raised, it must not fail.
+        """
+        ctx = ndb.get_context()
+        cache_key = _get_dashboard_version_cache_key(user_id)
+        try:
+            for _ in xrange(DASHBOARD_VERSION_CACHE_RETRIES):
+                cached = yield ctx.memcache_get(cache_key, for_cas=True)
+                if cached is not None and cached >= version:
+                    return
+                if cached is None:
+                    stored = yield ctx.memcache_add(
+                        cache_key, version, time=DASHBOARD_VERSION_CACHE_TIME)
+                else:
+                    stored = yield ctx.memcache_cas(
+                        cache_key, version, time=DASHBOARD_VERSION_CACHE_TIME)
+                if stored:
+                    return
+            yield ctx.memcache_delete(cache_key)
+        except Exception:
+            logging.error('cached dashboard version of {} is outdated'.format(
+                user_id), exc_info=True)
+
+    @classmethod
+    @ndb.transactional
+    def bump_version(cls, user_id):
+        """
+        Increases version of the dashboard of user after other data than
+        jobs and snippets (eg. the account) changed. Creates an incomplete
+        dashboard if it is missing.
+        """
+        key = cls.get_key(user_id)
+        dashboard = key.get() or cls(key=key)
+        dashboard.version = max(dashboard.version + 1, get_write_version())
+        dashboard.put()
+        version = dashboard.version
+        ndb.get_context().call_on_commit(
+            lambda: cls._cache_version_async(user_id, version).get_result())
+
+    @classmethod
+    @ndb.transactional
+    def invalidate(cls, user_id):
+        """
+        Marks dashboard of user as incomplete, so it is rebuilt from queries
+        when it is read next time.
+        """
+        dashboard = cls.get_key(user_id).get()
+        if dashboard is None:
+            return
+        dashboard.version = max(dashboard.version + 1, get_write_version())
+        dashboard.complete = False
+        dashboard.data = None
+        dashboard.put()
+        version = dashboard.version
+        ndb.get_context().call_on_commit(
+            lambda: cls._cache_version_async(user_id, version).get_result())
+
+
+def _get_dashboard_version_cache_key(user_id):
+    return 'dashboard_version:' + user_id
+
+
+def get_write_version():
+    """
+    Returns version jobs written now are stamped with (see
+    Dashboard.save_multi): microseconds since the epoch, so it does not
+    depend on reading the dashboard. Writers that take longer than
+    CHANGES_SETTLE_TIME from stamping to updating the dashboard might be
+    missed by Dashboard.get_changes.
+    """
+    return int(time.time() * 1000000)
+
+
+@ndb.tasklet
+def get_layout_async(user_id):
+    """ Returns layout of the jobs and snippets of user. """
+    account = yield Account.get_key(user_id).get_async()
+    if account is None:
+        raise ndb.Return(LAYOUT_ROOT)
+    raise ndb.Return(account.layout)
+
+
+def _get_read_parents(user_id, layout):
+    """
+    Returns parent keys (None for root entities) to read entities of user
+    with layout from. While migrating, root entities come first: entities
+    that exist in both places were saved by a writer that saw the root
+    layout after they were moved.
+    """
+    account_key = Account.get_key(user_id)
+    return {LAYOUT_ROOT: [None],
+            LAYOUT_MIGRATING: [None, account_key],
+            LAYOUT_ANCESTOR: [account_key]}[layout]
+
+
+@ndb.tasklet
+def fetch_user_entities_async(user_id, query_fn, **options):
+    """
+    Fetches entities of user with the queries query_fn(user_id, parent)
+    returns for the parents of the layout of user (see query_user).
+    Entities found in both places are returned once.
+    """
+    layout = yield get_layout_async(user_id)
+    results = yield [query_fn(user_id, parent=parent).fetch_async(**options)
+                     for parent in _get_read_parents(user_id, layout)]
+    entities = []
+    seen = set()
+    for entity in itertools.chain(*results):
+        if entity.key.id() not in seen:
+            seen.add(entity.key.id())
+            entities.append(entity)
+    raise ndb.Return(entities)
+
+
+def _move_to_account(entity):
+    """
+    Re-keys new and movable root entity under the account of its user,
+    keeping its id. Returns list of the old key if it was moved.
+    """
+    account_key = Account.get_key(entity.user_id)
+    if entity.key is None:
+        entity.key = ndb.Key(entity._get_kind(), None, parent=account_key)
+    elif entity.key.parent() is None and entity.is_movable():
+        old_key = entity.key
+        entity.key = ndb.Key(entity._get_kind(), old_key.id(),
+                             parent=account_key)
+        return [old_key]
+    return []
+
+
+@ndb.tasklet
+def _unindex_moved_async(moved):
+    """
+    Removes the old keys of scheduled jobs of moved, (job, old key) tuples
+    of jobs that were re-keyed by _move_to_account, from the dispatch index.
+    Their new keys were added when they were put (see
+    _ScheduledJob._post_put_hook), so the index holds each of them once.
+    Called once the move committed, a rolled back move keeps its entries.
+    """
+    bucket_keys = {}
+    for job, old_key in moved:
+        if isinstance(job, _ScheduledJob) and job.state == 'scheduled':
+            bucket_keys.setdefault(
+                DispatchBucket.get_key(old_key, job.scheduled_at),
+                []).append(old_key)
+    yield [DispatchBucket.remove_jobs_async(bucket_key, job_keys)
+           for bucket_key, job_keys in bucket_keys.iteritems()]
+
+
+def add_migrate_layout_tasks(cursor=None):
+    """
+    Adds a migrate_layout task for every account on a page of accounts
+    starting at cursor and a task that continues with the next page.
+    """
+    keys, cursor, more = Account.query().fetch_page(
+        QUEUE_ADD_BATCH_SIZE - 1, start_cursor=cursor, keys_only=True)
+    tasks = [taskqueue.Task(url=MIGRATE_LAYOUT_URL,
+                            payload=json.dumps({'user_id': key.id()}))
+             for key in keys]
+    if more:
+        tasks.append(taskqueue.Task(
+            url=MIGRATE_LAYOUT_URL,
+            payload=json.dumps({'cursor': cursor.urlsafe()})))
+    if tasks:
+        taskqueue.Queue().add(tasks)
+
+
+def _add_migrate_layout_task(user_id, countdown=0, **state):
+    state['user_id'] = user_id
+    if state.get('cursor') is not None:
+        state['cursor'] = state['cursor'].urlsafe()
+    taskqueue.add(url=MIGRATE_LAYOUT_URL, payload=json.dumps(state),
+                  countdown=countdown)
+
+
+@ndb.transactional
+def _switch_layout(user_id, old_layout, new_layout):
+    """
+    Sets layout of account of user to new_layout if it is old_layout.
+    Returns layout of the account or None if there is no account.
+    """
+    account = Account.get_key(user_id).get()
+    if account is None:
+        return None
+    if account.layout == old_layout:
+        account.layout = new_layout
+        account.put()
+    return account.layout
+
+
+def migrate_layout(user_id, kind=None, cursor=None, found=0, passes=0,
+                   time_budget=MIGRATE_TIME_BUDGET):
+    """
+    Moves jobs and snippets of user under its account. Switches the account
+    to the migrating layout first: readers read both places and every save
+    moves the saved entity from then on. Then passes over all root entities
+    of user and moves them. Passes are repeated every MIGRATE_PASS_DELAY
+    until one finds no root entity, then readers are switched to the
+    ancestor layout.
+    A pass that runs out of time_budget (seconds) is continued in a task at
+    kind and cursor, found is the number of root entities found by the
+    pass so far and passes the number of passes before.
+    """
+    if _switch_layout(user_id, LAYOUT_ROOT, LAYOUT_MIGRATING) != \
+            LAYOUT_MIGRATING:
+        return
+    start = time.time()
+    entity_classes = [SendJob, RemindJob, Snippet]
+    if kind is not None:
+        entity_classes = entity_classes[
+            [entity_cls._get_kind() for entity_cls in entity_classes].index(
+                kind):]
+    for entity_cls in entity_classes:
+        # children of the account match as well
+        query = entity_cls.query(entity_cls.user_id == user_id)
+        more = True
+        while more:
+            keys, cursor, more = query.fetch_page(
+                MIGRATE_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+            root_keys = [key for key in keys if key.parent() is None]
+            found += len(root_keys)
+            Dashboard.move_to_account(user_id, root_keys)
+            if more and time.time() - start > time_budget:
+                _add_migrate_layout_task(user_id,
+                                         kind=entity_cls._get_kind(),
+                                         cursor=cursor, found=found,
+                                         passes=passes)
+                return
+        cursor = None
+    if not found:
+        _switch_layout(user_id, LAYOUT_MIGRATING, LAYOUT_ANCESTOR)
+        logging.info('moved entities of {} under account'.format(user_id))
+    elif passes + 1 >= MIGRATE_MAX_PASSES:
+        logging.warn('{} root entities of {} left after {} passes'.format(
+            found, user_id, passes + 1))
+    else:
+        _add_migrate_layout_task(user_id, countdown=MIGRATE_PASS_DELAY,
+                                 passes=passes + 1)
+
+
 @ndb.tasklet
 def get_credentials_async(user_id):
     """ Get oauth credentials by user_id asynchronously """
@@ -344,3 +1902,257 @@ def get_credentials(user_id):
     return get_credentials_async(user_id).get_result()
 
 
+def _get_access_token_cache_key(user_id):
+    return 'access_token:' + user_id
+
+
+def _get_cached_access_token(user_id):
+    """
+    Returns access token of user from in process cache or memcache or None
+    if there is none that is valid for at least ACCESS_TOKEN_EXPIRY_MARGIN.
+    """
+    access_token = access_token_cache.get(user_id)
+    if access_token is None:
+        cached = memcache.get(_get_access_token_cache_key(user_id))
+        if cached is None:
+            return None
+        access_token, expires_at = cached
+        ttl = expires_at - ACCESS_TOKEN_EXPIRY_MARGIN - time.time()
+        if ttl <= 0:
+            return None
+        access_token_cache.set(user_id, access_token, ttl=ttl)
+    return access_token
+
+
+def _cache_access_token(user_id, credentials):
+    if credentials.token_expiry is None:
+        # validity is unknown
+        return
+    expires_at = calendar.timegm(credentials.token_expiry.utctimetuple())
+    ttl = int(expires_at - ACCESS_TOKEN_EXPIRY_MARGIN - time.time())
+    if ttl <= 0:
+        return
+    access_token_cache.set(user_id, credentials.access_token, ttl=ttl)
+    memcache.set(_get_access_token_cache_key(user_id),
+                 (credentials.access_token, expires_at), time=ttl)
+
+
+class _PendingRefresh(object):
+    """ Refresh of an access token that concurrent requests wait for. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.access_token = None
+        self.error = None
+
+
+def _refresh_access_token(user_id):
+    """
+    Refreshes access token of user and caches it. Returns None if there are
+    no credentials stored for the user.
+    """
+    credentials = get_credentials(user_id)
+    if not credentials:
+        return None
+    logging.debug('refreshing oauth token')
+    start = time.time()
+    try:
+        credentials.refresh(httplib2.Http())
+    finally:
+        metrics.incr(metrics.ACCESS_TOKEN_REFRESHES)
+        metrics.incr(metrics.ACCESS_TOKEN_REFRESH_MS,
+                     int((time.time() - start) * 1000))
+    _cache_access_token(user_id, credentials)
+    return credentials.access_token
+
+
+def get_access_token(user_id):
+    """
+    Returns valid oauth access token of user or None if there are no
+    credentials stored for the user. Tokens are cached until shortly before
+    they expire, concurrent requests of this instance for the same user
+    wait for a single refresh. No lock is held while refreshing, so
+    requests of other users are never blocked by it.
+    Raises AccessTokenRefreshError if refreshing the token failed.
+    """
+    access_token = _get_cached_access_token(user_id)
+    if access_token is not None:
+        metrics.incr(metrics.ACCESS_TOKEN_CACHE_HITS)
+        return access_token
+    with _refresh_lock:
+        pending = _pending_refreshes.get(user_id)
+        is_refreshing = pending is None
+        if is_refreshing:
+            pending = _pending_refreshes[user_id] = _PendingRefresh()
+    if not is_refreshing:
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        metrics.incr(metrics.ACCESS_TOKEN_CACHE_HITS)
+        return pending.access_token
+    try:
+        # a refresh might have finished since the cache was checked
+        pending.access_token = _get_cached_access_token(user_id)
+        if pending.access_token is None:
+            pending.access_token = _refresh_access_token(user_id)
+        else:
+            metrics.incr(metrics.ACCESS_TOKEN_CACHE_HITS)
+    except Exception, err:
+        pending.error = err
+        raise
+    finally:
+        with _refresh_lock:
+            del _pending_refreshes[user_id]
+        pending.done.set()
+    return pending.access_token
+
+
+def invalidate_access_token(user_id):
+    """
+    Removes cached access token of user, eg. if it was rejected by the mail
+    server.
+    """
+    access_token_cache.delete(user_id)
+    memcache.delete(_get_access_token_cache_key(user_id))
+
+
+def add_prewarm_tasks(now=None):
+    """
+    Adds a task for every user with jobs that are due in about
+    PREWARM_LOOKAHEAD that calls prewarm_user. Reads the dispatch buckets of
+    the two minutes before the end of the lookahead window, tasks are named
+    by user and minute, so consecutive cron runs add them once.
+    Returns number of tasks added.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    end = now + PREWARM_LOOKAHEAD
+    start = end - datetime.timedelta(minutes=2)
+    buckets = [bucket for cls in (SendJob, RemindJob)
+               for bucket in DispatchBucket.query_due_between(
+                   cls._get_kind(), start, end).fetch()]
+    job_keys = list({key for bucket in buckets for key in bucket.job_keys})
+    jobs = dict(zip(job_keys, ndb.get_multi(job_keys)))
+    # (user_id, due minute) to keys of jobs
+    user_keys = {}
+    for bucket in buckets:
+        for key in bucket.job_keys:
+            job = jobs[key]
+            if job is None or job.state != 'scheduled':
+                continue
+            user_keys.setdefault((job.user_id, bucket.due_at), []).append(key)
+    tasks = []
+    for (user_id, due_at), keys in user_keys.iteritems():
+        name = 'prewarm-{}-{}'.format(hashlib.sha1(user_id).hexdigest(),
+                                      due_at.strftime('%Y%m%d%H%M'))
+        payload = json.dumps({'user_id': user_id,
+                              'keys': [key.urlsafe() for key in keys]})
+        tasks.append(taskqueue.Task(url=PREWARM_URL, payload=payload,
+                                    name=name))
+    for i in xrange(0, len(tasks), QUEUE_ADD_BATCH_SIZE):
+        _ScheduledJob._add_tasks(tasks[i:i + QUEUE_ADD_BATCH_SIZE])
+    return len(tasks)
+
+
+def prewarm_user(user_id, job_keys):
+    """
+    Prepares processing of given jobs of user before they are due. Refreshes
+    and caches the access token (see get_access_token) and opens a mail
+    session, which caches the folders of the user, and lets every job that
+    is still scheduled prewarm itself (eg. SendJob prefetches its draft).
+    """
+    jobs = [job for job in ndb.get_multi(job_keys)
+            if job is not None and job.state == 'scheduled' and
+            job.user_id == user_id]
+    if not jobs:
+        return
+    access_token = get_access_token(user_id)
+    if access_token is None:
+        logging.info('no credentials of user {}, not prewarming'.format(
+            user_id))
+        return
+    mailman = gmail.Mailman(jobs[0].user_email, access_token)
+    try:
+        mailman.get_opened_imap_session()
+        for job in jobs:
+            job.prewarm(mailman)
+    finally:
+        mailman.quit()
+
+
+class JSONEncoder(json.JSONEncoder):
+    """
+    Encodes jobs and snippets in the format of the api, used for responses
+    and pushed messages (see Dashboard._update_async).
+    """
+
+    def default(self, o):
+        if isinstance(o, SendJob):
+            return self._encode_send_job(o)
+        if isinstance(o, RemindJob):
+            return self._encode_remind_job(o)
+        if isinstance(o, DisabledReply):
+            return self._encode_disabled_reply(o)
+        if isinstance(o, Snippet):
+            return self._encode_snippet(o)
+        if isinstance(o, datetime.datetime):
+            return o.replace(tzinfo=UTC).isoformat()
+        if isinstance(o, datetime.date):
+            return o.isoformat()
+        return json.JSONEncoder.default(self, o)
+
+    def _encode_snippet(self, snippet):
+        return {
+            'id': snippet.key.id(),
+            'usageCnt': snippet.usage_cnt,
+            'updatedAt': snippet.updated_at,
+            'subject': snippet.subject,
+            'body': snippet.body,
+            'name': snippet.name,
+        }
+
+    def _encode_base_job(self, job):
+        return {'id': job.key.id(),
+                'state': job.state,
+                'scheduledAt': job.scheduled_at,
+                'createdAt': job.created_at,
+                'utcOffset': job.utc_offset}
+
+    def _encode_send_job(self, job):
+        json = self._encode_base_job(job)
+        json.update({
+            'subject': job.subject,
+            'messageId': job.message_id
+        })
+        return json
+
+    def _encode_remind_job(self, job):
+        json = self._encode_base_job(job)
+        json.update({
+            'subject': job.subject,
+            'threadId': job.thread_id,
+            'knownMessageIds': job.known_message_ids,
+            'onlyIfNoreply': job.only_if_noreply,
+            'disabledReply': job.disabled_reply
+        })
+        return json
+
+    def _encode_disabled_reply(self, reply):
+        return {
+            'rfcMessageId': reply.rfc_message_id,
+            'messageId': reply.message_id,
+            'fromName': reply.from_name,
+            'fromEmail': reply.from_email,
+            'date': reply.date,
+        }
+
+
+def group_jobs(jobs):
+    """
+    Returns dict with given jobs split into 'sendJobs' and 'remindJobs'
+    lists, as returned by /api/changes.
+    """
+    return {'sendJobs': [job for job in jobs
+                         if isinstance(job, SendJob)],
+            'remindJobs': [job for job in jobs
+                           if isinstance(job, RemindJob)]}
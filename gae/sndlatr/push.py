@@ -0,0 +1,108 @@
+"""
+Pushes job changes to the open clients (gmail tabs) of a user over the
+channel api, so they do not have to poll for them. The channels of a user
+are registered in memcache, so changes may be lost, clients catch up with
+/api/changes when they (re)open their channel.
+"""
+import os
+import json
+import time
+import logging
+
+from google.appengine.api import channel, memcache, taskqueue
+from google.appengine.ext import ndb
+
+# minutes a channel stays open. Clients request a new one afterwards.
+CHANNEL_DURATION = 120
+# maximal number of open channels of a user, the oldest one is dropped
+# when another one is opened.
+MAX_CHANNELS = 10
+# maximal size of a message sent over a channel.
+MAX_MESSAGE_SIZE = 32 * 1024
+# tries to update the channel list of a user with compare and set.
+REGISTER_RETRIES = 10
+# url and queue of tasks that send messages (see publish_async).
+PUBLISH_URL = '/api/tasks/publish'
+PUBLISH_QUEUE = 'push'
+
+
+def _get_channels_key(user_id):
+    return 'push_channels:' + user_id
+
+
+def create_channel(user_id):
+    """ Opens and registers a new channel of user. Returns its token. """
+    client_id = '{}-{}'.format(user_id, os.urandom(8).encode('hex'))
+    token = channel.create_channel(client_id,
+                                   duration_minutes=CHANNEL_DURATION)
+    _register_channel(user_id, client_id,
+                      time.time() + CHANNEL_DURATION * 60)
+    return token
+
+
+def _register_channel(user_id, client_id, expires_at):
+    """
+    Adds channel with given client_id to the list of (client_id,
+    expires_at) tuples of user in memcache and drops expired ones.
+    """
+    client = memcache.Client()
+    key = _get_channels_key(user_id)
+    for _ in xrange(REGISTER_RETRIES):
+        channels = client.gets(key)
+        if channels is None:
+            if client.add(key, [(client_id, expires_at)],
+                          time=CHANNEL_DURATION * 60):
+                return
+            continue
+        now = time.time()
+        channels = [(other_id, other_expires_at)
+                    for other_id, other_expires_at in channels
+                    if other_expires_at > now][-(MAX_CHANNELS - 1):]
+        channels.append((client_id, expires_at))
+        if client.cas(key, channels, time=CHANNEL_DURATION * 60):
+            return
+    logging.warn('could not register channel of {}'.format(user_id))
+
+
+def get_client_ids(user_id):
+    """ Returns client ids of open channels of user. """
+    return get_client_ids_async(user_id).get_result()
+
+
+@ndb.tasklet
+def get_client_ids_async(user_id):
+    """ Async version of get_client_ids. """
+    channels = yield ndb.get_context().memcache_get(
+        _get_channels_key(user_id))
+    now = time.time()
+    raise ndb.Return([client_id for client_id, expires_at in channels or []
+                      if expires_at > now])
+
+
+def publish(user_id, message):
+    """
+    Sends message (a string) to all open channels of user. Does nothing if
+    there are none.
+    """
+    client_ids = get_client_ids(user_id)
+    if not client_ids:
+        return
+    if len(message) > MAX_MESSAGE_SIZE:
+        logging.warn('message to {} too big, not sending'.format(user_id))
+        return
+    for client_id in client_ids:
+        channel.send_message(client_id, message)
+
+
+@ndb.tasklet
+def publish_async(user_id, message):
+    """
+    Adds task that sends message to all open channels of user (see
+    publish), so the caller does not wait for the channel api.
+    """
+    if len(message) > MAX_MESSAGE_SIZE:
+        logging.warn('message to {} too big, not sending'.format(user_id))
+        return
+    payload = json.dumps({'user_id': user_id, 'message': message})
+    yield taskqueue.Queue(PUBLISH_QUEUE).add_async(
+        taskqueue.Task(url=PUBLISH_URL, payload=payload))
@@ -2,6 +2,8 @@ from voluptuous import Schema, Any, All, Invalid, Length, Required, Optional, \
     Range
 import iso8601
 import pytz
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
 
 # re-export
 Error = Invalid
@@ -21,6 +23,39 @@ def parse_datetime(date):
         raise Invalid('date is not in iso8601 format')
 
 
+def parse_cursor(cursor):
+    """ Parses websafe encoded query cursor into ndb.Cursor. """
+    if not isinstance(cursor, basestring):
+        raise Invalid('cursor is not a string')
+    try:
+        return ndb.Cursor(urlsafe=cursor)
+    except datastore_errors.BadValueError:
+        raise Invalid('invalid cursor')
+
+
+def parse_key(key):
+    """ Parses websafe encoded ndb.Key. """
+    if not isinstance(key, basestring):
+        raise Invalid('key is not a string')
+    try:
+        return ndb.Key(urlsafe=key)
+    except Exception:
+        raise Invalid('invalid key')
+
+
+def parse_changes_token(token):
+    """ Parses token of /api/changes into the dashboard version. """
+    if not isinstance(token, basestring):
+        raise Invalid('token is not a string')
+    try:
+        version = int(token)
+    except ValueError:
+        raise Invalid('invalid token')
+    if version < 0:
+        raise Invalid('invalid token')
+    return version
+
+
 def _validate_hex(num):
     if not isinstance(num, basestring):
         raise Invalid('message id is not hex str')
@@ -89,3 +124,79 @@ snippet_schema = Schema({Required('subject', default=''): basestring,
                          Optional('updatedAt'): basestring,
                          Optional('usageCnt'): number,
                          Optional('id'): number}, required=True)
+
+dispatch_continuation_schema = Schema({'kind': basestring,
+                                       'cursor': parse_cursor,
+                                       'now': parse_datetime}, required=True)
+
+backfill_dispatch_index_schema = Schema({'kind': basestring,
+                                         Optional('cursor'): parse_cursor},
+                                        required=True)
+
+dispatch_schema = Schema({'kind': basestring,
+                          'due_at': parse_datetime}, required=True)
+
+prewarm_schema = Schema({'user_id': basestring,
+                         'keys': [parse_key]}, required=True)
+
+invalidate_dashboard_schema = Schema({'user_id': basestring},
+                                     required=True)
+
+publish_schema = Schema({'user_id': basestring, 'message': basestring},
+                        required=True)
+
+migrate_layout_schema = Schema({Optional('user_id'): basestring,
+                                Optional('kind'): basestring,
+                                Optional('cursor'): parse_cursor,
+                                Optional('found'): number,
+                                Optional('passes'): number})
+
+# maximal number of operations of a /api/batch request
+BATCH_MAX_OPERATIONS = 100
+
+_batch_data_schemas = {'sendJob': send_job_schema,
+                       'remindJob': remind_job_schema,
+                       'snippet': snippet_schema}
+
+_batch_operation_schema = Schema(
+    {'type': Any(*_batch_data_schemas.keys()),
+     'action': Any('create', 'update', 'delete'),
+     Optional('id'): All(number, Range(min=1)),
+     Optional('data'): dict},
+    required=True)
+
+
+def _validate_batch_operation(operation):
+    """
+    Validates operation of a batch and its data with the schema of its
+    type. Creates need data, updates id and data and deletes an id.
+    """
+    operation = _batch_operation_schema(operation)
+    action = operation['action']
+    if action == 'create':
+        operation.pop('id', None)
+    elif 'id' not in operation:
+        raise Invalid('id missing')
+    if action == 'delete':
+        operation.pop('data', None)
+    elif 'data' not in operation:
+        raise Invalid('data missing')
+    else:
+        operation['data'] = _batch_data_schemas[operation['type']](
+            operation['data'])
+    return operation
+
+
+def _validate_batch_ids(operations):
+    ids = [(operation['type'], operation['id'])
+           for operation in operations if 'id' in operation]
+    if len(set(ids)) != len(ids):
+        raise Invalid('multiple operations on the same id')
+    return operations
+
+
+batch_schema = Schema(
+    {'operations': All([_validate_batch_operation],
+                       Length(min=1, max=BATCH_MAX_OPERATIONS),
+                       _validate_batch_ids)},
+    required=True)
@@ -6,9 +6,11 @@ from contextlib import contextmanager
 
 import webapp2
 from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
 import mock
 
 import main
+from sndlatr import models
 
 
 test_data_dir = os.path.join(os.path.dirname(__file__), 'data')
@@ -33,13 +35,18 @@ class BaseTestCase(TestCase):
 
         self.testbed.activate()
         self.testbed.init_user_stub()
-        self.testbed.init_datastore_v3_stub()
+        # cross group transactions need the high replication datastore
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
         self.testbed.init_memcache_stub()
         self.testbed.init_urlfetch_stub()
         self.testbed.init_mail_stub()
+        self.testbed.init_channel_stub()
         self.testbed.init_taskqueue_stub(
             root_path=os.path.join(os.path.dirname(__file__), '..'))
         self.addCleanup(self.testbed.deactivate)
+        self.addCleanup(models.access_token_cache.clear)
 
         self.taskqueue_stub = self.testbed.get_stub(
             testbed.TASKQUEUE_SERVICE_NAME)
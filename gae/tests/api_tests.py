@@ -5,7 +5,8 @@ from w69b import idtokenauth
 from oauth2client.client import OAuth2Credentials, AccessTokenRefreshError
 
 from tests import BaseTestCase, auth_user
-from sndlatr import api, gmail
+from google.appengine.ext import testbed
+from sndlatr import api, gmail, push
 from tests.common import *
 
 
@@ -29,11 +30,136 @@ def mock_mailman():
      """
     with mock_instance('sndlatr.gmail.Mailman') as mailman, \
         mock.patch('sndlatr.models.get_credentials') as cred_mock:
-        cred_mock.auth_token = 'testtoken'
+        cred_mock.return_value.access_token = 'testtoken'
+        cred_mock.return_value.token_expiry = None
         mailman.send_draft.return_value = ('test_rfc_id', 'testmail')
+        mailman.get_all_box_status.return_value = {}
+        mailman.get_threads.return_value = {}
         yield mailman
 
 
+class BatchHandlerTest(BaseTestCase):
+    url = '/api/tasks/batch'
+
+    def _post_batch(self, jobs):
+        return self.send_request(
+            self.url, json_data={'keys': [job.key.urlsafe() for job in jobs]})
+
+    @contextmanager
+    def mailman_mocks(self):
+        """ Provides Mailman constructor mock. """
+        with mock.patch('sndlatr.gmail.Mailman', autospec=True) as \
+                constructor, \
+            mock.patch('sndlatr.models.get_credentials') as cred_mock:
+            cred_mock.return_value.access_token = 'testtoken'
+            cred_mock.return_value.token_expiry = None
+            mailman = constructor.return_value
+            mailman.send_draft.return_value = 'testmail'
+            mailman.get_all_box_status.return_value = {}
+            yield constructor
+
+    def test_success(self):
+        jobs = [create_send_job(state='queued') for _ in xrange(2)]
+        jobs.append(create_remind_job(state='queued'))
+        with self.mailman_mocks() as constructor:
+            resp = self._post_batch(jobs)
+            self.assertEqual(constructor.call_count, 1)
+            mailman = constructor.return_value
+            self.assertEqual(mailman.send_draft.call_count, 2)
+            self.assertEqual(mailman.send_mail.call_count, 1)
+            mailman.quit.assert_called_with()
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual([job.key.get().state for job in jobs],
+                         ['done', 'done', 'done'])
+
+    def test_error_isolation(self):
+        """ A failing job should be retried on its own. """
+        failing = create_send_job(state='queued')
+        job = create_send_job(state='queued')
+
+        def send_draft(message_id, rfc_id, **kwargs):
+            if message_id == failing.message_id_int:
+                raise IOError()
+            return 'testmail'
+
+        failing.message_id = 'ff'
+        failing.put()
+        with self.mailman_mocks() as constructor:
+            constructor.return_value.send_draft.side_effect = send_draft
+            resp = self._post_batch([failing, job])
+        self.assertEqual(resp.status_int, 200)
+        failing = failing.key.get()
+        self.assertEqual(failing.state, 'queued')
+        self.assertEqual(failing.error_cnt, 1)
+        self.assertEqual(job.key.get().state, 'done')
+        tasks = self.taskqueue_stub.get_filtered_tasks(url='/api/tasks/send')
+        self.assertEqual([task.name for task in tasks],
+                         [failing.get_task_name() + '-retry1'])
+
+
+class DispatchHandlerTest(BaseTestCase):
+    url = '/api/tasks/dispatch'
+
+    def _post_dispatch(self, job):
+        data = {'kind': job.key.kind(), 'due_at': job.get_eta().isoformat()}
+        return self.send_request(self.url, json_data=data)
+
+    def test_dispatch_due(self):
+        job = create_send_job()
+        resp = self._post_dispatch(job)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(job.key.get().state, 'queued')
+        tasks = self.taskqueue_stub.get_filtered_tasks(url='/api/tasks/send')
+        self.assertEqual([json.loads(task.payload)['key'] for task in tasks],
+                         [job.key.urlsafe()])
+        # a second delivery of the eta task should not queue it again
+        self._post_dispatch(job)
+        self.assertEqual(
+            len(self.taskqueue_stub.get_filtered_tasks(url='/api/tasks/send')),
+            1)
+
+    def test_dispatch_not_due(self):
+        job = create_send_job(scheduled_at=datetime.datetime.utcnow() +
+                                           datetime.timedelta(hours=1))
+        self._post_dispatch(job)
+        self.assertEqual(job.key.get().state, 'scheduled')
+        self.assertEqual(
+            self.taskqueue_stub.get_filtered_tasks(url='/api/tasks/send'), [])
+
+    def test_dispatch_queued(self):
+        job = create_remind_job(state='queued')
+        resp = self._post_dispatch(job)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(
+            self.taskqueue_stub.get_filtered_tasks(url='/api/tasks/remind'),
+            [])
+
+    def test_dispatch_due_at(self):
+        """ Jobs due at the same time should be queued in user batches. """
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        jobs = [create_send_job(scheduled_at=now)
+                for _ in xrange(models.USER_BATCH_SIZE + 2)]
+        other = create_send_job(scheduled_at=now, user_id='other_user')
+        for job in jobs + [other]:
+            job.add_eta_task()
+        eta_tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=models.DISPATCH_URL)
+        resp = self.send_request(self.url,
+                                 json_data=json.loads(eta_tasks[0].payload))
+        self.assertEqual(resp.status_int, 200)
+        batches = self.taskqueue_stub.get_filtered_tasks(
+            url=models.USER_BATCH_URL)
+        self.assertEqual(sorted(len(json.loads(task.payload)['keys'])
+                                for task in batches),
+                         [2, models.USER_BATCH_SIZE])
+        self.assertEqual(
+            [json.loads(task.payload)['key'] for task in
+             self.taskqueue_stub.get_filtered_tasks(url='/api/tasks/send')],
+            [other.key.urlsafe()])
+        for job in jobs + [other]:
+            self.assertEqual(job.key.get().state, 'queued')
+
+
 class QueueJobHandlerTest(BaseTestCase):
     url = '/api/tasks/enqueue_scheduled'
 
@@ -41,12 +167,27 @@ class QueueJobHandlerTest(BaseTestCase):
         send_fn_name = 'sndlatr.models.SendJob.add_all_due_to_queue'
         remind_fn_name = 'sndlatr.models.RemindJob.add_all_due_to_queue'
         with mock.patch(send_fn_name) as add_send, \
-            mock.patch(remind_fn_name) as add_remind:
+            mock.patch(remind_fn_name) as add_remind, \
+            mock.patch('sndlatr.models.add_prewarm_tasks') as add_prewarm:
             resp = self.send_request(self.url)
             add_send.assert_called()
             add_remind.assert_called()
+            add_prewarm.assert_called()
             self.assertEqual(resp.status_int, 200)
 
+    def test_post_continuation(self):
+        now = datetime.datetime.utcnow()
+        jobs = [create_send_job(
+            scheduled_at=now - datetime.timedelta(minutes=minutes))
+                for minutes in (1, 2)]
+        with mock.patch('sndlatr.models.DISPATCH_PAGE_SIZE', 1):
+            models.SendJob.add_all_due_to_queue(time_budget=-1)
+        task = self.taskqueue_stub.get_filtered_tasks(url=self.url)[0]
+        resp = self.send_request(self.url, json_data=json.loads(task.payload))
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual([job.key.get().state for job in jobs],
+                         ['queued', 'queued'])
+
     def test_forbidden(self):
         with mock.patch('sndlatr.auth.is_dev') as dev_mock:
             dev_mock.return_value = False
@@ -213,6 +354,48 @@ class SendHandlerTest(BaseTestCase, CommonJobTaskHandlerTests,
         job = job.key.get()
         self.assertEquals(job.state, 'done')
 
+    def test_concurrent_tasks(self):
+        """
+        A second task of a job that runs while the first one sends the mail
+        (eg. a task that was delivered twice) should not send it again.
+        """
+        job = self.create_job(state='queued')
+        responses = []
+
+        def send_draft(*args, **kwargs):
+            responses.append(self._post_send(job))
+            return 'testmail'
+
+        with mock_mailman() as mailman:
+            mailman.send_draft.side_effect = send_draft
+            responses.append(self._post_send(job))
+            self.assertEqual(mailman.send_draft.call_count, 1)
+        self.assertEqual([resp.status_int for resp in responses], [200, 200])
+        self.assertEqual(job.key.get().state, 'done')
+
+    def test_publishes_job(self):
+        """ Should push processed job to open channels of its user. """
+        stub = self.testbed.get_stub(testbed.CHANNEL_SERVICE_NAME)
+        job = self.create_job(state='queued')
+        token = push.create_channel('test_user_id')
+        stub.connect_channel(token)
+        with mock_mailman():
+            self._post_send(job)
+        for task in self.taskqueue_stub.get_filtered_tasks(
+                url=push.PUBLISH_URL):
+            resp = self.send_request(push.PUBLISH_URL,
+                                     json_data=json.loads(task.payload))
+            self.assertEqual(resp.status_int, 200)
+        messages = stub.get_channel_messages(token)
+        # every save of the job is pushed
+        self.assertEqual(
+            [json.loads(message)['sendJobs'][0]['state']
+             for message in messages], ['sending', 'sent', 'done'])
+        message = json.loads(messages[-1])
+        self.assertEqual(message['remindJobs'], [])
+        self.assertDictContainsSubset({'id': job.key.id(), 'state': 'done'},
+                                      message['sendJobs'][0])
+
 
 class RemindHandlerTest(BaseTestCase, CommonJobTaskHandlerTests,
                         CommonNotifyingJobTests):
@@ -277,6 +460,93 @@ class RemindHandlerTest(BaseTestCase, CommonJobTaskHandlerTests,
         self.assert_handles_error(gmail.RfcMsgIdMissing, 'unknown')
 
 
+class BackfillDispatchIndexHandlerTest(BaseTestCase):
+    url = '/api/tasks/backfill_dispatch_index'
+
+    def test_get(self):
+        self.set_auth_is_admin(True)
+        resp = self.send_request(self.url)
+        self.assertEqual(resp.status_int, 200)
+        tasks = self.taskqueue_stub.get_filtered_tasks(url=self.url)
+        self.assertEqual({json.loads(task.payload)['kind'] for task in tasks},
+                         {'SendJob', 'RemindJob'})
+
+    def test_get_forbidden(self):
+        self.set_auth_is_admin(False)
+        resp = self.send_request(self.url)
+        self.assertEqual(resp.status_int, 403)
+
+    def test_post(self):
+        job = create_send_job()
+        job.remove_from_dispatch_index()
+        resp = self.send_request(self.url, json_data={'kind': 'SendJob'})
+        self.assertEqual(resp.status_int, 200)
+        self.assertTrue(models.SendJob.is_dispatch_index_complete())
+        self.assertIsNotNone(
+            models.DispatchBucket.get_key(job.key, job.scheduled_at).get())
+
+
+class MigrateLayoutHandlerTest(BaseTestCase):
+    url = '/api/tasks/migrate_layout'
+
+    def test_get(self):
+        user = idtokenauth.User('test@example.com', _user_id='testuser')
+        create_account(user)
+        self.set_auth_is_admin(True)
+        resp = self.send_request(self.url)
+        self.assertEqual(resp.status_int, 200)
+        tasks = self.taskqueue_stub.get_filtered_tasks(url=self.url)
+        self.assertEqual([json.loads(task.payload) for task in tasks],
+                         [{'user_id': 'testuser'}])
+
+    def test_get_forbidden(self):
+        self.set_auth_is_admin(False)
+        resp = self.send_request(self.url)
+        self.assertEqual(resp.status_int, 403)
+
+    def test_post(self):
+        user = idtokenauth.User('test@example.com', _user_id='testuser')
+        create_account(user)
+        job = create_send_job(user_id='testuser')
+        resp = self.send_request(self.url, json_data={'user_id': 'testuser'})
+        self.assertEqual(resp.status_int, 200)
+        self.assertIsNone(job.key.get())
+        self.assertEqual(models.Account.get_by_id('testuser').layout,
+                         models.LAYOUT_MIGRATING)
+
+
+class InvalidateDashboardHandlerTest(BaseTestCase):
+    url = '/api/tasks/invalidate_dashboard'
+
+    def test_post(self):
+        job = create_send_job(user_id='testuser')
+        models.Dashboard.get_displayed_async('testuser').get_result()
+        resp = self.send_request(self.url, json_data={'user_id': 'testuser'})
+        self.assertEqual(resp.status_int, 200)
+        self.assertFalse(
+            models.Dashboard.get_key(job.user_id).get().complete)
+
+
+class PrewarmHandlerTest(BaseTestCase):
+    url = '/api/tasks/prewarm'
+
+    def test_post(self):
+        job = create_send_job()
+        with mock.patch('sndlatr.models.prewarm_user') as prewarm:
+            resp = self.send_request(self.url, json_data={
+                'user_id': job.user_id, 'keys': [job.key.urlsafe()]})
+            prewarm.assert_called_with(job.user_id, [job.key])
+        self.assertEqual(resp.status_int, 200)
+
+    def test_failure_not_retried(self):
+        job = create_send_job()
+        with mock.patch('sndlatr.models.prewarm_user') as prewarm:
+            prewarm.side_effect = IOError()
+            resp = self.send_request(self.url, json_data={
+                'user_id': job.user_id, 'keys': [job.key.urlsafe()]})
+        self.assertEqual(resp.status_int, 200)
+
+
 class CheckReplyHandlerTest(BaseTestCase, CommonJobTaskHandlerTests):
     url = '/api/tasks/check_reply'
     JOB_MAX_RETRIES = 2
@@ -307,7 +577,7 @@ class CheckReplyHandlerTest(BaseTestCase, CommonJobTaskHandlerTests):
             job = self.create_job(state='checking')
         old_err_cnt = job.error_cnt
         with mock_mailman() as mailman:
-            mailman.get_thread.side_effect = raise_error
+            mailman.get_threads.side_effect = raise_error
             resp = self._post_send(job)
 
         job = job.key.get()
@@ -338,6 +608,33 @@ class CheckReplyHandlerTest(BaseTestCase, CommonJobTaskHandlerTests):
     def test_io_error(self):
         self.assert_handles_error(IOError, should_retry=True)
 
+    def test_checks_other_jobs_of_user(self):
+        job = self.create_job(state='checking', thread_id='a')
+        other = self.create_job(state='checking', thread_id='b')
+        scheduled = self.create_job(state='scheduled', thread_id='c')
+        foreign = self.create_job(state='checking', thread_id='d',
+                                  user_id='other_user')
+        with mock_mailman() as mailman:
+            mailman.get_threads.return_value = {
+                0xb: [{'message_id': 'reply', 'from_name': 'Foo',
+                       'from_email': 'foo@example.com', 'subject': 'Re'}]}
+            resp = self._post_send(job)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(mailman.get_threads.call_count, 1)
+            self.assertEqual(set(mailman.get_threads.call_args[0][0]),
+                             {0xa, 0xb})
+        self.assertEqual(job.key.get().state, 'scheduled')
+        self.assertEqual(other.key.get().state, 'disabled')
+        self.assertEqual(scheduled.key.get().state, 'scheduled')
+        self.assertEqual(foreign.key.get().state, 'checking')
+
+    def test_skips_checked_job(self):
+        job = self.create_job(state='scheduled')
+        with mock_mailman() as mailman:
+            resp = self._post_send(job)
+            self.assertEqual(resp.status_int, 200)
+            self.assertFalse(mailman.get_threads.called)
+
 
 class CommonCRUDHandlerTests(object):
     def setUp(self):
@@ -370,6 +667,30 @@ class CommonCRUDHandlerTests(object):
         self.assertEqual(result[0]['id'], job1.key.id())
         self.assertEqual(result[1]['id'], job2.key.id())
 
+    def test_get_multiple_more_than_100(self):
+        ids = [self.create_model(user_id=self.user.user_id()).key.id()
+               for _ in xrange(120)]
+        resp = self.send_request('{}?id={}'.format(
+            self.all_url, '&id='.join(str(id) for id in ids)))
+        self.assertEqual(resp.status_code, 200)
+        result = json.loads(resp.body)
+        self.assertEqual([item['id'] for item in result], ids)
+
+    def test_get_multiple_paged(self):
+        """ Should get more than MAX_GET_IDS ids in pages. """
+        ids = [self.create_model(user_id=self.user.user_id()).key.id()
+               for _ in xrange(5)]
+        get_multi_async = models.ndb.get_multi_async
+        with mock.patch('sndlatr.api.MAX_GET_IDS', 2), \
+                mock.patch('sndlatr.models.ndb.get_multi_async') as get:
+            get.side_effect = get_multi_async
+            resp = self.send_request('{}?id={}&id=444565656'.format(
+                self.all_url, '&id='.join(str(id) for id in ids)))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([item['id'] for item in json.loads(resp.body)], ids)
+        self.assertEqual([len(args[0][0]) for args in get.call_args_list],
+                         [2, 2, 2])
+
     def test_get_multiple_wrong_user(self):
         wrong_job = self.create_model(user_id='wronguser')
         job = self.create_model(user_id=self.user.user_id())
@@ -381,6 +702,8 @@ class CommonCRUDHandlerTests(object):
     def test_get_multiple_invalid_id(self):
         resp = self.send_request(self.all_url + '?id=1&id=hihi')
         self.assertEqual(resp.status_code, 400)
+        resp = self.send_request(self.all_url + '?id=1&id=0')
+        self.assertEqual(resp.status_code, 400)
 
     def test_get_multiple_nonexistent_id(self):
         resp = self.send_request(self.all_url + '?id=456456561&id=444565656')
@@ -395,6 +718,27 @@ class CommonCRUDHandlerTests(object):
         result = json.loads(resp.body)
         self.assertEquals(result['id'], job.key.id())
 
+    def test_get_single_not_modified(self):
+        job = self.create_model(user_id=self.user.user_id())
+        url = self.url.format(job.key.id())
+        etag = self.send_request(url).headers['ETag']
+        resp = self.send_request(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        job.save()
+        resp = self.send_request(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_get_single_ancestor_layout(self):
+        account = create_account(self.user)
+        account.layout = models.LAYOUT_ANCESTOR
+        account.put()
+        job = self.create_model(user_id=self.user.user_id())
+        job.save()
+        self.assertEqual(job.key.parent(), account.key)
+        resp = self.send_request(self.url.format(job.key.id()))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEquals(json.loads(resp.body)['id'], job.key.id())
+
     def test_get_single_wrong_user(self):
         job = self.create_model(user_id='wronguser')
         resp = self.send_request(self.url.format(job.key.id()))
@@ -455,6 +799,70 @@ class ScheduleSendHandlerTest(CommonScheduleHandlerTests, BaseTestCase):
         self.assertEqual(job.message_id, '456')
         self.assertEqual(job.scheduled_at.isoformat(), '2023-10-05T08:00:00')
 
+    def test_create_adds_eta_task(self):
+        resp = self.send_request(self.all_url,
+                                 json_data={
+                                     'messageId': '1234',
+                                     'utcOffset': 0,
+                                     'scheduledAt': '2023-09-05T08:00:00.00Z'
+                                 })
+        job = models.SendJob.get_by_id(json.loads(resp.body)['id'])
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=models.DISPATCH_URL)
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(json.loads(tasks[0].payload),
+                         {'kind': 'SendJob',
+                          'due_at': '2023-09-05T08:00:00'})
+
+    def test_create_shares_eta_task(self):
+        """ Jobs due at the same time should share their eta task. """
+        due_at = (datetime.datetime.utcnow() +
+                  datetime.timedelta(hours=1)).replace(microsecond=0)
+        for _ in xrange(3):
+            self.send_request(self.all_url, json_data={
+                'messageId': '1234',
+                'utcOffset': 0,
+                'scheduledAt': due_at.isoformat() + 'Z'})
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=models.DISPATCH_URL)
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0].name,
+                         'SendJob-{}-eta'.format(
+                             due_at.strftime('%Y%m%d%H%M%S')))
+
+    def test_update_adds_eta_task(self):
+        job = self.create_model(user_id=self.user.user_id())
+        self.send_request(self.url.format(job.key.id()),
+                          json_data=self.update_data)
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=models.DISPATCH_URL)
+        self.assertEqual([json.loads(task.payload)['due_at']
+                          for task in tasks], ['2023-10-05T08:00:00'])
+
+    def test_delete_not_dispatched(self):
+        """ The eta task of a deleted job should not queue it. """
+        job = self.create_model(user_id=self.user.user_id())
+        self.send_request(self.url.format(job.key.id()), method='DELETE')
+        self.assertEqual(models.SendJob.dispatch_due(job.scheduled_at), 0)
+
+    def test_update_moves_dispatch_bucket(self):
+        job = self.create_model(user_id=self.user.user_id())
+        old_bucket_key = models.DispatchBucket.get_key(job.key,
+                                                       job.scheduled_at)
+        self.send_request(self.url.format(job.key.id()),
+                          json_data=self.update_data)
+        job = job.key.get()
+        self.assertIsNone(old_bucket_key.get())
+        bucket = models.DispatchBucket.get_key(job.key,
+                                               job.scheduled_at).get()
+        self.assertEqual(bucket.job_keys, [job.key])
+
+    def test_delete_removes_from_dispatch_index(self):
+        job = self.create_model(user_id=self.user.user_id())
+        bucket_key = models.DispatchBucket.get_key(job.key, job.scheduled_at)
+        self.send_request(self.url.format(job.key.id()), method='DELETE')
+        self.assertIsNone(bucket_key.get())
+
     def test_delete_queued(self):
         """ Deleting a queued job should result in not found response """
         job = self.create_model(user_id=self.user.user_id(), state='queued')
@@ -531,6 +939,13 @@ class ScheduleRemindHandlerTest(CommonScheduleHandlerTests, BaseTestCase):
         self.assertEqual(job.known_message_ids, ['123'])
         self.assertEqual(job.scheduled_at.isoformat(), '2023-10-05T08:00:00')
 
+    def test_update_resets_last_seen_uid(self):
+        job = self.create_model(user_id=self.user.user_id(),
+                                last_seen_uid=44, uid_validity=1)
+        self.send_request(self.url.format(job.key.id()),
+                          json_data=self.update_data)
+        self.assertIsNone(job.key.get().last_seen_uid)
+
     def test_delete_cancelled(self):
         """ Disabled jobs can be deleted. """
         job = self.create_model(user_id=self.user.user_id(), state='disabled')
@@ -552,6 +967,7 @@ class ScheduleCheckReplyHandlerTest(BaseTestCase):
     url = '/api/remind/{}/check_reply'
 
     def setUp(self):
+        super(ScheduleCheckReplyHandlerTest, self).setUp()
         self.user = idtokenauth.User('test@example.com', _user_id='testuser')
         self.set_auth_user(self.user)
         self.valid_reply = {'fromName': 'Manu',
@@ -582,6 +998,184 @@ class ScheduleCheckReplyHandlerTest(BaseTestCase):
         self.assertEqual(resp.status_int, 404)
 
 
+class BatchMutationHandlerTest(BaseTestCase):
+    url = '/api/batch'
+
+    def setUp(self):
+        super(BatchMutationHandlerTest, self).setUp()
+        self.user = idtokenauth.User('test@example.com', _user_id='testuser')
+        self.set_auth_user(self.user)
+        self.send_job_data = {'messageId': '456', 'utcOffset': 0,
+                              'scheduledAt': '2023-10-05T08:00:00.00Z'}
+
+    def send_batch(self, operations):
+        return self.send_request(self.url,
+                                 json_data={'operations': operations})
+
+    def get_eta_payloads(self):
+        return [json.loads(task.payload) for task in
+                self.taskqueue_stub.get_filtered_tasks(
+                    url=models.DISPATCH_URL)]
+
+    def test_needs_auth(self):
+        self.set_auth_user(None)
+        self.assertEqual(self.send_batch([]).status_int, 403)
+
+    def test_mixed(self):
+        updated = create_send_job(user_id=self.user.user_id())
+        deleted = create_remind_job(user_id=self.user.user_id())
+        snippet = create_snippet(user_id=self.user.user_id())
+        resp = self.send_batch([
+            {'type': 'sendJob', 'action': 'create',
+             'data': self.send_job_data},
+            {'type': 'sendJob', 'action': 'update', 'id': updated.key.id(),
+             'data': self.send_job_data},
+            {'type': 'remindJob', 'action': 'delete',
+             'id': deleted.key.id()},
+            {'type': 'snippet', 'action': 'update', 'id': snippet.key.id(),
+             'data': {'subject': 'new subject'}}])
+        self.assertEqual(resp.status_int, 200)
+        results = json.loads(resp.body)['results']
+        self.assertEqual([result['status'] for result in results],
+                         [200, 200, 204, 200])
+        created = models.SendJob.get_by_id(results[0]['data']['id'])
+        self.assertEqual(created.message_id, '456')
+        self.assertEqual(created.user_email, self.user.email())
+        updated = updated.key.get()
+        self.assertEqual(updated.scheduled_at.isoformat(),
+                         '2023-10-05T08:00:00')
+        # of created and updated job, past ones are not named
+        self.assertEqual(self.get_eta_payloads(),
+                         [{'kind': 'SendJob',
+                           'due_at': '2023-10-05T08:00:00'}] * 2)
+        bucket = models.DispatchBucket.get_key(updated.key,
+                                               updated.scheduled_at).get()
+        self.assertIn(updated.key, bucket.job_keys)
+        self.assertIsNone(deleted.key.get())
+        self.assertEqual(snippet.key.get().subject, 'new subject')
+        displayed, _ = models.Dashboard.get_displayed_async(
+            self.user.user_id()).get_result()
+        self.assertEqual(len(displayed), 3)
+
+    def test_mixed_not_found(self):
+        """
+        Should run the hooks of all applied operations of a batch with
+        operations that were not found.
+        """
+        now = datetime.datetime.utcnow()
+        remind_job = create_remind_job(user_id=self.user.user_id(),
+                                       scheduled_at=now)
+        deleted = create_send_job(user_id=self.user.user_id(),
+                                  scheduled_at=now)
+        later = (now + datetime.timedelta(hours=1)).replace(microsecond=0)
+        resp = self.send_batch([
+            {'type': 'sendJob', 'action': 'update', 'id': 444565656,
+             'data': self.send_job_data},
+            {'type': 'sendJob', 'action': 'create',
+             'data': self.send_job_data},
+            {'type': 'remindJob', 'action': 'update',
+             'id': remind_job.key.id(),
+             'data': {'threadId': '4d2', 'utcOffset': 0,
+                      'scheduledAt': later.isoformat() + 'Z'}},
+            {'type': 'remindJob', 'action': 'delete', 'id': 444565656},
+            {'type': 'sendJob', 'action': 'delete', 'id': deleted.key.id()}])
+        results = json.loads(resp.body)['results']
+        self.assertEqual([result['status'] for result in results],
+                         [404, 200, 200, 404, 204])
+        self.assertItemsEqual(self.get_eta_payloads(), [
+            {'kind': 'SendJob', 'due_at': '2023-10-05T08:00:00'},
+            {'kind': 'RemindJob', 'due_at': later.isoformat()}])
+        # moved to the bucket of its new schedule date
+        self.assertIsNone(models.DispatchBucket.get_key(
+            remind_job.key, now).get())
+        self.assertEqual(models.DispatchBucket.get_key(
+            remind_job.key, later).get().job_keys, [remind_job.key])
+        self.assertIsNone(models.DispatchBucket.get_key(
+            deleted.key, now).get())
+
+    def test_failing_hook(self):
+        """ Should run the other hooks if one of them fails. """
+        with mock.patch('sndlatr.models.SendJob.add_eta_tasks') as add:
+            add.side_effect = Exception()
+            resp = self.send_batch([
+                {'type': 'sendJob', 'action': 'create',
+                 'data': self.send_job_data},
+                {'type': 'remindJob', 'action': 'create',
+                 'data': {'threadId': '4d2', 'utcOffset': 0,
+                          'scheduledAt': '2023-10-05T08:00:00.00Z'}}])
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(self.get_eta_payloads(),
+                         [{'kind': 'RemindJob',
+                           'due_at': '2023-10-05T08:00:00'}])
+
+    def test_failing_chunk(self):
+        """
+        Should report the operations of a chunk that was not written and
+        run the hooks of the chunks that were.
+        """
+        save_multi = models.Dashboard.save_multi
+        calls = []
+
+        def fail_second(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise Exception()
+            save_multi(*args)
+
+        with mock.patch('sndlatr.models.Dashboard.save_multi') as save:
+            save.side_effect = fail_second
+            resp = self.send_batch([
+                {'type': 'sendJob', 'action': 'create',
+                 'data': self.send_job_data}
+                for _ in xrange(api.BATCH_WRITE_CHUNK_SIZE + 1)])
+        self.assertEqual(resp.status_int, 200)
+        results = json.loads(resp.body)['results']
+        self.assertEqual([result['status'] for result in results],
+                         [200] * api.BATCH_WRITE_CHUNK_SIZE + [500])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(models.SendJob.query().count(),
+                         api.BATCH_WRITE_CHUNK_SIZE)
+        # hooks of the first chunk, its jobs share the eta task
+        self.assertEqual(self.get_eta_payloads(),
+                         [{'kind': 'SendJob',
+                           'due_at': '2023-10-05T08:00:00'}])
+
+    def test_operation_errors(self):
+        """ Should report failed operations and apply the others. """
+        done = create_send_job(user_id=self.user.user_id(), state='done')
+        resp = self.send_batch([
+            {'type': 'sendJob', 'action': 'delete', 'id': done.key.id()},
+            {'type': 'sendJob', 'action': 'update', 'id': 444565656,
+             'data': self.send_job_data},
+            {'type': 'snippet', 'action': 'create', 'data': {}}])
+        self.assertEqual(resp.status_int, 200)
+        results = json.loads(resp.body)['results']
+        self.assertEqual([result['status'] for result in results],
+                         [404, 404, 200])
+        self.assertIsNotNone(done.key.get())
+        self.assertIsNotNone(models.Snippet.get_by_id(
+            results[2]['data']['id']))
+
+    def test_invalid(self):
+        """ Should reject the whole batch if an operation is invalid. """
+        resp = self.send_batch([
+            {'type': 'snippet', 'action': 'create', 'data': {}},
+            {'type': 'sendJob', 'action': 'create', 'data': {}}])
+        self.assertEqual(resp.status_int, 400)
+        self.assertEqual(models.Snippet.query().count(), 0)
+
+    def test_wrong_user(self):
+        """ Should reject the whole batch if a model is not owned. """
+        job = create_send_job(user_id=self.user.user_id())
+        wrong_job = create_send_job(user_id='wronguser')
+        resp = self.send_batch([
+            {'type': 'sendJob', 'action': 'delete', 'id': job.key.id()},
+            {'type': 'sendJob', 'action': 'delete',
+             'id': wrong_job.key.id()}])
+        self.assertEqual(resp.status_int, 403)
+        self.assertIsNotNone(job.key.get())
+
+
 class SnippetHandlerTest(CommonCRUDHandlerTests, BaseTestCase):
     url = '/api/snippet/{}'
     all_url = '/api/snippet'
@@ -643,6 +1237,20 @@ class InitializeHandlerTest(BaseTestCase):
         self.assertEqual(account.email, id_token['email'])
         self.assertEqual(account.user_id(), id_token['sub'])
 
+    def test_save_code_modifies(self):
+        """ Should not answer with 304 after the account was saved. """
+        credentials = build_credentials()
+        user = idtokenauth.User(credentials.id_token['email'],
+                                _user_id=credentials.id_token['sub'])
+        self.set_auth_user(user)
+        etag = self.send_request('/api/init').headers['ETag']
+        with mock.patch('sndlatr.auth.credentials_from_code') as from_code:
+            from_code.return_value = credentials
+            self.send_request('/api/init', json_data={'code': 'testcode'})
+        resp = self.send_request('/api/init', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_int, 200)
+        self.assertNotIn('auth', json.loads(resp.body))
+
     def test_need_code(self):
         """ If there is not account for this user, it should request code. """
         self.set_auth_user(self.user)
@@ -681,3 +1289,92 @@ class InitializeHandlerTest(BaseTestCase):
         snippet = snippets[0]
         self.assertDictContainsSubset({'subject': 'snipSubject'}, snippet)
 
+    def test_list_jobs_from_dashboard(self):
+        """ Should not query jobs once the dashboard was built. """
+        self.set_auth_user(self.user)
+        create_account(self.user)
+        self.assertEqual(self.get_result()['sendJobs'], [])
+        job = models.SendJob(scheduled_at=datetime.datetime.utcnow(),
+                             user_id=self.user.user_id(), message_id='123',
+                             user_email=self.user.email())
+        job.save()
+        with mock.patch('sndlatr.models.SendJob.query_display') as query:
+            result = self.get_result()
+            self.assertFalse(query.called)
+        self.assertEqual(len(result['sendJobs']), 1)
+        self.assertEqual(result['sendJobs'][0]['messageId'], '123')
+        self.assertEqual(
+            result['changesToken'],
+            str(models.Dashboard.get_key(self.user.user_id()).get().version))
+
+    def test_not_modified(self):
+        """ Should answer with 304 until data of user changed. """
+        self.set_auth_user(self.user)
+        create_account(self.user)
+        resp = self.send_request('/api/init')
+        etag = resp.headers['ETag']
+        self.assertIn('ETag', resp.headers['Access-Control-Expose-Headers'])
+        with mock.patch('sndlatr.models.Account.get_by_id_async') as get:
+            resp = self.send_request('/api/init',
+                                     headers={'If-None-Match': etag})
+            self.assertFalse(get.called)
+        self.assertEqual(resp.status_int, 304)
+        self.assertEqual(resp.body, '')
+        create_send_job(user_id=self.user.user_id()).save()
+        resp = self.send_request('/api/init', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_int, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(resp.body)['sendJobs']), 1)
+
+
+class ChannelHandlerTest(BaseTestCase):
+    def test_needs_auth(self):
+        resp = self.send_request('/api/channel', method='POST')
+        self.assertEqual(403, resp.status_int)
+
+    def test_create(self):
+        user = idtokenauth.User('test@example.com', _user_id='testuser')
+        self.set_auth_user(user)
+        resp = self.send_request('/api/channel', method='POST')
+        self.assertEqual(resp.status_int, 200)
+        self.assertTrue(json.loads(resp.body)['token'])
+        self.assertEqual(len(push.get_client_ids('testuser')), 1)
+
+
+class ChangesHandlerTest(BaseTestCase):
+    def setUp(self):
+        self.user = idtokenauth.User('test@example.com', _user_id='testuser')
+        super(ChangesHandlerTest, self).setUp()
+
+    def get_changes(self, since):
+        resp = self.send_request('/api/changes?since={}'.format(since))
+        self.assertEqual(resp.status_int, 200)
+        return json.loads(resp.body)
+
+    def test_needs_auth(self):
+        resp = self.send_request('/api/changes?since=0')
+        self.assertEqual(403, resp.status_int)
+
+    def test_invalid_token(self):
+        self.set_auth_user(self.user)
+        for path in ('/api/changes', '/api/changes?since=x',
+                     '/api/changes?since=-1'):
+            self.assertEqual(self.send_request(path).status_int, 400)
+
+    def test_changes(self):
+        """ Should return changed jobs and token. """
+        self.set_auth_user(self.user)
+        self.assertEqual(self.get_changes(0),
+                         {'sendJobs': [], 'remindJobs': [], 'token': '0'})
+        job = create_remind_job(user_id=self.user.user_id(),
+                                thread_id='333')
+        job.state = 'disabled'
+        job.save()
+        result = self.get_changes(0)
+        self.assertEqual(result['sendJobs'], [])
+        self.assertEqual(len(result['remindJobs']), 1)
+        self.assertDictContainsSubset({'id': job.key.id(),
+                                       'state': 'disabled'},
+                                      result['remindJobs'][0])
+        self.assertEqual(self.get_changes(job.version)['remindJobs'], [])
+
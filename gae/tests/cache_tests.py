@@ -0,0 +1,100 @@
+import unittest
+import threading
+import time
+
+from w69b import cache
+
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = cache.LRUCache(maxsize=3, clock=lambda: self.now)
+
+    def test_evicts_least_recently_used(self):
+        for i in xrange(3):
+            self.cache.set(i, str(i))
+        self.assertEqual(self.cache.get(0), '0')
+        self.cache.set(3, '3')
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_ttl(self):
+        self.cache.set('a', 1, ttl=10)
+        self.cache.ttl = 20
+        self.cache.set('b', 2)
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+        self.now = 20
+        self.assertNotIn('b', self.cache)
+        self.assertEqual(self.cache.expirations, 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_maxbytes(self):
+        evicted = []
+        lru = cache.LRUCache(maxsize=100, maxbytes=10, sizeof=len,
+                             on_evict=lambda key, value: evicted.append(key))
+        lru.set('a', 'aaaa')
+        lru.set('b', 'bbbb')
+        lru.set('c', 'cccc')
+        self.assertEqual(evicted, ['a'])
+        self.assertEqual(lru.currbytes, 8)
+        lru.set('b', 'b')
+        self.assertEqual(lru.currbytes, 5)
+        lru.delete('c')
+        self.assertEqual(lru.stats()['bytes'], 1)
+
+    def test_get_or_load_single_flight(self):
+        calls = []
+
+        def load():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.cache.get_or_load('k', load)))
+            for _ in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 10)
+
+    def test_get_or_load_error(self):
+        def fail():
+            raise IOError()
+
+        with self.assertRaises(IOError):
+            self.cache.get_or_load('k', fail)
+        self.assertEqual(self.cache.get_or_load('k', lambda: 1), 1)
+
+    def test_clear(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+
+class LRUCacheDecoratorTest(unittest.TestCase):
+    def test_cached(self):
+        calls = []
+
+        @cache.lru_cache(maxsize=2)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual([square(2), square(2), square(3)], [4, 4, 9])
+        self.assertEqual(calls, [2, 3])
+        self.assertEqual((square.hits, square.misses), (1, 2))
+        square(4)
+        square(2)
+        self.assertEqual(calls, [2, 3, 4, 2])
+        square.clear()
+        self.assertEqual(square.hits, 0)
@@ -4,6 +4,12 @@ import mock
 import imapclient
 import smtplib
 import datetime
+import email.parser
+import StringIO
+import zlib
+
+from google.appengine.ext import testbed
+from google.appengine.api import memcache
 
 from sndlatr import gmail
 from tests import fixture_file_content
@@ -31,7 +37,17 @@ class SMTPClientMockHelper():
         self.constructor_mock = patcher.start()
         client = self.constructor_mock.return_value
         self.client_mock = client
-        client.docmd.return_value = (235, '')
+        # AUTH succeeds with 235, DATA is accepted with 354
+        client.docmd.side_effect = \
+            lambda cmd, *args: (354, '') if cmd == 'data' else (235, '')
+        client.mail.return_value = (250, '')
+        client.rcpt.return_value = (250, '')
+        client.getreply.return_value = (250, '')
+
+
+# key of the header fields in fetch responses
+HEADER_FIELDS_KEY = ('BODY[HEADER.FIELDS (MESSAGE-ID IN-REPLY-TO REFERENCES '
+                     'SUBJECT FROM DATE)]')
 
 
 def raise_imap(*args, **kwargs):
@@ -40,6 +56,11 @@ def raise_imap(*args, **kwargs):
 
 class IMAPSessionTest(unittest.TestCase):
     def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+        self.addCleanup(gmail.folder_cache.clear)
         self.mock_helper = IMAPClientMockHelper()
         self.addCleanup(self.mock_helper.cleanup)
         self.session = gmail.IMAPSession(
@@ -47,6 +68,7 @@ class IMAPSessionTest(unittest.TestCase):
 
     def test_raises_mailbox_not_exists(self):
         """ Should raise in if trash or all mailbox does not exist """
+        gmail.IMAPSession.invalidate_folder_cache('testuser')
         self.mock_helper.client_mock.list_folders.return_value = [
             [['\All'], '/', 'myAll']]
         with self.assertRaises(gmail.MailboxNotFound):
@@ -66,6 +88,66 @@ class IMAPSessionTest(unittest.TestCase):
     def test_get_all_box(self):
         self.assertEquals('myAll', self.session.get_all_box())
 
+    def test_condstore(self):
+        client = self.mock_helper.client_mock
+        self.assertFalse(self.session.condstore)
+        self.assertEqual(self.session.get_all_box_status(), {})
+        self.assertFalse(client.select_folder.called)
+
+        client.capabilities = ('IMAP4REV1', 'CONDSTORE')
+        client.enable.return_value = ['CONDSTORE']
+        client.select_folder.return_value = {'EXISTS': 3, 'UIDVALIDITY': 1,
+                                             'HIGHESTMODSEQ': 9}
+        session = gmail.IMAPSession('testuser', 'testtoken')
+        client.enable.assert_called_with('CONDSTORE')
+        self.assertTrue(session.condstore)
+        self.assertEqual(session.get_all_box_status(),
+                         {'UIDVALIDITY': 1, 'HIGHESTMODSEQ': 9})
+        client.select_folder.assert_called_once_with('myAll')
+        # no further commands while the all box is selected
+        session.get_all_box_status()
+        self.assertEqual(client.select_folder.call_count, 1)
+        self.assertFalse(client.folder_status.called)
+
+    def test_caches_folders(self):
+        client = self.mock_helper.client_mock
+        client.list_folders.reset_mock()
+        session = gmail.IMAPSession('testuser', 'testtoken')
+        self.assertFalse(client.list_folders.called)
+        self.assertEquals('mytrash', session.get_trash_box())
+
+        # memcache is shared with other instances
+        gmail.folder_cache.clear()
+        gmail.IMAPSession('testuser', 'testtoken')
+        self.assertFalse(client.list_folders.called)
+
+        gmail.IMAPSession('otheruser', 'testtoken')
+        self.assertTrue(client.list_folders.called)
+
+    def test_select_renamed_folder(self):
+        client = self.mock_helper.client_mock
+        client.list_folders.return_value = [
+            [['\All'], '/', 'renamedAll'],
+            [['\Trash'], '/', 'mytrash']]
+
+        def select_folder(mailbox):
+            if mailbox == 'myAll':
+                raise gmail.IMAPError('[NONEXISTENT] Unknown Mailbox: myAll')
+
+        client.select_folder.side_effect = select_folder
+        self.session.select_folder(self.session.get_all_box())
+        client.select_folder.assert_called_with('renamedAll')
+        self.assertEquals('renamedAll', self.session.get_all_box())
+        session = gmail.IMAPSession('testuser', 'testtoken')
+        self.assertEquals('renamedAll', session.get_all_box())
+
+    def test_select_nonexistent_folder(self):
+        client = self.mock_helper.client_mock
+        client.select_folder.side_effect = gmail.IMAPError(
+            '[NONEXISTENT] Unknown Mailbox: foo')
+        with self.assertRaises(gmail.MailboxNotFound):
+            self.session.select_folder('foo')
+
     def test_copy_labels_to_sent(self):
         client = self.mock_helper.client_mock
         client.search.return_value = [123]
@@ -90,6 +172,107 @@ class IMAPSessionTest(unittest.TestCase):
         client.fetch.assert_called_with('33', ['RFC822', 'X-GM-LABELS'])
         self.assertEqual(rfc_mail, mail.rfc_message)
 
+    def test_get_mail_chunked(self):
+        client = self.mock_helper.client_mock
+        client.search.return_value = ['33']
+        rfc_mail = fixture_file_content('mail_rfc822.txt')
+
+        def fetch(uid, items):
+            if items == ['RFC822.SIZE', 'X-GM-LABELS']:
+                return {uid: {'RFC822.SIZE': len(rfc_mail),
+                              'X-GM-LABELS': ['label']}}
+            if items == ['RFC822', 'X-GM-LABELS']:
+                return {uid: {'RFC822': rfc_mail, 'X-GM-LABELS': ['label']}}
+            offset, length = map(int, items[0][12:-1].split('.'))
+            return {uid: {'BODY[]<{}>'.format(offset):
+                          rfc_mail[offset:offset + length]}}
+
+        client.fetch.side_effect = fetch
+        mail = self.session.get_mail(12345, max_size=100)
+        self.assertIsNone(mail.rfc_message)
+        self.assertEqual(mail.labels, ['label'])
+        self.assertEqual(''.join(mail.chunks), rfc_mail)
+        chunks = list(self.session.iter_mail_chunks('33', len(rfc_mail),
+                                                    chunk_size=100))
+        self.assertEqual(len(chunks[0]), 100)
+        self.assertEqual(''.join(chunks), rfc_mail)
+
+        client.fetch.reset_mock()
+        mail = self.session.get_mail(12345, max_size=len(rfc_mail))
+        self.assertIsNone(mail.chunks)
+        client.fetch.assert_called_with('33', ['RFC822', 'X-GM-LABELS'])
+
+    def setup_prefetch_mock(self, rfc_mail):
+        client = self.mock_helper.client_mock
+        client.select_folder.return_value = {'UIDVALIDITY': 7}
+        client.search.return_value = ['33']
+
+        def fetch(uid, items):
+            msg = {'RFC822.SIZE': len(rfc_mail), 'X-GM-LABELS': ['label'],
+                   'RFC822': rfc_mail}
+            return {uid: {item: msg[item] for item in items}}
+
+        client.fetch.side_effect = fetch
+        return client
+
+    def test_prefetch_mail(self):
+        """ Should use prefetched mail instead of fetching it again. """
+        rfc_mail = fixture_file_content('mail_rfc822.txt')
+        client = self.setup_prefetch_mock(rfc_mail)
+        self.assertTrue(self.session.prefetch_mail(12345, 'secret'))
+        client.fetch.assert_called_with('33', ['RFC822'])
+        # only stored encrypted
+        cached = memcache.get('prefetched_mail:testuser:12345')
+        self.assertNotIn(zlib.compress(rfc_mail), cached['data'])
+
+        client.fetch.reset_mock()
+        mail = self.session.get_mail(12345, max_size=100,
+                                     prefetch_secret='secret')
+        self.assertEqual(mail.rfc_message, rfc_mail)
+        self.assertEqual(mail.labels, ['label'])
+        client.fetch.assert_called_once_with('33', ['RFC822.SIZE',
+                                                    'X-GM-LABELS'])
+        # prefetched mail is used once
+        mail = self.session.get_mail(12345, max_size=100,
+                                     prefetch_secret='secret')
+        self.assertIsNone(mail.rfc_message)
+        self.assertIsNone(memcache.get('prefetched_mail:testuser:12345'))
+
+    def test_prefetch_mail_other_secret(self):
+        """ Should ignore prefetched mail encrypted with another secret. """
+        rfc_mail = fixture_file_content('mail_rfc822.txt')
+        client = self.setup_prefetch_mock(rfc_mail)
+        self.session.prefetch_mail(12345, 'secret')
+        mail = self.session.get_mail(12345, max_size=len(rfc_mail),
+                                     prefetch_secret='other')
+        client.fetch.assert_called_with('33', ['RFC822', 'X-GM-LABELS'])
+        self.assertEqual(mail.rfc_message, rfc_mail)
+
+    def test_prefetch_mail_outdated(self):
+        """ Should ignore prefetched mail if uid of message changed. """
+        rfc_mail = fixture_file_content('mail_rfc822.txt')
+        client = self.setup_prefetch_mock(rfc_mail)
+        self.session.prefetch_mail(12345, 'secret')
+        client.search.return_value = ['34']
+        mail = self.session.get_mail(12345, max_size=len(rfc_mail),
+                                     prefetch_secret='secret')
+        client.fetch.assert_called_with('34', ['RFC822', 'X-GM-LABELS'])
+        self.assertEqual(mail.rfc_message, rfc_mail)
+
+    def test_prefetch_mail_too_large(self):
+        client = self.setup_prefetch_mock('x' * 200)
+        self.assertFalse(self.session.prefetch_mail(12345, 'secret',
+                                                    max_size=100))
+        client.fetch.assert_called_once_with('33', ['RFC822.SIZE'])
+
+    def test_seal(self):
+        sealed = gmail.seal('secret', 'context', 'data')
+        self.assertNotIn('data', sealed)
+        self.assertEqual(gmail.unseal('secret', 'context', sealed), 'data')
+        self.assertIsNone(gmail.unseal('other', 'context', sealed))
+        self.assertIsNone(gmail.unseal('secret', 'other', sealed))
+        self.assertIsNone(gmail.unseal('secret', 'context', sealed[:-1]))
+
     def test_mark_as_sent_missing(self):
         self.session.get_mail = mock.Mock(return_value=None)
         self.session.mark_as_sent(123, 'rfcid', None)
@@ -120,20 +303,20 @@ class IMAPSessionTest(unittest.TestCase):
         client.search.return_value = ['33', '43']
         client.fetch.return_value = {
             '43': {
-                'RFC822.HEADER': fixture_file_content(
+                HEADER_FIELDS_KEY: fixture_file_content(
                     'mail2_header_rfc822.txt'),
                 'X-GM-MSGID': 200
             },
             '33': {
-                'RFC822.HEADER': fixture_file_content(
+                HEADER_FIELDS_KEY: fixture_file_content(
                     'mail1_header_rfc822.txt'),
                 'X-GM-MSGID': 110
             },
         }
         msgs = self.session.get_thread(1234)
         client.search.assert_called_with('X-GM-THRID 1234')
-        client.fetch.assert_called_with(['33', '43'],
-                                        ['X-GM-MSGID', 'RFC822.HEADER'])
+        client.fetch.assert_called_with(
+            ['33', '43'], ['X-GM-MSGID', gmail.THREAD_HEADER_ITEM])
         self.assertEqual(2, len(msgs))
         mail1 = msgs[0]
         self.assertDictContainsSubset({
@@ -150,11 +333,90 @@ class IMAPSessionTest(unittest.TestCase):
         self.assertDictContainsSubset({'subject': 'Mail2 Subject',
                                        'from_name': 'Example'}, mail2)
 
+    def test_get_thread_since_uid(self):
+        client = self.mock_helper.client_mock
+        client.select_folder.return_value = {'UIDVALIDITY': 7}
+        # UID 50:* matches the highest uid even if it is lower than 50
+        client.search.return_value = [43]
+        msgs = self.session.get_thread(1234, since_uid=49, uid_validity=7)
+        client.search.assert_called_with('X-GM-THRID 1234 UID 50:*')
+        self.assertEqual(msgs, [])
+        self.assertFalse(client.fetch.called)
+
+        client.search.return_value = [43, 51]
+        client.fetch.return_value = {51: {
+            HEADER_FIELDS_KEY: fixture_file_content('mail2_header_rfc822.txt'),
+            'X-GM-MSGID': 2222}}
+        msgs = self.session.get_thread(1234, since_uid=49, uid_validity=7)
+        client.fetch.assert_called_with([51], ['X-GM-MSGID',
+                                               gmail.THREAD_HEADER_ITEM])
+        self.assertDictContainsSubset({'uid': 51, 'uid_validity': 7}, msgs[0])
+
+    def test_get_thread_uid_validity_changed(self):
+        client = self.mock_helper.client_mock
+        client.select_folder.return_value = {'UIDVALIDITY': 8}
+        client.search.return_value = []
+        self.session.get_thread(1234, since_uid=49, uid_validity=7)
+        client.search.assert_called_with('X-GM-THRID 1234')
+
+    def test_get_threads(self):
+        """
+        Should search all threads at once and group messages by thread id.
+        """
+        client = self.mock_helper.client_mock
+        client.search.return_value = ['43', '33']
+        client.fetch.return_value = {
+            33: {HEADER_FIELDS_KEY: fixture_file_content(
+                'mail1_header_rfc822.txt'),
+                'X-GM-MSGID': 110, 'X-GM-THRID': 1},
+            43: {HEADER_FIELDS_KEY: fixture_file_content(
+                'mail2_header_rfc822.txt'),
+                'X-GM-MSGID': 200, 'X-GM-THRID': 2},
+        }
+        threads = self.session.get_threads([1, 2, 3])
+        client.search.assert_called_once_with(
+            'OR OR X-GM-THRID 1 X-GM-THRID 2 X-GM-THRID 3')
+        client.fetch.assert_called_once_with(
+            [33, 43], ['X-GM-THRID', 'X-GM-MSGID', gmail.THREAD_HEADER_ITEM])
+        self.assertEqual(sorted(threads.keys()), [1, 2, 3])
+        self.assertEqual(threads[1][0]['subject'], 'Mail1 Subject')
+        self.assertEqual(threads[2][0]['subject'], 'Mail2 Subject')
+        self.assertEqual(threads[3], [])
+
+    def test_get_threads_chunked(self):
+        client = self.mock_helper.client_mock
+        client.search.return_value = []
+        threads = self.session.get_threads([1, 2, 3], chunk_size=2)
+        self.assertEqual(client.search.call_args_list, [
+            mock.call('OR X-GM-THRID 1 X-GM-THRID 2'),
+            mock.call('X-GM-THRID 3')])
+        self.assertFalse(client.fetch.called)
+        self.assertEqual(threads, {1: [], 2: [], 3: []})
+
+    def test_get_threads_since_uid(self):
+        client = self.mock_helper.client_mock
+        client.select_folder.return_value = {'UIDVALIDITY': 7}
+        client.search.return_value = [43]
+        threads = self.session.get_threads([1, 2], since_uid=49,
+                                           uid_validity=7)
+        client.search.assert_called_with(
+            'OR X-GM-THRID 1 X-GM-THRID 2 UID 50:*')
+        self.assertFalse(client.fetch.called)
+        self.assertEqual(threads, {1: [], 2: []})
+
+    def test_parse_header_fields(self):
+        fields = gmail.parse_header_fields(
+            'References: <a>\r\n <b>\r\nSubject:  x \r\nfrom: a\r\n'
+            'From: b\r\n\r\n')
+        self.assertEqual(fields, {'references': '<a>\r\n <b>',
+                                  'subject': 'x ',
+                                  'from': 'a'})
+
     def setup_single_thread_mock(self):
         client = self.mock_helper.client_mock
         client.search.return_value = ['33', '43']
         client.fetch.return_value = {'43': {
-            'RFC822.HEADER': fixture_file_content(
+            HEADER_FIELDS_KEY: fixture_file_content(
                 'mail2_header_rfc822.txt'),
             'X-GM-MSGID': 2222
         }}
@@ -197,8 +459,52 @@ class SMTPSessionTest(unittest.TestCase):
         client = self.mock_helper.client_mock
         mail = fixture_file_content('mail_rfc822.txt')
         self.session.send_rfc822(mail)
-        client.sendmail.assert_called_once_with('thembrown@gmail.com',
-                                                receivers, mock.ANY)
+        client.mail.assert_called_once_with('thembrown@gmail.com')
+        self.assertEqual([args[0][0] for args in client.rcpt.call_args_list],
+                         receivers)
+        client.docmd.assert_called_with('data')
+        data = ''.join(args[0][0] for args in client.send.call_args_list)
+        self.assertTrue(data.endswith('\r\n.\r\n'))
+        body = gmail.split_rfc822(mail)[1].tobytes()
+        self.assertIn(body.replace('\n', '\r\n'), data)
+
+    def test_send_stream(self):
+        client = self.mock_helper.client_mock
+        fd = StringIO.StringIO('Subject: x\n\n.dot\nline\r\n..')
+        refused = self.session.send_stream('from@example.com',
+                                           ['to@example.com'], fd)
+        self.assertEqual(refused, {})
+        data = ''.join(args[0][0] for args in client.send.call_args_list)
+        self.assertEqual(data, 'Subject: x\r\n\r\n..dot\r\nline\r\n'
+                               '...\r\n.\r\n')
+
+    def test_send_stream_refused(self):
+        client = self.mock_helper.client_mock
+        client.rcpt.return_value = (550, 'no such user')
+        with self.assertRaises(gmail.InvalidEmail):
+            self.session.send_stream('from@example.com', ['to@example.com'],
+                                     ['Subject: x\r\n\r\nbody'])
+        self.assertFalse(client.send.called)
+
+    def test_send_stream_body_error(self):
+        client = self.mock_helper.client_mock
+
+        def message():
+            yield 'Subject: x\r\n\r\nfirst chunk\r\n'
+            raise gmail.IMAPError('fetch failed')
+
+        with self.assertRaises(gmail.IMAPError):
+            self.session.send_stream('from@example.com', ['to@example.com'],
+                                     message())
+        self.assertEqual(client.send.call_count, 1)
+        self.assertTrue(client.close.called)
+        self.assertFalse(client.quit.called)
+        self.assertFalse(client.getreply.called)
+
+    def test_smtp_data_chunks(self):
+        chunks = ['a\r', '\n.b\n', '.c\rd', '']
+        self.assertEqual(''.join(gmail.smtp_data_chunks(chunks)),
+                         'a\r\n..b\r\n..c\r\nd\r\n.\r\n')
 
 
 class SendMailRewriterTest(unittest.TestCase):
@@ -243,6 +549,33 @@ class SendMailRewriterTest(unittest.TestCase):
         self.assertNotIn('Bcc', self.rewriter.message)
 
 
+class HeadersOnlySendMailRewriterTest(SendMailRewriterTest):
+    def setUp(self):
+        self.rfc822 = fixture_file_content('mail_rfc822.txt')
+        self.rewriter = gmail.MailSendRewriter(self.rfc822, headers_only=True)
+
+    def test_split_rfc822(self):
+        header, body = gmail.split_rfc822('A: b\r\nC: d\r\n\r\nbody\r\n')
+        self.assertEqual(header, 'A: b\r\nC: d\r\n')
+        self.assertIsInstance(body, memoryview)
+        self.assertEqual(body.tobytes(), 'body\r\n')
+        header, body = gmail.split_rfc822('A: b\n\nbody\n')
+        self.assertEqual(header, 'A: b\n')
+        self.assertEqual(body.tobytes(), 'body\n')
+        header, body = gmail.split_rfc822('A: b\r\n')
+        self.assertEqual(body.tobytes(), '')
+
+    def test_body_untouched(self):
+        self.rewriter.rewrite()
+        self.rewriter.message['Message-Id'] = '<new@example.com>'
+        _, orig_body = gmail.split_rfc822(self.rfc822)
+        header, body = gmail.split_rfc822(self.rewriter.message_as_str())
+        self.assertEqual(body.tobytes(), orig_body.tobytes())
+        message = email.parser.HeaderParser().parsestr(header)
+        self.assertNotIn('Bcc', message)
+        self.assertIn('<new@example.com>', message.get_all('Message-Id'))
+
+
 class MailmanTest(unittest.TestCase):
     def setUp(self):
         imap_patcher = mock.patch('sndlatr.gmail.IMAPSession')
@@ -263,12 +596,36 @@ class MailmanTest(unittest.TestCase):
 
         self.mailman.send_draft(123, 'test_rfc')
 
-        imap.get_mail.assert_called_with(123)
+        imap.get_mail.assert_called_with(123, max_size=mock.ANY,
+                                         prefetch_secret=None)
         self.assertTrue(smtp.send_rfc822.called)
-        message = smtp.send_rfc822.call_args[0][0]
-        self.assertEqual(message['Message-ID'], 'test_rfc')
+        rewriter = smtp.send_rfc822.call_args[0][0]
+        self.assertEqual(rewriter.message['Message-ID'], 'test_rfc')
+        # body is not re-encoded
+        self.assertEqual(rewriter.body.tobytes(),
+                         gmail.split_rfc822(mail.rfc_message)[1].tobytes())
         self.assertFalse(imap.delete_message.called)
 
+    def test_send_draft_chunked(self):
+        imap = self.imap_mock
+        smtp = self.smtp_mock
+        rfc_mail = fixture_file_content('mail_rfc822.txt')
+        mail = gmail.Mail(None, chunks=[rfc_mail[:100], rfc_mail[100:1000],
+                                        rfc_mail[1000:]])
+        imap.get_mail.return_value = mail
+
+        self.mailman.send_draft(123, 'test_rfc')
+        rewriter = smtp.send_rfc822.call_args[0][0]
+        self.assertEqual(rewriter.message['Message-ID'], 'test_rfc')
+        data = ''.join(rewriter.message_chunks())
+        self.assertEqual(gmail.split_rfc822(data)[1].tobytes(),
+                         gmail.split_rfc822(rfc_mail)[1].tobytes())
+
+    def test_quit(self):
+        self.mailman.mark_as_sent(123, sent_message_rfc_id='sentrfc')
+        self.mailman.quit()
+        self.assertTrue(self.imap_mock.quit.called)
+
     def test_mark_as_sent(self):
         self.mailman.mark_as_sent(123, sent_message_rfc_id='sentrfc',
                                   mail='mymail')
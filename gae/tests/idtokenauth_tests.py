@@ -0,0 +1,158 @@
+import unittest
+import json
+import hashlib
+
+import mock
+import httplib2
+from oauth2client import crypt
+
+from w69b import idtokenauth, cache
+
+
+def build_response(certs, status=200, headers=None):
+    info = {'status': status}
+    info.update(headers or {})
+    return httplib2.Response(info), json.dumps(certs)
+
+
+class CertManagerTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('oauth2client.crypt.Verifier.from_string')
+        from_string = patcher.start()
+        from_string.side_effect = lambda pem, is_x509: 'verifier-' + pem
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('time.time', return_value=1000.0)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.http = mock.Mock()
+        self.http.request.return_value = build_response(
+            {'k1': 'pem1'}, headers={'cache-control': 'public, max-age=100'})
+        self.certs = idtokenauth.CertManager('http://certs', http=self.http)
+
+    def test_unknown_kid(self):
+        """ Should refresh certs once for an unknown kid. """
+        self.assertEqual(self.certs.get_verifiers('k1'), ['verifier-pem1'])
+        self.http.request.return_value = build_response(
+            {'k1': 'pem1', 'k2': 'pem2'})
+        # at most once per MIN_CERTS_REFRESH_INTERVAL
+        self.time.return_value += 1
+        self.assertEqual(self.certs.get_verifiers('k2'), [])
+        self.assertEqual(self.http.request.call_count, 1)
+        self.time.return_value += idtokenauth.MIN_CERTS_REFRESH_INTERVAL
+        self.assertEqual(self.certs.get_verifiers('k2'), ['verifier-pem2'])
+        self.assertEqual(self.certs.get_verifiers('k3'), [])
+        self.assertEqual(self.certs.get_verifiers('k3'), [])
+        self.assertEqual(self.http.request.call_count, 2)
+
+    def test_max_age(self):
+        """ Should cache certs for max-age minus Age of the response. """
+        self.http.request.return_value = build_response(
+            {'k1': 'pem1'}, headers={'cache-control': 'public, max-age=100',
+                                     'age': '40'})
+        self.certs.get_verifiers('k1')
+        self.time.return_value += 59
+        self.certs.get_verifiers('k1')
+        self.assertEqual(self.http.request.call_count, 1)
+        self.time.return_value += 1
+        self.certs.get_verifiers('k1')
+        self.assertEqual(self.http.request.call_count, 2)
+
+    def test_default_max_age(self):
+        self.http.request.return_value = build_response({'k1': 'pem1'})
+        self.certs.get_verifiers()
+        self.time.return_value += idtokenauth.DEFAULT_CERTS_MAX_AGE - 1
+        self.certs.get_verifiers()
+        self.assertEqual(self.http.request.call_count, 1)
+
+    def test_failed_fetch_keeps_certs(self):
+        """ Should keep using old certs if fetching new ones fails. """
+        self.certs.get_verifiers('k1')
+        self.http.request.return_value = build_response({}, status=500)
+        self.time.return_value += 100
+        self.assertEqual(self.certs.get_verifiers('k1'), ['verifier-pem1'])
+        self.assertEqual(self.http.request.call_count, 2)
+        # not fetched again right away
+        self.certs.get_verifiers('k1')
+        self.assertEqual(self.http.request.call_count, 2)
+
+        self.http.request.side_effect = IOError()
+        self.time.return_value += idtokenauth.MIN_CERTS_REFRESH_INTERVAL
+        self.assertEqual(self.certs.get_verifiers('k1'), ['verifier-pem1'])
+        self.assertEqual(self.http.request.call_count, 3)
+
+    def test_failed_first_fetch(self):
+        self.http.request.return_value = build_response({}, status=500)
+        with self.assertRaises(idtokenauth.client.VerifyJwtTokenError):
+            self.certs.get_verifiers('k1')
+
+
+class VerifiedTokenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        patcher = mock.patch('time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(
+            idtokenauth, 'verified_token_cache',
+            cache.LRUCache(maxsize=10, clock=lambda: self.now))
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('w69b.idtokenauth.verify_id_token')
+        self.verify = patcher.start()
+        self.verify.side_effect = self.fake_verify
+        self.addCleanup(patcher.stop)
+        self.payload = {'iat': 1000, 'exp': 1600, 'aud': 'myaud',
+                        'email': 'test@example.com', 'sub': '123'}
+
+    def fake_verify(self, token, audience):
+        """ Verifies claims of self.payload, signatures are not checked. """
+        idtokenauth._verify_claims(self.payload, audience,
+                                   json.dumps(self.payload))
+        return self.payload
+
+    def test_cached(self):
+        user = idtokenauth._user_from_token('token', 'myaud')
+        self.assertEqual(user.user_id(), '123')
+        self.assertIs(idtokenauth._user_from_token('token', 'myaud'), user)
+        self.assertEqual(self.verify.call_count, 1)
+
+    def test_key_is_token_hash(self):
+        idtokenauth._user_from_token('token', 'myaud')
+        self.assertIn(('myaud', hashlib.sha256('token').digest()),
+                      self.cache)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_expires_at_exp(self):
+        """ Should verify token again once it expired. """
+        idtokenauth._user_from_token('token', 'myaud')
+        self.now = 1599
+        self.assertIsNotNone(idtokenauth._user_from_token('token', 'myaud'))
+        self.assertEqual(self.verify.call_count, 1)
+        self.now = 1600
+        self.assertNotIn(('myaud', hashlib.sha256('token').digest()),
+                         self.cache)
+        # expired tokens are rejected after the clock skew
+        self.now = 1600 + crypt.CLOCK_SKEW_SECS + 1
+        self.assertIsNone(idtokenauth._user_from_token('token', 'myaud'))
+        self.assertEqual(self.verify.call_count, 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expired_not_cached(self):
+        self.now = 1600 + crypt.CLOCK_SKEW_SECS + 1
+        self.assertIsNone(idtokenauth._user_from_token('token', 'myaud'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_wrong_audience(self):
+        """ Should not serve user cached for another audience. """
+        idtokenauth._user_from_token('token', 'myaud')
+        self.assertIsNone(idtokenauth._user_from_token('token', 'otheraud'))
+        self.assertEqual(self.verify.call_count, 2)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_verify_claims(self):
+        idtokenauth._verify_claims(self.payload, 'myaud', '')
+        with self.assertRaises(crypt.AppIdentityError):
+            idtokenauth._verify_claims(self.payload, 'otheraud', '')
+        self.now = 1600 + crypt.CLOCK_SKEW_SECS + 1
+        with self.assertRaises(crypt.AppIdentityError):
+            idtokenauth._verify_claims(self.payload, 'myaud', '')
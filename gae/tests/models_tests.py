@@ -1,14 +1,16 @@
 import unittest
 import datetime
 import json
+import calendar
+import threading
 
 from google.appengine.ext import ndb, testbed
-from google.appengine.api import datastore_errors
+from google.appengine.api import datastore_errors, memcache
 import oauth2client.client
 import mock
 from google.appengine.api import mail as gae_mail
 
-from sndlatr import models, gmail
+from sndlatr import models, gmail, validation, metrics, push
 from tests import BaseTestCase
 from tests.common import *
 from tests import fixture_file_content
@@ -18,9 +20,16 @@ from tests import fixture_file_content
 def mailman_mock():
     with mock_instance('sndlatr.gmail.Mailman') as mailman:
         mailman.send_draft.return_value = 'testmail'
+        mailman.get_all_box_status.return_value = {}
         yield mailman
 
 
+def create_mailman_mock():
+    mailman = mock.create_autospec(gmail.Mailman)
+    mailman.get_all_box_status.return_value = {}
+    return mailman
+
+
 class AccountTest(BaseTestCase):
     def test_credentials_required(self):
         account = models.Account(email='test@example.com', id='1234')
@@ -38,6 +47,549 @@ class AccountTest(BaseTestCase):
         account.put()
 
 
+class AccessTokenTest(BaseTestCase):
+    def setUp(self):
+        super(AccessTokenTest, self).setUp()
+        patcher = mock.patch('sndlatr.models.get_credentials')
+        self.getter = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.credentials = self.getter.return_value
+        self.credentials.access_token = 'token1'
+        self.credentials.token_expiry = (datetime.datetime.utcnow() +
+                                         datetime.timedelta(hours=1))
+
+    def test_cached(self):
+        """ Should refresh token only once while it is valid. """
+        self.assertEqual(models.get_access_token('user1'), 'token1')
+        self.assertEqual(models.get_access_token('user1'), 'token1')
+        self.assertEqual(self.credentials.refresh.call_count, 1)
+        self.assertEqual(metrics.get(metrics.ACCESS_TOKEN_REFRESHES), 1)
+        self.assertEqual(metrics.get(metrics.ACCESS_TOKEN_CACHE_HITS), 1)
+
+        # other instances get it from memcache
+        models.access_token_cache.clear()
+        self.assertEqual(models.get_access_token('user1'), 'token1')
+        self.assertEqual(self.credentials.refresh.call_count, 1)
+
+        models.get_access_token('user2')
+        self.assertEqual(self.credentials.refresh.call_count, 2)
+
+    def test_expiry_margin(self):
+        """ Should refresh token if it expires soon. """
+        self.credentials.token_expiry = (
+            datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=models.ACCESS_TOKEN_EXPIRY_MARGIN - 10))
+        models.get_access_token('user1')
+        models.get_access_token('user1')
+        self.assertEqual(self.credentials.refresh.call_count, 2)
+
+    def test_invalidate(self):
+        models.get_access_token('user1')
+        models.invalidate_access_token('user1')
+        self.credentials.access_token = 'token2'
+        self.assertEqual(models.get_access_token('user1'), 'token2')
+        self.assertEqual(self.credentials.refresh.call_count, 2)
+
+    def test_no_credentials(self):
+        self.getter.return_value = None
+        self.assertIsNone(models.get_access_token('user1'))
+
+    def test_refresh_error(self):
+        self.credentials.refresh.side_effect = \
+            oauth2client.client.AccessTokenRefreshError()
+        with self.assertRaises(oauth2client.client.AccessTokenRefreshError):
+            models.get_access_token('user1')
+        self.assertIsNone(models.access_token_cache.get('user1'))
+
+    def test_single_flight(self):
+        """
+        Should refresh token of a user once for concurrent requests without
+        blocking requests of other users.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def refresh(http):
+            if not started.is_set():
+                started.set()
+                release.wait()
+
+        self.credentials.refresh.side_effect = refresh
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(models.get_access_token('user1')))
+            for _ in range(3)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        # refresh of user1 is still running
+        self.assertEqual(models.get_access_token('user2'), 'token1')
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['token1'] * 3)
+        self.assertEqual(self.credentials.refresh.call_count, 2)
+        self.assertEqual(models._pending_refreshes, {})
+
+
+class PrewarmTest(BaseTestCase):
+    def test_add_prewarm_tasks(self):
+        """ Should add one task per user for jobs due in the lookahead. """
+        now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+        due = now + models.PREWARM_LOOKAHEAD
+        send_job = create_send_job(scheduled_at=due)
+        remind_job = create_remind_job(scheduled_at=due)
+        other_job = create_send_job(scheduled_at=due, user_id='other_user')
+        # not in window
+        create_send_job(scheduled_at=now)
+        create_send_job(scheduled_at=due + datetime.timedelta(minutes=1))
+        create_send_job(scheduled_at=due, state='done')
+
+        self.assertEqual(models.add_prewarm_tasks(now), 2)
+        tasks = self.taskqueue_stub.get_filtered_tasks(url=models.PREWARM_URL)
+        payloads = sorted((json.loads(task.payload) for task in tasks),
+                          key=lambda payload: payload['user_id'])
+        self.assertEqual(payloads[0], {'user_id': 'other_user',
+                                       'keys': [other_job.key.urlsafe()]})
+        self.assertEqual(payloads[1]['user_id'], 'test_user_id')
+        self.assertEqual(set(payloads[1]['keys']),
+                         {send_job.key.urlsafe(), remind_job.key.urlsafe()})
+
+        # next cron run does not add them again
+        models.add_prewarm_tasks(now + datetime.timedelta(seconds=30))
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(
+            url=models.PREWARM_URL)), 2)
+
+    def test_prewarm_user(self):
+        """ Should refresh token and prefetch drafts of scheduled jobs. """
+        send_job = create_send_job(message_id='ff')
+        done_job = create_send_job(message_id='fe', state='done')
+        remind_job = create_remind_job()
+        with mailman_mock() as mailman, \
+                mock.patch('sndlatr.models.get_access_token') as get_token, \
+                mock.patch('sndlatr.models.PREFETCH_DRAFTS', True):
+            get_token.return_value = 'token'
+            models.prewarm_user('test_user_id', [send_job.key, done_job.key,
+                                                 remind_job.key])
+            get_token.assert_called_with('test_user_id')
+            mailman.prefetch_draft.assert_called_once_with(
+                0xff, models.get_prefetch_secret())
+            self.assertTrue(mailman.quit.called)
+
+    def test_prewarm_user_no_prefetch(self):
+        """ Should not prefetch drafts unless enabled. """
+        send_job = create_send_job(message_id='ff')
+        with mailman_mock() as mailman, \
+                mock.patch('sndlatr.models.get_access_token') as get_token:
+            get_token.return_value = 'token'
+            models.prewarm_user('test_user_id', [send_job.key])
+            self.assertFalse(mailman.prefetch_draft.called)
+
+    def test_prewarm_user_no_credentials(self):
+        job = create_send_job()
+        with mailman_mock() as mailman, \
+                mock.patch('sndlatr.models.get_access_token') as get_token:
+            get_token.return_value = None
+            models.prewarm_user('test_user_id', [job.key])
+            self.assertFalse(mailman.prefetch_draft.called)
+
+
+class DashboardTest(BaseTestCase):
+    def get_displayed(self, user_id='test_user_id'):
+        entities, _ = models.Dashboard.get_displayed_async(
+            user_id).get_result()
+        return entities
+
+    def get_dashboard(self, user_id='test_user_id'):
+        return models.Dashboard.get_key(user_id).get()
+
+    def test_rebuild(self):
+        """ Should build missing dashboard from queries. """
+        send_job = create_send_job()
+        remind_job = create_remind_job()
+        snippet = create_snippet()
+        create_send_job(state='done',
+                        scheduled_at=datetime.datetime(2013, 1, 1))
+        create_send_job(user_id='other_user')
+        self.assertEqual(set(entity.key for entity in self.get_displayed()),
+                         {send_job.key, remind_job.key, snippet.key})
+        dashboard = self.get_dashboard()
+        self.assertTrue(dashboard.complete)
+        self.assertEqual(set(dashboard.get_entities()),
+                         {send_job.key, remind_job.key, snippet.key})
+
+    def test_save(self):
+        """ Should update complete dashboard with saved entities. """
+        self.assertEqual(self.get_displayed(), [])
+        job = models.SendJob(scheduled_at=datetime.datetime.utcnow(),
+                             user_id='test_user_id', message_id='4d2',
+                             user_email='test@example.com')
+        job.save()
+        with mock.patch('sndlatr.models.SendJob.query_display') as query:
+            self.assertEqual(self.get_displayed(), [job])
+            self.assertFalse(query.called)
+        job.state = 'done'
+        job.scheduled_at = datetime.datetime(2013, 1, 1)
+        job.save()
+        self.assertEqual(self.get_dashboard().get_entities(), {})
+        snippet = create_snippet()
+        snippet.save()
+        self.assertEqual(self.get_displayed(), [snippet])
+        snippet.remove()
+        self.assertIsNone(snippet.key.get())
+        self.assertEqual(self.get_displayed(), [])
+
+    def test_save_without_dashboard(self):
+        """
+        Should mark dashboard as incomplete if entities are saved before it
+        was built, and only store it once it was not written for a while.
+        """
+        old_job = create_send_job()
+        job = create_remind_job()
+        job.save()
+        self.assertFalse(self.get_dashboard().complete)
+        self.assertEqual(len(self.get_displayed()), 2)
+        self.assertFalse(self.get_dashboard().complete)
+
+        with mock.patch('sndlatr.models.DASHBOARD_REBUILD_DELAY',
+                        datetime.timedelta(0)):
+            self.assertEqual(
+                set(entity.key for entity in self.get_displayed()),
+                {old_job.key, job.key})
+        self.assertTrue(self.get_dashboard().complete)
+
+    def test_save_multi_chunks(self):
+        """ Should write many jobs of a user in multiple transactions. """
+        self.get_displayed()
+        now = datetime.datetime.utcnow()
+        jobs = [models.SendJob(scheduled_at=now, user_id='test_user_id',
+                               message_id='4d2', user_email='test@example.com')
+                for _ in xrange(models.XG_MAX_ENTITY_GROUPS * 2)]
+        jobs.append(models.SendJob(scheduled_at=now, user_id='other_user',
+                                   message_id='4d2',
+                                   user_email='test@example.com'))
+        with mock.patch('sndlatr.models.Dashboard._write_chunk_async',
+                        side_effect=models.Dashboard._write_chunk_async) \
+                as write:
+            models.Dashboard.save_multi(jobs)
+        self.assertTrue(all(job.key.get() for job in jobs))
+        dashboard = self.get_dashboard()
+        self.assertEqual(len(dashboard.get_entities()), len(jobs) - 1)
+        self.assertEqual(dashboard.version, max(job.version for job in jobs))
+        self.assertEqual(write.call_count, 3)
+
+    def test_get_changes(self):
+        """ Should return jobs saved after given version. """
+        now = datetime.datetime.utcnow()
+        self.assertEqual(models.Dashboard.get_changes('test_user_id', 0),
+                         ([], 0))
+        self.get_displayed()
+        version = self.get_dashboard().version
+        job = create_send_job()
+        job.save()
+        self.assertGreater(job.version, version)
+        other_job = create_remind_job()
+        other_job.save()
+        self.assertGreater(other_job.version, job.version)
+        create_snippet().save()
+
+        jobs, token = models.Dashboard.get_changes('test_user_id', version,
+                                                   now)
+        self.assertEqual(set(job.key for job in jobs),
+                         {job.key, other_job.key})
+        # recent writes might be missing in query results
+        self.assertEqual(token, version)
+        jobs, token = models.Dashboard.get_changes(
+            'test_user_id', job.version,
+            now + models.CHANGES_SETTLE_TIME + datetime.timedelta(seconds=1))
+        self.assertEqual([job.key for job in jobs], [other_job.key])
+        self.assertEqual(token, self.get_dashboard().version)
+        self.assertGreater(token, other_job.version)
+        self.assertEqual(models.Dashboard.get_changes('test_user_id', token),
+                         ([], token))
+
+    def test_too_big(self):
+        """ Should leave dashboards incomplete that do not fit. """
+        create_send_job()
+        with mock.patch('sndlatr.models.DASHBOARD_MAX_SIZE', 10):
+            self.assertEqual(len(self.get_displayed()), 1)
+        self.assertIsNone(self.get_dashboard())
+
+    def test_save_in_transaction(self):
+        """
+        Should update dashboard once the transaction committed and not in
+        it.
+        """
+        job = create_send_job()
+        self.get_displayed()
+
+        @ndb.transactional(xg=True)
+        def save(fail):
+            job.state = 'queued'
+            job.save()
+            self.assertNotEqual(
+                self.get_dashboard().get_entities()[job.key].state, 'queued')
+            if fail:
+                raise ndb.Rollback()
+
+        save(True)
+        self.assertEqual(self.get_dashboard().get_entities()[job.key].state,
+                         'scheduled')
+        save(False)
+        self.assertEqual(self.get_dashboard().get_entities()[job.key].state,
+                         'queued')
+
+    def test_save_publishes(self):
+        """
+        Should push saved jobs in a task once the transaction committed.
+        """
+        job = create_send_job()
+        snippet = create_snippet()
+        push.create_channel('test_user_id')
+
+        def get_messages():
+            return [json.loads(task.payload) for task in
+                    self.taskqueue_stub.get_filtered_tasks(
+                        url=push.PUBLISH_URL)]
+
+        @ndb.transactional(xg=True)
+        def save(fail):
+            job.state = 'queued'
+            models.Dashboard.save_multi([job, snippet])
+            self.assertEqual(get_messages(), [])
+            if fail:
+                raise ndb.Rollback()
+
+        save(True)
+        self.assertEqual(get_messages(), [])
+        save(False)
+        messages = get_messages()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['user_id'], 'test_user_id')
+        message = json.loads(messages[0]['message'])
+        self.assertEqual([sent['id'] for sent in message['sendJobs']],
+                         [job.key.id()])
+        self.assertEqual(message['remindJobs'], [])
+        snippet.save()
+        self.assertEqual(len(get_messages()), 1)
+        with mock.patch('sndlatr.push.publish_async') as publish:
+            publish.side_effect = Exception()
+            job.save()
+        self.assertEqual(job.key.get().state, 'queued')
+
+    def test_save_without_channels(self):
+        """ Should not add push tasks if the user has no open channels. """
+        create_send_job().save()
+        self.assertEqual(self.taskqueue_stub.get_filtered_tasks(
+            url=push.PUBLISH_URL), [])
+
+    def test_save_update_fails(self):
+        """ Should invalidate dashboard in a task if it can't be updated. """
+        self.get_displayed()
+        job = create_send_job()
+        with mock.patch('sndlatr.models.Dashboard._store_update_async') \
+                as update:
+            update.side_effect = datastore_errors.TransactionFailedError()
+            job.save()
+        self.assertIsNotNone(job.key.get())
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=models.DASHBOARD_INVALIDATE_URL)
+        self.assertEqual([json.loads(task.payload) for task in tasks],
+                         [{'user_id': 'test_user_id'}])
+
+        version = self.get_dashboard().version
+        models.Dashboard.invalidate('test_user_id')
+        dashboard = self.get_dashboard()
+        self.assertFalse(dashboard.complete)
+        self.assertGreater(dashboard.version, version)
+        with mock.patch('sndlatr.models.DASHBOARD_REBUILD_DELAY',
+                        datetime.timedelta(0)):
+            self.assertEqual([entity.key for entity in self.get_displayed()],
+                             [job.key])
+        self.assertTrue(self.get_dashboard().complete)
+
+    def test_save_out_of_order(self):
+        """ Should not replace jobs by older versions. """
+        self.get_displayed()
+        job = create_send_job()
+        job.save()
+        old = models.SendJob(key=job.key, **job.to_dict())
+        old.version = job.version - 1
+        old.state = 'queued'
+        models.Dashboard._store_update_async('test_user_id',
+                                             [old]).get_result()
+        self.assertEqual(self.get_dashboard().get_entities()[job.key].state,
+                         'scheduled')
+
+    def test_version(self):
+        """ Should change version only when writes committed. """
+        self.assertEqual(models.Dashboard.get_version('test_user_id'), 0)
+        job = create_send_job()
+        job.save()
+        version = models.Dashboard.get_version('test_user_id')
+        self.assertGreater(version, 0)
+        self.assertEqual(models.Dashboard.get_version('other_user'), 0)
+
+        @ndb.transactional(xg=True)
+        def save():
+            job.save()
+            raise ndb.Rollback()
+
+        save()
+        self.assertEqual(models.Dashboard.get_version('test_user_id'),
+                         version)
+        with mock.patch('sndlatr.models.Dashboard._write_chunk_async') \
+                as write:
+            write.side_effect = datastore_errors.TransactionFailedError()
+            with self.assertRaises(datastore_errors.TransactionFailedError):
+                job.save()
+        self.assertEqual(models.Dashboard.get_version('test_user_id'),
+                         version)
+        models.Dashboard.bump_version('test_user_id')
+        self.assertGreater(models.Dashboard.get_version('test_user_id'),
+                           version)
+        models.Dashboard.bump_version('other_user')
+        self.assertGreater(models.Dashboard.get_version('other_user'), 0)
+
+    def test_version_cached(self):
+        """
+        Should read version from memcache, raised by committed writes only.
+        """
+        self.assertEqual(models.Dashboard.get_version('test_user_id'), 0)
+        create_send_job().save()
+        with mock.patch('sndlatr.models.Dashboard.get_key') as get_key:
+            version = models.Dashboard.get_version('test_user_id')
+            self.assertFalse(get_key.called)
+        self.assertGreater(version, 0)
+        # out of order updates do not lower it
+        models.Dashboard._cache_version_async('test_user_id',
+                                              version - 1).get_result()
+        self.assertEqual(models.Dashboard.get_version('test_user_id'),
+                         version)
+        models.Dashboard.invalidate('test_user_id')
+        invalidated = models.Dashboard.get_version('test_user_id')
+        self.assertGreater(invalidated, version)
+        memcache.flush_all()
+        self.assertEqual(models.Dashboard.get_version('test_user_id'),
+                         invalidated)
+
+
+class LayoutTest(BaseTestCase):
+    def setUp(self):
+        super(LayoutTest, self).setUp()
+        self.account_key = models.Account.get_key('test_user_id')
+
+    def create_account(self, layout):
+        credentials = oauth2client.client.OAuth2Credentials(
+            'x', 'y', 'z', 'a', 'b', 'c', 'd')
+        models.Account(key=self.account_key, email='test@example.com',
+                       credentials=credentials, layout=layout).put()
+
+    def get_displayed(self):
+        entities, _ = models.Dashboard.get_displayed_async(
+            'test_user_id').get_result()
+        return entities
+
+    def get_by_ids(self, model_cls, ids):
+        return model_cls.get_by_ids_async('test_user_id', ids).get_result()
+
+    def test_save_new_under_account(self):
+        self.create_account(models.LAYOUT_ANCESTOR)
+        snippet = models.Snippet(user_id='test_user_id', name='snippet')
+        snippet.save()
+        self.assertEqual(snippet.key.parent(), self.account_key)
+        self.assertEqual(self.get_by_ids(models.Snippet, [snippet.key.id()]),
+                         [snippet])
+        self.assertEqual(self.get_displayed(), [snippet])
+
+    def test_save_moves_root_entities(self):
+        """ Should move saved entities unless they are processed. """
+        self.create_account(models.LAYOUT_MIGRATING)
+        job = create_send_job()
+        queued = create_send_job(state='queued')
+        job_id = job.key.id()
+        models.Dashboard.save_multi([job, queued])
+        self.assertEqual(job.key.parent(), self.account_key)
+        self.assertIsNone(ndb.Key(models.SendJob, job_id).get())
+        self.assertIsNone(queued.key.parent())
+        self.assertEqual(self.get_by_ids(models.SendJob,
+                                         [job_id, queued.key.id(), 444565656]),
+                         [job, queued, None])
+        self.assertEqual(len(self.get_displayed()), 2)
+        old_key = ndb.Key(models.SendJob, job_id)
+        old_bucket = models.DispatchBucket.get_key(old_key,
+                                                   job.scheduled_at).get()
+        self.assertNotIn(old_key, old_bucket.job_keys if old_bucket else [])
+        self.assertIn(job.key, models.DispatchBucket.get_key(
+            job.key, job.scheduled_at).get().job_keys)
+
+    def test_migrate_dispatch_index(self):
+        """ Should dispatch a migrated scheduled job exactly once. """
+        now = datetime.datetime.utcnow()
+        self.create_account(models.LAYOUT_ROOT)
+        job = create_send_job(scheduled_at=now)
+        old_bucket_key = models.DispatchBucket.get_key(job.key, now)
+        models.migrate_layout('test_user_id')
+        moved = self.get_by_ids(models.SendJob, [job.key.id()])[0]
+        self.assertEqual(moved.key.parent(), self.account_key)
+        # re-keyed in the dispatch index
+        old_bucket = old_bucket_key.get()
+        self.assertNotIn(job.key, old_bucket.job_keys if old_bucket else [])
+        self.assertIn(moved.key, models.DispatchBucket.get_key(
+            moved.key, now).get().job_keys)
+
+        models.DispatchBackfill(id=models.SendJob._get_kind()).put()
+        self.assertEqual(models.SendJob.dispatch_due(now, now=now), 1)
+        self.assertEqual(models.SendJob.add_all_due_to_queue(now=now), 0)
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=models.SendJob.queue_url)
+        self.assertEqual([json.loads(task.payload)['key'] for task in tasks],
+                         [moved.key.urlsafe()])
+        self.assertEqual(moved.key.get().state, 'queued')
+
+    def test_migrate(self):
+        self.create_account(models.LAYOUT_ROOT)
+        job = create_send_job()
+        checking = create_remind_job(state='checking')
+        create_snippet()
+        other_job = create_send_job(user_id='other_user')
+        models.migrate_layout('test_user_id')
+        self.assertEqual(self.account_key.get().layout,
+                         models.LAYOUT_MIGRATING)
+        moved = self.get_by_ids(models.SendJob, [job.key.id()])[0]
+        self.assertEqual(moved.key.parent(), self.account_key)
+        self.assertIsNotNone(checking.key.get())
+        self.assertIsNotNone(other_job.key.get())
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(
+            url=models.MIGRATE_LAYOUT_URL)), 1)
+
+        # not processed anymore
+        checking.state = 'scheduled'
+        checking.save()
+        models.migrate_layout('test_user_id', passes=1)
+        self.assertEqual(self.account_key.get().layout,
+                         models.LAYOUT_ANCESTOR)
+        displayed = self.get_displayed()
+        self.assertEqual(len(displayed), 3)
+        self.assertTrue(all(entity.key.parent() == self.account_key
+                            for entity in displayed))
+
+    def test_migrate_continuation(self):
+        self.create_account(models.LAYOUT_ROOT)
+        for _ in xrange(2):
+            create_send_job()
+        with mock.patch('sndlatr.models.MIGRATE_PAGE_SIZE', 1):
+            models.migrate_layout('test_user_id', time_budget=-1)
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=models.MIGRATE_LAYOUT_URL)
+        self.assertEqual(len(tasks), 1)
+        payload = json.loads(tasks[0].payload)
+        self.assertDictContainsSubset({'user_id': 'test_user_id',
+                                       'kind': 'SendJob', 'found': 1},
+                                      payload)
+
+
 class CommonScheduledTests(object):
     """ Common tests for Scheduled Jobs """
     model_cls = None
@@ -62,9 +614,319 @@ class CommonScheduledTests(object):
         self.create_job()
         self.create_job()
         self.create_job(state='done')
+        self.create_job(user_id='other_user')
         self.model_cls.add_all_due_to_queue()
         tasks = self.taskqueue_stub.get_filtered_tasks()
+        # one batch for test_user_id, a single job task for other_user
         self.assertEquals(len(tasks), 2)
+        self.assertEquals(
+            len(self.taskqueue_stub.get_filtered_tasks(
+                url=models.USER_BATCH_URL)), 1)
+
+    def test_put_adds_to_dispatch_index(self):
+        job = self.create_job()
+        bucket = models.DispatchBucket.get_key(job.key, job.scheduled_at).get()
+        self.assertEquals(bucket.job_keys, [job.key])
+        self.assertEquals(bucket.kind, self.model_cls._get_kind())
+        # saving again should not add a duplicate entry
+        job.put()
+        self.assertEquals(bucket.key.get().job_keys, [job.key])
+
+    def test_put_not_scheduled_not_indexed(self):
+        job = self.create_job(state='done')
+        bucket_key = models.DispatchBucket.get_key(job.key, job.scheduled_at)
+        self.assertIsNone(bucket_key.get())
+
+    def test_add_all_due_to_queue_consumes_index(self):
+        now = datetime.datetime.utcnow()
+        due_job = self.create_job(scheduled_at=now)
+        later_job = self.create_job(
+            scheduled_at=now + datetime.timedelta(hours=1))
+        stale_job = self.create_job(scheduled_at=now)
+        stale_job.state = 'done'
+        stale_job.put()
+        self.model_cls.add_all_due_to_queue()
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        self.assertEquals(len(tasks), 1)
+        self.assertEquals(json.loads(tasks[0].payload)['key'],
+                          due_job.key.urlsafe())
+        for job in (due_job, stale_job):
+            bucket = models.DispatchBucket.get_key(
+                job.key, job.scheduled_at).get()
+            self.assertTrue(bucket is None or
+                            job.key not in bucket.job_keys)
+        bucket = models.DispatchBucket.get_key(
+            later_job.key, later_job.scheduled_at).get()
+        self.assertIn(later_job.key, bucket.job_keys)
+
+    def test_dispatch_during_save(self):
+        """
+        Should dispatch job that is rescheduled by a save that commits
+        while a dispatcher runs.
+        """
+        now = datetime.datetime.utcnow()
+        job = self.create_job(scheduled_at=now + datetime.timedelta(hours=1))
+        results = []
+
+        def dispatch():
+            # another request, outside of the transaction
+            results.append(self.model_cls.dispatch_due(now, now=now))
+
+        @ndb.transactional(xg=True)
+        def save():
+            job.scheduled_at = now
+            job.save()
+            thread = threading.Thread(target=dispatch)
+            thread.start()
+            thread.join()
+
+        save()
+        self.assertEquals(results, [0])
+        self.assertIn(job.key, models.DispatchBucket.get_key(
+            job.key, now).get().job_keys)
+        self.assertEquals(self.model_cls.dispatch_due(now, now=now), 1)
+        self.assertEquals(job.key.get().state, 'queued')
+
+    def test_dispatch_keeps_entry_of_uncommitted_save(self):
+        """
+        Should keep entries of jobs that are stored with an earlier date
+        until the bucket is due for DISPATCH_STALE_GRACE.
+        """
+        now = datetime.datetime.utcnow()
+        job = self.create_job(scheduled_at=now - datetime.timedelta(hours=1))
+        bucket_key = models.DispatchBucket.get_key(job.key, now)
+        models.DispatchBucket.add_jobs(bucket_key, [job.key], now)
+        self.assertEquals(self.model_cls.dispatch_due(now, now=now), 0)
+        self.assertEquals(bucket_key.get().job_keys, [job.key])
+        self.model_cls.dispatch_due(
+            now, now=now + models.DISPATCH_STALE_GRACE)
+        self.assertIsNone(bucket_key.get())
+
+    def mark_dispatch_index_complete(self):
+        models.DispatchBackfill(id=self.model_cls._get_kind()).put()
+
+    def test_dispatch_due(self):
+        now = datetime.datetime.utcnow()
+        due_job = self.create_job(scheduled_at=now)
+        later_job = self.create_job(
+            scheduled_at=now + datetime.timedelta(seconds=30))
+        self.assertEquals(self.model_cls.dispatch_due(now, now=now), 1)
+        self.assertEquals(due_job.key.get().state, 'queued')
+        self.assertEquals(later_job.key.get().state, 'scheduled')
+
+    def test_add_eta_task(self):
+        later = (datetime.datetime.utcnow() +
+                 datetime.timedelta(hours=1)).replace(microsecond=500)
+        job = self.create_job(scheduled_at=later)
+        job.add_eta_task()
+        self.create_job(scheduled_at=later).add_eta_task()
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=models.DISPATCH_URL)
+        self.assertEquals([task.name for task in tasks],
+                          [job.get_eta_task_name()])
+        # rounded up to whole seconds
+        self.assertEquals(tasks[0].eta_posix,
+                          calendar.timegm(job.get_eta().utctimetuple()))
+        self.assertGreater(job.get_eta(), job.scheduled_at)
+
+    def test_add_eta_tasks(self):
+        """ Should add the eta tasks of jobs that are not there yet. """
+        now = datetime.datetime.utcnow()
+        existing = self.create_job(scheduled_at=now + datetime.timedelta(
+            hours=1))
+        existing.add_eta_task()
+        jobs = [existing] + [
+            self.create_job(scheduled_at=now + datetime.timedelta(hours=2))
+            for _ in xrange(2)]
+        self.model_cls.add_eta_tasks(jobs)
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=models.DISPATCH_URL)
+        self.assertItemsEqual([task.name for task in tasks],
+                              [jobs[0].get_eta_task_name(),
+                               jobs[1].get_eta_task_name()])
+
+    def test_remove_from_dispatch_index(self):
+        job = self.create_job()
+        self.mark_dispatch_index_complete()
+        job.remove_from_dispatch_index()
+        self.model_cls.add_all_due_to_queue()
+        self.assertEquals(len(self.taskqueue_stub.get_filtered_tasks()), 0)
+
+    def test_add_all_due_to_queue_unindexed(self):
+        """
+        Jobs scheduled before the dispatch index existed should be queried
+        until the index is backfilled.
+        """
+        job = self.create_job()
+        job.remove_from_dispatch_index()
+        self.assertEquals(self.model_cls.add_all_due_to_queue(), 1)
+        self.assertEquals(job.key.get().state, 'queued')
+
+    def test_backfill_dispatch_index(self):
+        now = datetime.datetime.utcnow()
+        jobs = [self.create_job(scheduled_at=now) for _ in xrange(3)]
+        self.create_job(scheduled_at=now, state='done')
+        for job in jobs:
+            job.remove_from_dispatch_index()
+        self.assertFalse(self.model_cls.is_dispatch_index_complete())
+        with mock.patch('sndlatr.models.BACKFILL_PAGE_SIZE', 2):
+            self.model_cls.backfill_dispatch_index(time_budget=-1)
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=models.BACKFILL_URL)
+        self.assertEquals(len(tasks), 1)
+        self.assertFalse(self.model_cls.is_dispatch_index_complete())
+        data = validation.backfill_dispatch_index_schema(
+            json.loads(tasks[0].payload))
+        self.model_cls.backfill_dispatch_index(cursor=data['cursor'])
+        self.assertTrue(self.model_cls.is_dispatch_index_complete())
+        indexed = {key for bucket in models.DispatchBucket.query()
+                   for key in bucket.job_keys}
+        self.assertEquals(indexed, {job.key for job in jobs})
+
+        self.assertEquals(self.model_cls.add_all_due_to_queue(), 3)
+
+    def test_add_all_due_to_queue_continuation(self):
+        """
+        Should continue in a task when time budget runs out and skip
+        overlapping runs meanwhile.
+        """
+        now = datetime.datetime.utcnow()
+        for minutes in (1, 2, 3):
+            self.create_job(
+                scheduled_at=now - datetime.timedelta(minutes=minutes))
+        with mock.patch('sndlatr.models.DISPATCH_PAGE_SIZE', 1):
+            cnt = self.model_cls.add_all_due_to_queue(time_budget=-1)
+        self.assertEquals(cnt, 1)
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url='/api/tasks/enqueue_scheduled')
+        self.assertEquals(len(tasks), 1)
+        payload = json.loads(tasks[0].payload)
+        self.assertEquals(payload['kind'], self.model_cls._get_kind())
+
+        # overlapping cron run should not do anything
+        self.assertEquals(self.model_cls.add_all_due_to_queue(), 0)
+
+        continuation = validation.dispatch_continuation_schema(payload)
+        cnt = self.model_cls.add_all_due_to_queue(
+            cursor=continuation['cursor'], now=continuation['now'])
+        self.assertEquals(cnt, 2)
+        # lease should have been released
+        self.assertEquals(self.model_cls.add_all_due_to_queue(), 0)
+        self.assertIsNone(
+            memcache.get('dispatch_lease:' + self.model_cls._get_kind()))
+
+    def test_add_batches_to_queue_single(self):
+        jobs = [self.create_job() for _ in xrange(3)]
+        jobs.append(self.create_job(state='done'))
+        cnt = self.model_cls.add_batches_to_queue(
+            [([job], 0) for job in jobs])
+        self.assertEquals(cnt, 3)
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        self.assertEquals({json.loads(task.payload)['key'] for task in tasks},
+                          {job.key.urlsafe() for job in jobs[0:3]})
+        for job in jobs[0:3]:
+            job = job.key.get()
+            self.assertEquals(job.state, 'queued')
+            self.assertIsNotNone(job.queued_at)
+
+    def test_add_batches_to_queue_not_due(self):
+        """ Jobs rescheduled after they were read should be skipped. """
+        job = self.create_job()
+        stored = job.key.get()
+        stored.scheduled_at += datetime.timedelta(hours=1)
+        stored.put()
+        self.assertEquals(self.model_cls.add_batches_to_queue([([job], 0)]), 0)
+        self.assertEquals(self.taskqueue_stub.get_filtered_tasks(), [])
+        self.assertEquals(job.key.get().state, 'scheduled')
+
+    def test_add_batches_to_queue_task_in_transaction(self):
+        """ Task should not be added if the job could not be queued. """
+        job = self.create_job()
+        with mock.patch('sndlatr.models.Dashboard.save_multi_async',
+                        side_effect=datastore_errors.TransactionFailedError):
+            with self.assertRaises(datastore_errors.TransactionFailedError):
+                self.model_cls.add_batches_to_queue([([job], 0)])
+        self.assertEquals(self.taskqueue_stub.get_filtered_tasks(), [])
+        self.assertEquals(job.key.get().state, 'scheduled')
+
+    def test_add_batches_to_queue_at_most_once(self):
+        """ Adding the same job twice should not create a second task. """
+        job = self.create_job()
+        self.model_cls.add_batches_to_queue([([job], 0)])
+        job.state = 'scheduled'
+        self.model_cls.add_batches_to_queue([([job], 0)])
+        self.assertEquals(len(self.taskqueue_stub.get_filtered_tasks()), 1)
+
+    def test_add_batches_to_queue(self):
+        jobs = [self.create_job() for _ in xrange(3)]
+        cnt = self.model_cls.add_batches_to_queue([(jobs, 20)])
+        self.assertEquals(cnt, 3)
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        self.assertEquals(len(tasks), 1)
+        self.assertEquals(tasks[0].url, models.USER_BATCH_URL)
+        self.assertEquals(json.loads(tasks[0].payload)['keys'],
+                          [job.key.urlsafe() for job in jobs])
+        for job in jobs:
+            job = job.key.get()
+            self.assertEquals(job.state, 'queued')
+
+    def test_requeue_lost_batch(self):
+        long_ago = (datetime.datetime.utcnow() - models.REQUEUE_AFTER -
+                    datetime.timedelta(minutes=1))
+        jobs = [self.create_job(scheduled_at=long_ago, state='queued',
+                                queued_at=long_ago)
+                for _ in xrange(2)]
+        self.model_cls.requeue_lost_jobs(datetime.datetime.utcnow())
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        self.assertEquals(len(tasks), 1)
+        self.assertEquals(set(json.loads(tasks[0].payload)['keys']),
+                          {job.key.urlsafe() for job in jobs})
+
+    def test_spread_user_batches(self):
+        now = datetime.datetime.utcnow()
+        jobs = [self.create_job(user_id='user_1',
+                                scheduled_at=now - datetime.timedelta(
+                                    minutes=i))
+                for i in xrange(5)]
+        jobs.append(self.create_job(user_id='user_2'))
+        batches = list(self.model_cls.spread_user_batches(
+            jobs, batch_size=2, batch_margin=10))
+        self.assertEquals([(len(batch), countdown)
+                           for batch, countdown in batches],
+                          [(2, 0), (2, 10), (1, 20), (1, 0)])
+        # ordered by schedule date
+        self.assertEquals(batches[0][0], [jobs[4], jobs[3]])
+
+    def test_requeue_lost_jobs(self):
+        now = datetime.datetime.utcnow()
+        long_ago = now - models.REQUEUE_AFTER - datetime.timedelta(minutes=1)
+        job = self.create_job(scheduled_at=long_ago, state='queued')
+        # recently queued jobs should not be touched
+        self.create_job(scheduled_at=long_ago, state='queued', queued_at=now)
+        self.assertEquals(self.model_cls.requeue_lost_jobs(now), 1)
+        # the lease was renewed
+        self.assertEquals(self.model_cls.requeue_lost_jobs(now), 0)
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        self.assertEquals([json.loads(task.payload)['key'] for task in tasks],
+                          [job.key.urlsafe()])
+
+    def test_requeue_lost_jobs_not_sending(self):
+        """ Jobs that started sending should never be queued again. """
+        now = datetime.datetime.utcnow()
+        long_ago = now - models.REQUEUE_AFTER - datetime.timedelta(minutes=1)
+        job = self.create_job(scheduled_at=long_ago, state='sending',
+                              queued_at=long_ago)
+        self.assertEquals(self.model_cls.requeue_lost_jobs(now), 0)
+        self.assertEquals(self.taskqueue_stub.get_filtered_tasks(), [])
+        self.assertEquals(job.key.get().state, 'sending')
+
+    def test_start_sending(self):
+        job = self.create_job(state='queued')
+        other = job.key.get(use_cache=False)
+        self.assertTrue(job.start_sending())
+        self.assertEquals(job.key.get().state, 'sending')
+        # a second task that read the job before should back off
+        self.assertFalse(other.start_sending())
 
     def verify_adds_to_queue(self, key, queue_name, queue_url,
                              target_state='queued'):
@@ -127,6 +989,24 @@ class SendJobTest(BaseTestCase, CommonScheduledTests):
         job.add_to_queue()
         self.verify_adds_to_queue(job.key, 'scheduled', '/api/tasks/send')
 
+    def test_send_mail_requeued(self):
+        """
+        A job that was requeued while its first task was slow should be sent
+        once by the two tasks.
+        """
+        now = datetime.datetime.utcnow()
+        long_ago = now - models.REQUEUE_AFTER - datetime.timedelta(minutes=1)
+        job = self.create_job(scheduled_at=long_ago, state='queued',
+                              queued_at=long_ago)
+        first = job.key.get(use_cache=False)
+        self.assertEquals(models.SendJob.requeue_lost_jobs(now), 1)
+        second = job.key.get(use_cache=False)
+        with mailman_mock() as mailman:
+            first.send_mail('token')
+            second.send_mail('token')
+            self.assertEquals(mailman.send_draft.call_count, 1)
+        self.assertEquals(job.key.get().state, 'done')
+
     def test_send_mail(self):
         """
         send_mail should send mail and mark as sent if everything goes well.
@@ -135,7 +1015,7 @@ class SendJobTest(BaseTestCase, CommonScheduledTests):
         with mailman_mock() as mailman:
             job.send_mail('token')
             mailman.send_draft.assert_called_with(
-                job.message_id_int, mock.ANY)
+                job.message_id_int, mock.ANY, prefetch_secret=None)
             mailman.mark_as_sent.assert_called_with(job.message_id_int,
                                                     job.sent_mail_rfc_id,
                                                     'testmail')
@@ -144,6 +1024,17 @@ class SendJobTest(BaseTestCase, CommonScheduledTests):
         self.assertEquals(job.state, 'done')
         self.assertTrue(job.sent_mail_rfc_id)
 
+    def test_send_mail_not_queued(self):
+        """ Should not send if another task started sending the job. """
+        job = self.create_job(state='queued')
+        stored = job.key.get(use_cache=False)
+        stored.state = 'sending'
+        stored.put()
+        with mailman_mock() as mailman:
+            job.send_mail('token')
+            self.assertFalse(mailman.send_draft.called)
+        self.assertEquals(job.key.get().state, 'sending')
+
     def test_send_mail_send_failure(self):
         """ send_mail should not update state when sending fails. """
         job = self.create_job(state='queued')
@@ -151,7 +1042,7 @@ class SendJobTest(BaseTestCase, CommonScheduledTests):
             mailman.send_draft.side_effect = raise_io_error
             with self.assertRaises(IOError):
                 job.send_mail('token')
-            self.assertEquals(job.key.get().state, 'queued')
+            self.assertEquals(job.key.get(use_cache=False).state, 'queued')
             mailman.quit.assert_called_with()
 
     def test_send_mail_mark_failure(self):
@@ -206,7 +1097,7 @@ class ReminderJobTest(BaseTestCase, CommonScheduledTests):
         remind should send remind and mark job as done.
         """
         job = self.create_job(state='queued')
-        with mock_instance('sndlatr.gmail.Mailman') as mailman:
+        with mailman_mock() as mailman:
             mail = mock.create_autospec(spec=gae_mail.EmailMessage)
             mailman.build_reply.return_value = mail
             job.remind('token')
@@ -220,7 +1111,7 @@ class ReminderJobTest(BaseTestCase, CommonScheduledTests):
     def test_remind_conditional_with_reply(self):
         job = self.create_job(state='queued', only_if_noreply=True)
         # should not send mail if there is a reply
-        with mock_instance('sndlatr.gmail.Mailman') as mailman:
+        with mailman_mock() as mailman:
             mailman.get_thread.return_value = [
                 create_thread_mail(message_id='reply_id')]
             job.remind('token')
@@ -233,7 +1124,7 @@ class ReminderJobTest(BaseTestCase, CommonScheduledTests):
         job = self.create_job(state='queued', only_if_noreply=True,
                               known_message_ids=['knownmail'])
         # should send mail if there is no reply
-        with mock_instance('sndlatr.gmail.Mailman') as mailman:
+        with mailman_mock() as mailman:
             mailman.get_thread.return_value = [
                 create_thread_mail(message_id='knownmail')]
             job.remind('token')
@@ -244,7 +1135,7 @@ class ReminderJobTest(BaseTestCase, CommonScheduledTests):
     def test_find_reply(self):
         """ Should find first unknown reply """
         job = self.create_job(known_message_ids=['abc1'])
-        mailman = mock.create_autospec(gmail.Mailman)
+        mailman = create_mailman_mock()
         mail1 = create_thread_mail(message_id='abc1')
         mail2 = create_thread_mail(message_id='abc2')
         mail3 = create_thread_mail(message_id='abc3')
@@ -256,16 +1147,73 @@ class ReminderJobTest(BaseTestCase, CommonScheduledTests):
     def test_find_reply_none(self):
         """ Return value should be none if there is no unkown reply """
         job = self.create_job(known_message_ids=['abc1', 'abc2'])
-        mailman = mock.create_autospec(gmail.Mailman)
+        mailman = create_mailman_mock()
         mailman.get_thread.return_value = [
             create_thread_mail(message_id='abc1'),
             create_thread_mail(message_id='abc2')]
         self.assertIsNone(job.find_reply(mailman))
 
+    def test_find_reply_since_last_seen(self):
+        """ Should only load messages newer than the last checked one. """
+        job = self.create_job(known_message_ids=['abc1', 'abc2'])
+        mailman = create_mailman_mock()
+        mailman.get_thread.return_value = [
+            create_thread_mail(message_id='abc1', uid=10, uid_validity=1),
+            create_thread_mail(message_id='abc2', uid=12, uid_validity=1)]
+        self.assertIsNone(job.find_reply(mailman))
+        mailman.get_thread.assert_called_with(job.thread_id_int,
+                                              since_uid=None,
+                                              uid_validity=None)
+        self.assertEqual(job.last_seen_uid, 12)
+        self.assertEqual(job.uid_validity, 1)
+
+        mailman.get_thread.return_value = [
+            create_thread_mail(message_id='abc3', uid=13, uid_validity=1)]
+        reply = job.find_reply(mailman)
+        self.assertEqual(reply['message_id'], 'abc3')
+        mailman.get_thread.assert_called_with(job.thread_id_int,
+                                              since_uid=12, uid_validity=1)
+        # mark is only moved if there was no reply
+        self.assertEqual(job.last_seen_uid, 12)
+
+    def test_find_reply_uid_validity_changed(self):
+        job = self.create_job(known_message_ids=['abc1'], last_seen_uid=50,
+                              uid_validity=1)
+        mailman = create_mailman_mock()
+        mailman.get_thread.return_value = [
+            create_thread_mail(message_id='abc1', uid=3, uid_validity=2)]
+        self.assertIsNone(job.find_reply(mailman))
+        self.assertEqual(job.last_seen_uid, 3)
+        self.assertEqual(job.uid_validity, 2)
+
+    def test_find_reply_mailbox_unchanged(self):
+        """ Should skip thread search if the all mailbox did not change. """
+        job = self.create_job(known_message_ids=['abc1'])
+        mailman = create_mailman_mock()
+        mailman.get_all_box_status.return_value = {'UIDVALIDITY': 1,
+                                                   'HIGHESTMODSEQ': 100}
+        mailman.get_thread.return_value = [
+            create_thread_mail(message_id='abc1', uid=10, uid_validity=1)]
+        self.assertIsNone(job.find_reply(mailman))
+        self.assertEqual(job.highest_modseq, 100)
+        self.assertEqual(mailman.get_thread.call_count, 1)
+
+        self.assertIsNone(job.find_reply(mailman))
+        self.assertEqual(mailman.get_thread.call_count, 1)
+        self.assertEqual(memcache.get(metrics.THREAD_FETCHES_AVOIDED,
+                                      namespace=metrics.NAMESPACE), 1)
+
+        mailman.get_all_box_status.return_value = {'UIDVALIDITY': 1,
+                                                   'HIGHESTMODSEQ': 104}
+        mailman.get_thread.return_value = [
+            create_thread_mail(message_id='abc2', uid=11, uid_validity=1)]
+        self.assertEqual(job.find_reply(mailman)['message_id'], 'abc2')
+        self.assertEqual(job.highest_modseq, 100)
+
     def test_disable_if_replied(self):
         """ Should disable job if there was a reply. """
         job = self.create_job(only_if_noreply=True, state='checking')
-        with mock_instance('sndlatr.gmail.Mailman') as mailman:
+        with mailman_mock() as mailman:
             mailman.get_thread.return_value = [
                 create_thread_mail(message_id='reply_id',
                                    from_name='Sender',
@@ -280,11 +1228,71 @@ class ReminderJobTest(BaseTestCase, CommonScheduledTests):
     def test_disable_if_replied_noreply(self):
         """ Should not disable job if there was not reply. """
         job = self.create_job(only_if_noreply=True, state='checking')
-        with mock_instance('sndlatr.gmail.Mailman') as mailman:
+        with mailman_mock() as mailman:
             mailman.get_thread.return_value = []
             job.disable_if_replied('token')
         self.assertEqual(job.state, 'scheduled')
 
+    def test_find_replies(self):
+        """ Should fetch threads of all jobs at once. """
+        job1 = self.create_job(thread_id='a', known_message_ids=['abc1'],
+                               last_seen_uid=10, uid_validity=1)
+        job2 = self.create_job(thread_id='b', known_message_ids=['abc2'],
+                               last_seen_uid=20, uid_validity=1)
+        mailman = create_mailman_mock()
+        mailman.get_threads.return_value = {
+            0xa: [create_thread_mail(message_id='abc1', uid=15,
+                                     uid_validity=1)],
+            0xb: [create_thread_mail(message_id='abc3', uid=15,
+                                     uid_validity=1),
+                  create_thread_mail(message_id='abc4', uid=21,
+                                     uid_validity=1)]}
+        replies = models.RemindJob.find_replies([job1, job2], mailman)
+        mailman.get_threads.assert_called_once_with(set([0xa, 0xb]),
+                                                    since_uid=10,
+                                                    uid_validity=1)
+        self.assertIsNone(replies[job1.key])
+        self.assertEqual(job1.last_seen_uid, 15)
+        # messages before the mark of job2 were already checked
+        self.assertEqual(replies[job2.key]['message_id'], 'abc4')
+
+    def test_find_replies_mixed_marks(self):
+        """ Should load whole threads if marks are not comparable. """
+        job1 = self.create_job(thread_id='a', last_seen_uid=10,
+                               uid_validity=1)
+        job2 = self.create_job(thread_id='b')
+        mailman = create_mailman_mock()
+        mailman.get_threads.return_value = {}
+        replies = models.RemindJob.find_replies([job1, job2], mailman)
+        mailman.get_threads.assert_called_once_with(set([0xa, 0xb]),
+                                                    since_uid=None,
+                                                    uid_validity=None)
+        self.assertEqual(replies, {job1.key: None, job2.key: None})
+
+    def test_disable_replied(self):
+        """ Should check and save all jobs in checking state. """
+        replied = self.create_job(thread_id='a', only_if_noreply=True,
+                                  state='checking')
+        noreply = self.create_job(thread_id='b', only_if_noreply=True,
+                                  state='checking')
+        unconditional = self.create_job(thread_id='c', state='checking')
+        done = self.create_job(thread_id='d', only_if_noreply=True,
+                               state='done')
+        with mailman_mock() as mailman:
+            mailman.get_threads.return_value = {
+                0xa: [create_thread_mail(message_id='reply_id')]}
+            models.RemindJob.disable_replied(
+                [replied, noreply, unconditional, done], 'token')
+            mailman.get_threads.assert_called_once_with(
+                set([0xa, 0xb]), since_uid=None, uid_validity=None)
+            self.assertEqual(mailman.quit.call_count, 1)
+        self.assertEqual(replied.key.get().state, 'disabled')
+        self.assertEqual(replied.key.get().disabled_reply.message_id,
+                         'reply_id')
+        self.assertEqual(noreply.key.get().state, 'scheduled')
+        self.assertEqual(unconditional.key.get().state, 'scheduled')
+        self.assertEqual(done.key.get().state, 'done')
+
     def test_add_to_check_reply_queue(self):
         job = self.create_job(only_if_noreply=True, state='scheduled')
         job.add_to_check_reply_queue()
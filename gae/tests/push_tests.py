@@ -0,0 +1,64 @@
+import time
+import json
+
+import mock
+from google.appengine.ext import testbed
+
+from sndlatr import push
+from tests import BaseTestCase
+
+
+class PushTest(BaseTestCase):
+    def get_stub(self):
+        return self.testbed.get_stub(testbed.CHANNEL_SERVICE_NAME)
+
+    def get_messages(self, token):
+        return self.get_stub().get_channel_messages(token)
+
+    def create_channel(self, user_id):
+        """ Opens a channel of user and connects a client to it. """
+        token = push.create_channel(user_id)
+        self.get_stub().connect_channel(token)
+        return token
+
+    def test_publish(self):
+        """ Should send message to all open channels of user. """
+        tokens = [self.create_channel('user1') for _ in xrange(2)]
+        other_token = self.create_channel('user2')
+        push.publish('user1', 'message')
+        for token in tokens:
+            self.assertEqual(self.get_messages(token), ['message'])
+        self.assertFalse(self.get_messages(other_token))
+
+    def test_publish_without_channels(self):
+        with mock.patch('google.appengine.api.channel.send_message') as send:
+            push.publish('user1', 'message')
+            self.assertFalse(send.called)
+
+    def test_message_too_big(self):
+        token = self.create_channel('user1')
+        push.publish('user1', 'x' * (push.MAX_MESSAGE_SIZE + 1))
+        self.assertFalse(self.get_messages(token))
+
+    def test_publish_async(self):
+        """ Should add a task that sends message. """
+        too_big = 'x' * (push.MAX_MESSAGE_SIZE + 1)
+        for message in ('message', too_big):
+            push.publish_async('user1', message).get_result()
+        tasks = self.taskqueue_stub.get_filtered_tasks(url=push.PUBLISH_URL)
+        self.assertEqual([json.loads(task.payload) for task in tasks],
+                         [{'user_id': 'user1', 'message': 'message'}])
+
+    def test_expired_channels(self):
+        """ Should drop expired and the oldest channels. """
+        now = time.time()
+        with mock.patch('time.time') as time_mock:
+            time_mock.return_value = now
+            push.create_channel('user1')
+            time_mock.return_value = now + 60
+            for _ in xrange(push.MAX_CHANNELS):
+                push.create_channel('user1')
+            self.assertEqual(len(push.get_client_ids('user1')),
+                             push.MAX_CHANNELS)
+            time_mock.return_value = now + 61 + push.CHANNEL_DURATION * 60
+            self.assertEqual(push.get_client_ids('user1'), [])
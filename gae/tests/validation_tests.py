@@ -190,3 +190,45 @@ class ValidateSnippet(unittest.TestCase):
         snippet = self.valid_snippet
         snippet.update({'id': 234, 'updatedAt': 'dfdf', 'usageCnt': 234,
                         'createdAt': 'hihi'})
+
+
+class ValidateBatch(unittest.TestCase):
+    def setUp(self):
+        self.send_job = {'scheduledAt': '2013-05-08T16:11:23.000Z',
+                         'messageId': '4d2', 'utcOffset': 0}
+
+    def test_valid(self):
+        result = validation.batch_schema({'operations': [
+            {'type': 'sendJob', 'action': 'create', 'data': self.send_job},
+            {'type': 'snippet', 'action': 'update', 'id': 1, 'data': {}},
+            {'type': 'remindJob', 'action': 'delete', 'id': 1}]})
+        operations = result['operations']
+        self.assertEqual(operations[0]['data']['scheduledAt'],
+                         datetime.datetime(2013, 5, 8, 16, 11, 23))
+        self.assertEqual(operations[1]['data']['subject'], '')
+
+    def test_invalid_data(self):
+        self.send_job['messageId'] = 'xyz'
+        with self.assertRaises(validation.Error):
+            validation.batch_schema({'operations': [
+                {'type': 'sendJob', 'action': 'create',
+                 'data': self.send_job}]})
+
+    def test_missing_id(self):
+        with self.assertRaises(validation.Error):
+            validation.batch_schema({'operations': [
+                {'type': 'sendJob', 'action': 'delete'}]})
+
+    def test_duplicate_id(self):
+        with self.assertRaises(validation.Error):
+            validation.batch_schema({'operations': [
+                {'type': 'sendJob', 'action': 'delete', 'id': 1},
+                {'type': 'sendJob', 'action': 'update', 'id': 1,
+                 'data': self.send_job}]})
+
+    def test_too_many(self):
+        operation = {'type': 'sendJob', 'action': 'create',
+                     'data': self.send_job}
+        with self.assertRaises(validation.Error):
+            validation.batch_schema({'operations': [operation] * (
+                validation.BATCH_MAX_OPERATIONS + 1)})
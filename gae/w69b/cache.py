@@ -1,138 +1,259 @@
-import collections
+import sys
+import time
 import functools
-from itertools import ifilterfalse
-from heapq import nsmallest
-from operator import itemgetter
+import threading
 
-class Counter(dict):
-    'Mapping where default values are zero'
-    def __missing__(self, key):
-        return 0
 
-def lru_cache(maxsize=100):
+def lru_cache(maxsize=100, ttl=None):
     '''Least-recently-used cache decorator.
 
     Arguments to the cached function must be hashable.
+    Results expire after ttl seconds if ttl is given. Concurrent calls with
+    the same arguments share a single call of the function.
     Cache performance statistics stored in f.hits and f.misses.
     Clear the cache with f.clear().
     http://en.wikipedia.org/wiki/Cache_algorithms#Least_Recently_Used
 
     '''
-    maxqueue = maxsize * 10
-    def decorating_function(user_function,
-            len=len, iter=iter, tuple=tuple, sorted=sorted, KeyError=KeyError):
-        cache = {}                  # mapping of args to results
-        queue = collections.deque() # order that keys have been used
-        refcount = Counter()        # times each key is in the queue
-        sentinel = object()         # marker for looping around the queue
+    def decorating_function(user_function):
+        cache = LRUCache(maxsize=maxsize, ttl=ttl)
         kwd_mark = object()         # separate positional and keyword args
 
-        # lookup optimizations (ugly but fast)
-        queue_append, queue_popleft = queue.append, queue.popleft
-        queue_appendleft, queue_pop = queue.appendleft, queue.pop
-
         @functools.wraps(user_function)
         def wrapper(*args, **kwds):
             # cache key records both positional and keyword args
             key = args
             if kwds:
                 key += (kwd_mark,) + tuple(sorted(kwds.items()))
-
-            # record recent use of this key
-            queue_append(key)
-            refcount[key] += 1
-
-            # get cache entry or compute if not found
-            try:
-                result = cache[key]
-                wrapper.hits += 1
-            except KeyError:
-                result = user_function(*args, **kwds)
-                cache[key] = result
-                wrapper.misses += 1
-
-                # purge least recently used cache entry
-                if len(cache) > maxsize:
-                    key = queue_popleft()
-                    refcount[key] -= 1
-                    while refcount[key]:
-                        key = queue_popleft()
-                        refcount[key] -= 1
-                    del cache[key], refcount[key]
-
-            # periodically compact the queue by eliminating duplicate keys
-            # while preserving order of most recent access
-            if len(queue) > maxqueue:
-                refcount.clear()
-                queue_appendleft(sentinel)
-                for key in ifilterfalse(refcount.__contains__,
-                                        iter(queue_pop, sentinel)):
-                    queue_appendleft(key)
-                    refcount[key] = 1
-
-
+            result = cache.get(key, _missing)
+            if result is _missing:
+                result = cache._load(
+                    key, functools.partial(user_function, *args, **kwds), None)
+                wrapper.misses = cache.misses
+            else:
+                wrapper.hits = cache.hits
             return result
 
         def clear():
             cache.clear()
-            queue.clear()
-            refcount.clear()
             wrapper.hits = wrapper.misses = 0
 
         wrapper.hits = wrapper.misses = 0
         wrapper.clear = clear
+        wrapper.cache = cache
         return wrapper
     return decorating_function
 
 
-def lfu_cache(maxsize=100):
-    '''Least-frequenty-used cache decorator.
-
-    Arguments to the cached function must be hashable.
-    Cache performance statistics stored in f.hits and f.misses.
-    Clear the cache with f.clear().
-    http://en.wikipedia.org/wiki/Least_Frequently_Used
-
-    '''
-    def decorating_function(user_function):
-        cache = {}                      # mapping of args to results
-        use_count = Counter()           # times each key has been accessed
-        kwd_mark = object()             # separate positional and keyword args
+# fields of linked list nodes of LRUCache
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES, _SIZE = range(6)
+# marks missing values
+_missing = object()
 
-        @functools.wraps(user_function)
-        def wrapper(*args, **kwds):
-            key = args
-            if kwds:
-                key += (kwd_mark,) + tuple(sorted(kwds.items()))
-            use_count[key] += 1
-
-            # get cache entry or compute if not found
-            try:
-                result = cache[key]
-                wrapper.hits += 1
-            except KeyError:
-                result = user_function(*args, **kwds)
-                cache[key] = result
-                wrapper.misses += 1
-
-                # purge least frequently used cache entry
-                if len(cache) > maxsize:
-                    for key, _ in nsmallest(maxsize // 10,
-                                            use_count.iteritems(),
-                                            key=itemgetter(1)):
-                        del cache[key], use_count[key]
 
-            return result
+class LRUCache(object):
+    '''Thread safe least-recently-used mapping.
 
-        def clear():
-            cache.clear()
-            use_count.clear()
-            wrapper.hits = wrapper.misses = 0
+    Entries are kept in a dict and a circular doubly linked list ordered by
+    recent use, so get, set and delete are O(1). Holds at most maxsize
+    entries and, if maxbytes is given, entries of at most maxbytes total
+    size as returned by sizeof (sys.getsizeof by default). The least
+    recently used entries are purged when a bound is exceeded.
+    Entries expire after ttl seconds (per cache or per set call, None
+    means never).
+    Cache performance statistics stored in c.hits, c.misses, c.evictions
+    and c.expirations, see also stats(). on_evict(key, value) is called for
+    entries purged by the bounds.
 
-        wrapper.hits = wrapper.misses = 0
-        wrapper.clear = clear
-        return wrapper
-    return decorating_function
+    '''
+    def __init__(self, maxsize=100, ttl=None, maxbytes=None, sizeof=None,
+                 on_evict=None, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or sys.getsizeof
+        self.on_evict = on_evict
+        self._clock = clock
+        self._lock = threading.Lock()
+        # keys that are loaded by get_or_load to the lock held while loading
+        self._loading = {}
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, None, 0]
+        self.currbytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            # inlined _lookup, this is the hot path
+            node = self._map.get(key)
+            if node is not None:
+                expires = node[_EXPIRES]
+                if expires is not None and expires <= self._clock():
+                    self._unlink(node)
+                    self.expirations += 1
+                else:
+                    root = self._root
+                    if root[_NEXT] is not node:
+                        prev, next = node[_PREV], node[_NEXT]
+                        prev[_NEXT] = next
+                        next[_PREV] = prev
+                        first = root[_NEXT]
+                        node[_PREV] = root
+                        node[_NEXT] = first
+                        first[_PREV] = root[_NEXT] = node
+                    self.hits += 1
+                    return node[_VALUE]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        '''Stores value, ttl defaults to the ttl of the cache.'''
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        with self._lock:
+            evicted = self._set(key, value, ttl, size)
+        self._notify_evicted(evicted)
+
+    def get_or_load(self, key, loader, ttl=None):
+        '''Returns value of key. On a miss, loader() is called to load the
+        value, which is stored and returned. Concurrent calls for the same
+        key wait for the first one instead of loading it again.
+
+        '''
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = self._load(key, loader, ttl)
+        return value
+
+    def _load(self, key, loader, ttl):
+        '''Loads missing value of key with loader, see get_or_load.'''
+        with self._lock:
+            # loaded by another thread in the meantime?
+            node = self._lookup(key)
+            if node is not None:
+                return node[_VALUE]
+            load_lock = self._loading.get(key)
+            loading = load_lock is None
+            if loading:
+                load_lock = self._loading[key] = threading.Lock()
+                load_lock.acquire()
+        if not loading:
+            # wait for the other thread and use its value or load it
+            # ourselves if it failed
+            with load_lock:
+                pass
+            return self._load(key, loader, ttl)
+        try:
+            value = loader()
+            size = self.sizeof(value) if self.maxbytes is not None else 0
+            with self._lock:
+                evicted = self._set(key, value, ttl, size)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            load_lock.release()
+        self._notify_evicted(evicted)
+        return value
+
+    def _set(self, key, value, ttl, size):
+        '''Stores value and returns evicted entries. Call with lock held.'''
+        if ttl is None:
+            ttl = self.ttl
+        node = self._map.get(key)
+        if node is not None:
+            self._unlink(node)
+        expires = self._clock() + ttl if ttl is not None else None
+        self._link([None, None, key, value, expires, size])
+        return self._purge()
+
+    def delete(self, key):
+        with self._lock:
+            node = self._map.get(key)
+            if node is not None:
+                self._unlink(node)
+
+    def clear(self):
+        with self._lock:
+            self._map.clear()
+            root = self._root
+            root[:] = [root, root, None, None, None, 0]
+            self.currbytes = 0
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self):
+        '''Returns dict of performance statistics and current size.'''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'size': len(self._map), 'bytes': self.currbytes}
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        '''Returns node of key or None if it is missing or expired. Marks
+        it as most recently used. Call with lock held.'''
+        node = self._map.get(key)
+        if node is None:
+            return None
+        expires = node[_EXPIRES]
+        if expires is not None and expires <= self._clock():
+            self._unlink(node)
+            self.expirations += 1
+            return None
+        # move to front
+        root = self._root
+        if root[_NEXT] is not node:
+            prev, next = node[_PREV], node[_NEXT]
+            prev[_NEXT] = next
+            next[_PREV] = prev
+            first = root[_NEXT]
+            node[_PREV] = root
+            node[_NEXT] = first
+            first[_PREV] = root[_NEXT] = node
+        return node
+
+    def _link(self, node):
+        '''Inserts node at the front of the list.'''
+        root = self._root
+        first = root[_NEXT]
+        node[_PREV] = root
+        node[_NEXT] = first
+        first[_PREV] = root[_NEXT] = node
+        self._map[node[_KEY]] = node
+        self.currbytes += node[_SIZE]
+
+    def _unlink(self, node):
+        prev, next = node[_PREV], node[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+        del self._map[node[_KEY]]
+        self.currbytes -= node[_SIZE]
+
+    def _purge(self):
+        '''Removes least recently used entries while bounds are exceeded.
+        Returns list of removed (key, value) tuples.'''
+        evicted = []
+        root = self._root
+        while self._map and (
+                len(self._map) > self.maxsize or
+                (self.maxbytes is not None and
+                 self.currbytes > self.maxbytes)):
+            node = root[_PREV]
+            self._unlink(node)
+            self.evictions += 1
+            evicted.append((node[_KEY], node[_VALUE]))
+        return evicted
+
+    def _notify_evicted(self, evicted):
+        if self.on_evict is not None:
+            for key, value in evicted:
+                self.on_evict(key, value)
 
 
 if __name__ == '__main__':
@@ -147,14 +268,3 @@ if __name__ == '__main__':
         r = f(choice(domain), choice(domain))
 
     print(f.hits, f.misses)
-
-    @lfu_cache(maxsize=20)
-    def f(x, y):
-        return 3*x+y
-
-    domain = range(5)
-    from random import choice
-    for i in range(1000):
-        r = f(choice(domain), choice(domain))
-
-    print(f.hits, f.misses)
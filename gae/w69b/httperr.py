@@ -26,6 +26,11 @@ class HTTPSuccess(HTTPError):
     status_code = 200
 
 
+class HTTPNotModified(HTTPError):
+    """ Client already has the current version (status code 304). """
+    status_code = 304
+
+
 class HTTPErrorMixin(object):
     """ Adds HTTP error handling to dispatching """
 
@@ -1,27 +1,125 @@
 import threading
 import json
+import re
+import time
+import logging
+import hashlib
 
 import webapp2
 import httplib2
 from oauth2client import crypt, client
 
-_cached_http = httplib2.Http(client.MemoryCache())
+from w69b import cache
 
+# seconds certs are cached if their response has no max-age.
+DEFAULT_CERTS_MAX_AGE = 3600
+# certs are fetched again for tokens with an unknown key id at most once
+# within this many seconds.
+MIN_CERTS_REFRESH_INTERVAL = 60
 
-def verify_id_token(id_token, audience, http=None,
-                    cert_uri=client.ID_TOKEN_VERIFICATON_CERTS):
+# maximal number of verified tokens whose users are cached.
+VERIFIED_TOKEN_CACHE_SIZE = 1000
+
+_max_age_re = re.compile(r'max-age=(\d+)')
+
+
+class CertManager(object):
+    """
+    Thread safe cache of the certs at cert_uri parsed into verifiers keyed by
+    key id (kid). Certs are fetched again when the max-age of their response
+    expired or when a token was signed with an unknown key id (keys are
+    rotated). If fetching fails, previously fetched certs are used for
+    another MIN_CERTS_REFRESH_INTERVAL seconds.
+    """
+
+    def __init__(self, cert_uri=client.ID_TOKEN_VERIFICATON_CERTS,
+                 http=None):
+        self.cert_uri = cert_uri
+        self._http = http
+        self._lock = threading.Lock()
+        self._verifiers = {}
+        self._fetched_at = 0
+        self._expires_at = 0
+
+    def get_verifiers(self, kid=None):
+        """
+        Returns list of verifiers for given key id. The list is empty if
+        there is no cert with this kid. Returns verifiers of all certs if kid
+        is None.
+        """
+        with self._lock:
+            now = time.time()
+            if (now >= self._expires_at or
+                    (kid is not None and kid not in self._verifiers and
+                     now - self._fetched_at >= MIN_CERTS_REFRESH_INTERVAL)):
+                self._refresh(now)
+            if kid is None:
+                return self._verifiers.values()
+            verifier = self._verifiers.get(kid)
+            return [verifier] if verifier else []
+
+    def _refresh(self, now):
+        try:
+            verifiers, resp = self._fetch()
+        except Exception:
+            if not self._verifiers:
+                raise
+            logging.warning('fetching certs failed, keeping old certs',
+                            exc_info=True)
+            self._fetched_at = now
+            self._expires_at = max(self._expires_at,
+                                   now + MIN_CERTS_REFRESH_INTERVAL)
+            return
+        self._verifiers = verifiers
+        self._fetched_at = now
+        self._expires_at = now + self._get_max_age(resp)
+        logging.debug('fetched {} certs'.format(len(self._verifiers)))
+
+    def _fetch(self):
+        """ Returns tuple of verifiers by kid and the response. """
+        http = self._http or httplib2.Http()
+        resp, content = http.request(self.cert_uri)
+        if resp.status != 200:
+            raise client.VerifyJwtTokenError('Status code: %d' % resp.status)
+        certs = json.loads(content)
+        verifiers = {kid: crypt.Verifier.from_string(pem, True)
+                     for kid, pem in certs.iteritems()}
+        return verifiers, resp
+
+    @staticmethod
+    def _get_max_age(resp):
+        """ Returns seconds response may be cached (Cache-Control, Age). """
+        match = _max_age_re.search(resp.get('cache-control', ''))
+        if not match:
+            return DEFAULT_CERTS_MAX_AGE
+        try:
+            age = int(resp.get('age', 0))
+        except ValueError:
+            age = 0
+        return max(int(match.group(1)) - age, 0)
+
+    def clear(self):
+        with self._lock:
+            self._verifiers = {}
+            self._fetched_at = self._expires_at = 0
+
+
+cert_manager = CertManager()
+# (audience, sha256 of token) -> User, entries expire with the token.
+verified_token_cache = cache.LRUCache(maxsize=VERIFIED_TOKEN_CACHE_SIZE)
+
+
+def verify_id_token(id_token, audience, certs=None):
     """Verifies a signed JWT id_token.
 
-    This function requires PyOpenSSL and because of that it does not work on
-    App Engine.
+    Like oauth2client.client.verify_id_token, but the signature is only
+    checked with the cert whose key id matches the kid in the JWT header.
+    Certs are parsed once and cached by the CertManager.
 
     Args:
       id_token: string, A Signed JWT.
       audience: string, The audience 'aud' that the token should be for.
-      http: httplib2.Http, instance to use to make the HTTP request. Callers
-        should supply an instance that has caching enabled.
-      cert_uri: string, URI of the certificates in JSON format to
-        verify the JWT against.
+      certs: CertManager, defaults to cert_manager.
 
     Returns:
       The deserialized JSON in the JWT.
@@ -29,16 +127,64 @@ def verify_id_token(id_token, audience, http=None,
     Raises:
       oauth2client.crypt.AppIdentityError if the JWT fails to verify.
     """
-    if http is None:
-        http = _cached_http
+    if certs is None:
+        certs = cert_manager
+    segments = id_token.split('.')
+    if len(segments) != 3:
+        raise crypt.AppIdentityError(
+            'Wrong number of segments in token: %s' % id_token)
+    try:
+        header = json.loads(crypt._urlsafe_b64decode(segments[0]))
+        json_body = crypt._urlsafe_b64decode(segments[1])
+        parsed = json.loads(json_body)
+        signature = crypt._urlsafe_b64decode(segments[2])
+    except (TypeError, ValueError):
+        raise crypt.AppIdentityError('Can\'t parse token: %s' % id_token)
+    if not isinstance(header, dict) or not isinstance(parsed, dict):
+        raise crypt.AppIdentityError('Can\'t parse token: %s' % id_token)
 
-    resp, content = http.request(cert_uri)
+    signed = '%s.%s' % (segments[0], segments[1])
+    if not any(verifier.verify(signed, signature)
+               for verifier in certs.get_verifiers(header.get('kid'))):
+        raise crypt.AppIdentityError('Invalid token signature: %s' % id_token)
+    _verify_claims(parsed, audience, json_body)
+    return parsed
 
-    if resp.status == 200:
-        certs = json.loads(content)
-        return crypt.verify_signed_jwt_with_certs(id_token, certs, audience)
-    else:
-        raise client.VerifyJwtTokenError('Status code: %d' % resp.status)
+
+def _verify_claims(parsed, audience, json_body):
+    """
+    Checks timestamps and audience of JWT payload like
+    crypt.verify_signed_jwt_with_certs.
+    """
+    iat = parsed.get('iat')
+    if iat is None:
+        raise crypt.AppIdentityError('No iat field in token: %s' % json_body)
+    earliest = iat - crypt.CLOCK_SKEW_SECS
+
+    now = long(time.time())
+    exp = parsed.get('exp')
+    if exp is None:
+        raise crypt.AppIdentityError('No exp field in token: %s' % json_body)
+    if exp >= now + crypt.MAX_TOKEN_LIFETIME_SECS:
+        raise crypt.AppIdentityError(
+            'exp field too far in future: %s' % json_body)
+    latest = exp + crypt.CLOCK_SKEW_SECS
+
+    if now < earliest:
+        raise crypt.AppIdentityError('Token used too early, %d < %d: %s' %
+                                     (now, earliest, json_body))
+    if now > latest:
+        raise crypt.AppIdentityError('Token used too late, %d > %d: %s' %
+                                     (now, latest, json_body))
+
+    if audience is not None:
+        aud = parsed.get('aud')
+        if aud is None:
+            raise crypt.AppIdentityError(
+                'No aud field in token: %s' % json_body)
+        if aud != audience:
+            raise crypt.AppIdentityError('Wrong recipient, %s != %s: %s' %
+                                         (aud, audience, json_body))
 
 
 def get_current_user():
@@ -70,15 +216,26 @@ class User(object):
 
 
 def _user_from_token(token, audience):
-    """ Returns User object or None if token is not valid or None. """
+    """
+    Returns User object or None if token is not valid or None. Users of
+    verified tokens are cached until the tokens expire.
+    """
     if token is None:
         return None
+    key = (audience, hashlib.sha256(token).digest())
+    user = verified_token_cache.get(key)
+    if user is not None:
+        return user
     try:
         verified_token = verify_id_token(token, audience)
-        return User(email=verified_token['email'],
+        user = User(email=verified_token['email'],
                     _user_id=verified_token['sub'])
     except (crypt.AppIdentityError, KeyError):
         return None
+    ttl = verified_token['exp'] - time.time()
+    if ttl > 0:
+        verified_token_cache.set(key, user, ttl=ttl)
+    return user
 
 
 class Decorator(object):